@@ -0,0 +1,91 @@
+''' Startup and lookup cost of the mapped cache index against walking the .meta files into a dict
+
+	python benchmarks/cache_index.py --objects 100000
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'liveserve', 'app_factory'))
+
+from cacheindex import CacheIndex
+
+def populate(cache_dir, count):
+	''' `count` .meta files sharded as the disk tier lays them out, and the index of them '''
+	index = CacheIndex(os.path.join(cache_dir, 'index'))
+	keys = []
+	for number in range(count):
+		key = '%032x.html' % (random.getrandbits(128),)
+		meta = {'key': key, 'suffix': 'html', 'stored_at': time.time(), 'size': number, 'etag': '"%x"' % (number,), 'last_modified': None, 'source_digest': None, 'encodings': ['gzip']}
+		shard_dir = os.path.join(cache_dir, key[:2], key[2:4])
+		os.makedirs(shard_dir, exist_ok=True)
+		with open(os.path.join(shard_dir, key + '.meta'), 'w') as f:
+			json.dump(meta, f)
+		index.put(key, meta['stored_at'], meta['size'], meta['suffix'], meta['encodings'], meta['etag'])
+		keys.append(key)
+	index.close()
+	return keys
+
+def walk_metas(cache_dir):
+	''' What the disk tier did at startup before the index '''
+	entries = {}
+	for (dir_path, _, file_names) in os.walk(cache_dir):
+		for file_name in file_names:
+			if file_name.endswith('.meta'):
+				with open(os.path.join(dir_path, file_name), 'rb') as f:
+					meta = json.loads(f.read())
+				entries[meta['key']] = meta
+	return entries
+
+def drop_page_cache():
+	try:
+		with open('/proc/sys/vm/drop_caches', 'w') as f:
+			f.write('3\n')
+		return True
+	except OSError:
+		return False
+
+def timed(function, *args):
+	start = time.perf_counter()
+	result = function(*args)
+	return time.perf_counter() - start, result
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark the cache index')
+	parser.add_argument('--objects', type=int, default=100000)
+	parser.add_argument('--lookups', type=int, default=200000)
+	args = parser.parse_args(argv)
+
+	cache_dir = tempfile.mkdtemp(prefix='cache-index-')
+	try:
+		print('populating %d objects in %s' % (args.objects, cache_dir))
+		keys = populate(cache_dir, args.objects)
+		cold = drop_page_cache()
+
+		(walk_time, entries) = timed(walk_metas, cache_dir)
+		drop_page_cache()
+		(open_time, index) = timed(CacheIndex, os.path.join(cache_dir, 'index'))
+		print('startup (%s page cache)' % ('cold' if cold else 'warm',))
+		print('  walk .meta files  %9.3f s' % (walk_time,))
+		print('  map the index     %9.3f s' % (open_time,))
+
+		sample = [random.choice(keys) for _ in range(args.lookups)] + ['%032x.html' % (number,) for number in range(args.lookups // 10)]
+		(dict_time, _) = timed(lambda: [entries.get(key) for key in sample])
+		(index_time, _) = timed(lambda: [index.get(key) for key in sample])
+		(stat_time, _) = timed(lambda: [os.path.exists(os.path.join(cache_dir, key[:2], key[2:4], key + '.meta')) for key in sample])
+		print('lookups (%d hits, %d misses)' % (args.lookups, args.lookups // 10))
+		print('  stat() the .meta  %9.0f /s' % (len(sample) / stat_time,))
+		print('  in-process dict   %9.0f /s' % (len(sample) / dict_time,))
+		print('  mapped index      %9.0f /s' % (len(sample) / index_time,))
+		index.close()
+	finally:
+		shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,85 @@
+''' Check the single pass link rewriter against the lxml DOM path on the corpus, then time both
+
+	python benchmarks/html_rewrite.py --size 2
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'liveserve', 'app_factory'))
+
+from lxml import html
+from linkrewrite import LinkRewriter
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'html_corpus')
+
+def check_corpus(rewriter):
+	''' The single pass output, parsed and serialised by lxml, must be exactly what the DOM path produces '''
+	failures = 0
+	for path in sorted(glob.glob(os.path.join(CORPUS, '*.html'))):
+		with open(path, encoding='utf-8') as f:
+			page = f.read()
+		expected = rewriter.rewrite_dom(page)
+		got = html.tostring(html.document_fromstring(rewriter.rewrite_html(page)), encoding='utf-8')
+		if got != expected:
+			failures += 1
+			print('MISMATCH %s' % (os.path.basename(path),))
+			print('  dom:    %s' % (expected,))
+			print('  stream: %s' % (got,))
+		else:
+			print('ok       %s' % (os.path.basename(path),))
+	return failures
+
+# a listing: three origin links in every 300 bytes
+LISTING_ROW = ('<div class="item"><a href="https://example.com/item/%d?ref=list">Item %d</a> '
+	'<img src="https://cdn.example.com/img/%d.jpg" alt="item" style="background: url(https://example.com/bg.png)"> '
+	'<a href="/relative/%d">relative</a> <a href="https://other.org/%d">elsewhere</a> '
+	'<p>Some text describing item %d with enough words to look like a real listing page.</p></div>\n')
+# an article: mostly text, one origin link in every 400 bytes
+ARTICLE_ROW = ('<p class="text">Lorem ipsum dolor sit amet, <em>consectetur</em> adipiscing elit, sed do eiusmod tempor incididunt '
+	'ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud <a href="/wiki/Local_%d">exercitation</a> ullamco '
+	'laboris nisi ut aliquip ex ea commodo consequat <a href="https://example.com/wiki/Page_%d" title="Page">linked</a>. '
+	'Duis aute irure dolor in <b>reprehenderit</b> in voluptate velit esse.</p>\n')
+
+def large_page(size, row):
+	''' Roughly `size` MiB of markup made of `row` '''
+	rows = []
+	total = 0
+	i = 0
+	while total < size * 1024 * 1024:
+		rows.append(row % ((i,) * row.count('%d')))
+		total += len(rows[-1])
+		i += 1
+	return '<html><head><title>big</title><script>var a = 1 < 2;</script></head><body>%s</body></html>' % (''.join(rows),)
+
+def timed(func, page, repeat):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		func(page)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark the link rewriters')
+	parser.add_argument('--size', type=float, default=2, help='MiB in the generated page')
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args(argv)
+
+	rewriter = LinkRewriter('example.com', 'proxy.test', 8080)
+	failures = check_corpus(rewriter)
+
+	for (name, row) in (('listing', LISTING_ROW), ('article', ARTICLE_ROW)):
+		page = large_page(args.size, row)
+		dom = timed(rewriter.rewrite_dom, page, args.repeat)
+		stream = timed(lambda page: rewriter.rewrite_html(page).encode('utf-8'), page, args.repeat)
+		print('%.1f MiB %s: dom %.1f ms, single pass %.1f ms (%.1fx)' % (len(page) / 1048576.0, name, dom * 1000, stream * 1000, dom / stream))
+
+	return 1 if failures else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,84 @@
+''' Accept rate of a sharded (SO_REUSEPORT) lbr listener as the shard count grows
+
+	python benchmarks/lbr_accept.py --shards 1 --shards 2 --shards 4 --clients 4 --duration 5
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lbr_relay import echo_backend, free_port, wait_for_port
+from liveserve.lbr.config import WorkerClientMapping
+from liveserve.lbr.listener import createListener
+
+def load_generator(port, duration, results):
+	''' Connect, round trip one byte, close, as fast as possible '''
+	done = failed = 0
+	deadline = time.time() + duration
+	while time.time() < deadline:
+		try:
+			sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+			sock.sendall(b'x')
+			if sock.recv(1) == b'x':
+				done += 1
+			else:
+				failed += 1
+			sock.close()
+		except OSError:
+			failed += 1
+	results.put((done, failed))
+
+def bench(shards, args):
+	backendPort, localPort = free_port(), free_port()
+	backend = multiprocessing.Process(target=echo_backend, args=(backendPort,), daemon=True)
+	backend.start()
+	wait_for_port(backendPort)
+
+	mapping = WorkerClientMapping('127.0.0.1', localPort, [{'addr': '127.0.0.1', 'port': backendPort}])
+	listener = createListener(mapping, {'relay_mode': 'eventloop', 'listen_shards': shards, 'listen_backlog': args.backlog})
+	listener.start()
+	wait_for_port(localPort)
+
+	results = multiprocessing.Queue()
+	clients = [multiprocessing.Process(target=load_generator, args=(localPort, args.duration, results)) for _ in range(args.clients)]
+	try:
+		for client in clients:
+			client.start()
+		totals = [results.get() for _ in clients]
+		for client in clients:
+			client.join()
+	finally:
+		listener.terminate()
+		listener.join(10)
+		backend.terminate()
+
+	done = sum(total[0] for total in totals)
+	failed = sum(total[1] for total in totals)
+	print('%3d shards  %8.0f accepts/s  %5d failed' % (shards, done / float(args.duration), failed))
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark lbr listener sharding')
+	parser.add_argument('--shards', type=int, action='append', help='shard counts to run (default 1, 2, 4 ... cores)')
+	parser.add_argument('--clients', type=int, default=os.cpu_count() or 1, help='load generator processes')
+	parser.add_argument('--duration', type=float, default=5)
+	parser.add_argument('--backlog', type=int, default=1024)
+	args = parser.parse_args(argv)
+
+	shardCounts = args.shards
+	if not shardCounts:
+		shardCounts, count = [], 1
+		while count <= (os.cpu_count() or 1):
+			shardCounts.append(count)
+			count *= 2
+
+	print('%d cores, %d load generator processes' % (os.cpu_count() or 1, args.clients))
+	for shards in shardCounts:
+		bench(shards, args)
+
+if __name__ == '__main__':
+	main()
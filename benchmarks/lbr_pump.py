@@ -0,0 +1,94 @@
+''' Throughput of the lbr pumps relaying one TCP stream over loopback
+
+	python benchmarks/lbr_pump.py --total 512
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from liveserve.lbr.pump import HAS_SPLICE, pumpUntilEof
+
+def connected_pair(listenSocket):
+	client = socket.create_connection(listenSocket.getsockname())
+	(server, _) = listenSocket.accept()
+	return client, server
+
+def legacy_copy(src, dst, bufferSize):
+	''' What lbr Worker did before the pumps: grow a bytes object and re-slice it '''
+	pending = b''
+	while True:
+		nextData = src.recv(bufferSize)
+		if not nextData:
+			break
+		pending += nextData
+		while pending:
+			dst.send(pending[:bufferSize])
+			pending = pending[bufferSize:]
+
+def run(name, total, writeSize, bufferSize):
+	listenSocket = socket.socket()
+	listenSocket.bind(('127.0.0.1', 0))
+	listenSocket.listen(4)
+
+	(sender, relayIn) = connected_pair(listenSocket)
+	(relayOut, receiver) = connected_pair(listenSocket)
+	listenSocket.close()
+
+	if name == 'legacy':
+		relay = threading.Thread(target=legacy_copy, args=(relayIn, relayOut, bufferSize))
+	else:
+		relay = threading.Thread(target=pumpUntilEof, args=(relayIn, relayOut, bufferSize, name == 'splice'))
+
+	def send():
+		chunk = b'x' * writeSize
+		for _ in range(total // writeSize):
+			sender.sendall(chunk)
+		sender.shutdown(socket.SHUT_WR)
+
+	start = time.perf_counter()
+	relay.start()
+	sendThread = threading.Thread(target=send)
+	sendThread.start()
+
+	received = 0
+	buffer = bytearray(1024 * 1024)
+	while True:
+		count = receiver.recv_into(buffer)
+		if not count:
+			break
+		received += count
+		if received >= total:
+			break
+	elapsed = time.perf_counter() - start
+
+	sendThread.join()
+	relayOut.shutdown(socket.SHUT_WR)
+	relay.join()
+	for sock in (sender, relayIn, relayOut, receiver):
+		sock.close()
+
+	return received / elapsed / (1024 * 1024)
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark the lbr pumps')
+	parser.add_argument('--total', type=int, default=256, help='MiB relayed per run')
+	parser.add_argument('--buffer-size', type=int, default=65536)
+	args = parser.parse_args(argv)
+
+	total = args.total * 1024 * 1024
+	pumps = ['legacy', 'buffer'] + (['splice'] if HAS_SPLICE else [])
+	streams = [('1 KiB writes', 1024), ('64 KiB writes', 65536), ('bulk (4 MiB writes)', 4 * 1024 * 1024)]
+
+	print('%-22s' % ('',) + ''.join('%14s' % (name,) for name in pumps))
+	for (label, writeSize) in streams:
+		results = [run(name, total, writeSize, args.buffer_size) for name in pumps]
+		print('%-22s' % (label,) + ''.join('%9.0f MiB/s' % (result,) for result in results))
+
+if __name__ == '__main__':
+	main()
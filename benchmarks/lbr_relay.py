@@ -0,0 +1,156 @@
+''' Compare the lbr relay modes: connections/sec and RSS of the listener process tree
+
+	python benchmarks/lbr_relay.py --mode process --mode eventloop --connections 2000 --concurrency 100
+'''
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from liveserve.lbr.config import WorkerClientMapping
+from liveserve.lbr.listener import createListener
+
+def echo_backend(port):
+	async def handle(reader, writer):
+		while True:
+			data = await reader.read(65536)
+			if not data:
+				break
+			writer.write(data)
+			await writer.drain()
+		writer.close()
+
+	async def serve():
+		server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+		async with server:
+			await server.serve_forever()
+
+	asyncio.run(serve())
+
+def free_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+def wait_for_port(port, timeout=10):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port), timeout=1).close()
+			return
+		except OSError:
+			time.sleep(.05)
+	raise RuntimeError('nothing listening on %d' % (port,))
+
+def tree_rss(pid):
+	''' RSS in KiB of a process and all of its descendants '''
+	children = {}
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			with open('/proc/%s/stat' % (entry,)) as f:
+				ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+		except (OSError, IndexError, ValueError):
+			continue
+		children.setdefault(ppid, []).append(int(entry))
+
+	total, pending = 0, [pid]
+	while pending:
+		current = pending.pop()
+		pending.extend(children.get(current, []))
+		try:
+			with open('/proc/%d/status' % (current,)) as f:
+				for line in f:
+					if line.startswith('VmRSS:'):
+						total += int(line.split()[1])
+		except OSError:
+			pass
+	return total
+
+async def one_connection(port, payload):
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	writer.write(payload)
+	await writer.drain()
+	await reader.readexactly(len(payload))
+	writer.close()
+
+async def run_connections(port, total, concurrency, payload):
+	semaphore = asyncio.Semaphore(concurrency)
+	failures = 0
+
+	async def bounded():
+		nonlocal failures
+		async with semaphore:
+			try:
+				await asyncio.wait_for(one_connection(port, payload), 30)
+			except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+				failures += 1
+
+	start = time.perf_counter()
+	await asyncio.gather(*[bounded() for _ in range(total)])
+	return time.perf_counter() - start, failures
+
+async def hold_connections(port, count, payload, pid):
+	''' Open `count` relayed connections at once and measure the listener tree while they are all live '''
+	conns = []
+	for _ in range(count):
+		reader, writer = await asyncio.open_connection('127.0.0.1', port)
+		writer.write(payload)
+		conns.append((reader, writer))
+	for reader, writer in conns:
+		await reader.readexactly(len(payload))
+	# give forked workers a moment to settle
+	await asyncio.sleep(1)
+	rss = tree_rss(pid)
+	for reader, writer in conns:
+		writer.close()
+	return rss
+
+def bench(mode, args):
+	backendPort, localPort = free_port(), free_port()
+	backend = multiprocessing.Process(target=echo_backend, args=(backendPort,), daemon=True)
+	backend.start()
+	wait_for_port(backendPort)
+
+	mapping = WorkerClientMapping('127.0.0.1', localPort, [{'addr': '127.0.0.1', 'port': backendPort}])
+	listener = createListener(mapping, {'relay_mode': mode, 'relay_loops': args.loops, 'buffer_size': 65536})
+	listener.start()
+	wait_for_port(localPort)
+
+	payload = b'x' * args.payload
+	try:
+		idleRss = tree_rss(listener.pid)
+		elapsed, failures = asyncio.run(run_connections(localPort, args.connections, args.concurrency, payload))
+		time.sleep(1)
+		heldRss = asyncio.run(hold_connections(localPort, args.hold, payload, listener.pid))
+	finally:
+		listener.terminate()
+		listener.join(10)
+		backend.terminate()
+
+	print('%-10s %10.0f conn/s  %5d failed  idle RSS %8d KiB  RSS with %d live %10d KiB' % (mode, args.connections / elapsed, failures, idleRss, args.hold, heldRss))
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark the lbr relay modes')
+	parser.add_argument('--mode', action='append', choices=['process', 'eventloop'])
+	parser.add_argument('--connections', type=int, default=2000)
+	parser.add_argument('--concurrency', type=int, default=50)
+	parser.add_argument('--hold', type=int, default=200, help='connections held open while measuring RSS')
+	parser.add_argument('--payload', type=int, default=512)
+	parser.add_argument('--loops', type=int, default=1, help='event loops for eventloop mode')
+	args = parser.parse_args(argv)
+
+	for mode in args.mode or ['process', 'eventloop']:
+		bench(mode, args)
+
+if __name__ == '__main__':
+	main()
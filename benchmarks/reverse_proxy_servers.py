@@ -0,0 +1,195 @@
+''' Compare the reverse_proxy servers under many slow clients: completed requests, time, threads and RSS of the proxy
+
+	python benchmarks/reverse_proxy_servers.py --server threaded --server asyncio --clients 10000 --slow 2
+
+With --slow-readers and --slow-uploaders that many more clients read a large response, or send a request body, over
+--slow seconds meanwhile: the other clients should not wait on them.
+'''
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import threading
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lbr_relay import free_port, wait_for_port
+
+PROXY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'liveserve', 'reverse_proxy.py')
+
+# bytes of the response each slow reader reads, and of the body each slow uploader sends, a piece at a time
+SLOW_READ_SIZE = 8 * 1024 * 1024
+SLOW_UPLOAD_SIZE = 16 * 1024
+SLOW_PIECES = 16
+# receive buffer of a slow reader, so the proxy cannot hand it the whole response at once
+SLOW_READ_BUFFER = 64 * 1024
+
+def http_backend(port, size):
+	''' Keep-alive HTTP/1.1 upstream answering every request with `size` bytes, SLOW_READ_SIZE for /large '''
+	def response(size):
+		return b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s' % (size, b'x' * size)
+	small, large = response(size), response(SLOW_READ_SIZE)
+
+	async def handle(reader, writer):
+		try:
+			while True:
+				head = await reader.readuntil(b'\r\n\r\n')
+				for line in head.split(b'\r\n'):
+					if line.lower().startswith(b'content-length:'):
+						await reader.readexactly(int(line.split(b':', 1)[1]))
+				writer.write(large if head.startswith(b'GET /large ') else small)
+				await writer.drain()
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		writer.close()
+
+	async def serve():
+		server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+		async with server:
+			await server.serve_forever()
+
+	asyncio.run(serve())
+
+def proc_status(pid):
+	''' (threads, RSS in KiB) of a process '''
+	threads = rss = 0
+	try:
+		with open('/proc/%d/status' % (pid,)) as f:
+			for line in f:
+				if line.startswith('Threads:'):
+					threads = int(line.split()[1])
+				elif line.startswith('VmRSS:'):
+					rss = int(line.split()[1])
+	except OSError:
+		pass
+	return threads, rss
+
+async def slow_client(port, slow, timeout):
+	''' Trickle one request head over `slow` seconds, then read the whole response '''
+	reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+	try:
+		writer.write(b'GET /bench HTTP/1.1\r\n')
+		await writer.drain()
+		await asyncio.sleep(slow)
+		writer.write(b'Host: bench\r\nConnection: close\r\n\r\n')
+		await writer.drain()
+		response = await asyncio.wait_for(reader.read(), timeout)
+		return response.startswith(b'HTTP/1.1 200')
+	finally:
+		writer.close()
+
+async def slow_reader(port, slow, timeout):
+	''' Send a request for a large response at once, then read it over `slow` seconds '''
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_READ_BUFFER)
+	sock.setblocking(False)
+	try:
+		await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port)), timeout)
+	except BaseException:
+		sock.close()
+		raise
+	reader, writer = await asyncio.open_connection(sock=sock)
+	try:
+		writer.write(b'GET /large HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n')
+		await writer.drain()
+		received = b''
+		for _ in range(SLOW_PIECES):
+			await asyncio.sleep(slow / SLOW_PIECES)
+			received += await asyncio.wait_for(reader.read(SLOW_READ_SIZE // SLOW_PIECES), timeout)
+		received += await asyncio.wait_for(reader.read(), timeout)
+		return received.startswith(b'HTTP/1.1 200') and len(received) > SLOW_READ_SIZE
+	finally:
+		writer.close()
+
+async def slow_uploader(port, slow, timeout):
+	''' Send a request body over `slow` seconds, then read the whole response '''
+	reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+	try:
+		writer.write(b'POST /bench HTTP/1.1\r\nHost: bench\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (SLOW_UPLOAD_SIZE,))
+		for _ in range(SLOW_PIECES):
+			await asyncio.sleep(slow / SLOW_PIECES)
+			writer.write(b'x' * (SLOW_UPLOAD_SIZE // SLOW_PIECES))
+			await writer.drain()
+		response = await asyncio.wait_for(reader.read(), timeout)
+		return response.startswith(b'HTTP/1.1 200')
+	finally:
+		writer.close()
+
+async def run_clients(port, clients, slow, timeout):
+	''' (seconds, completed) of each kind of client in `clients`, a dict of the client coroutine function to how many of it run at once '''
+	async def one(client):
+		try:
+			return await client(port, slow, timeout)
+		except (OSError, asyncio.TimeoutError):
+			return False
+
+	async def kind(client, count):
+		start = time.perf_counter()
+		results = await asyncio.gather(*[one(client) for _ in range(count)])
+		return time.perf_counter() - start, sum(results)
+
+	return await asyncio.gather(*[kind(client, count) for (client, count) in clients.items()])
+
+def bench(server, args):
+	backendPort, proxyPort = free_port(), free_port()
+	backend = multiprocessing.Process(target=http_backend, args=(backendPort, args.size), daemon=True)
+	backend.start()
+	wait_for_port(backendPort)
+
+	proxy = subprocess.Popen([sys.executable, PROXY, '--server', server, '--port', str(proxyPort), '--hostname', '127.0.0.1:%d' % (backendPort,), '--upstream-scheme', 'http'],
+		stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	wait_for_port(proxyPort)
+
+	peak = [0, 0]
+	sampling = True
+
+	def sample():
+		while sampling:
+			(threads, rss) = proc_status(proxy.pid)
+			peak[0], peak[1] = max(peak[0], threads), max(peak[1], rss)
+			time.sleep(.1)
+
+	sampler = threading.Thread(target=sample)
+	sampler.start()
+	try:
+		(idleThreads, idleRss) = proc_status(proxy.pid)
+		clients = {slow_client: args.clients, slow_reader: args.slow_readers, slow_uploader: args.slow_uploaders}
+		clients = dict((client, count) for (client, count) in clients.items() if count)
+		results = asyncio.run(run_clients(proxyPort, clients, args.slow, args.timeout))
+	finally:
+		sampling = False
+		sampler.join()
+		proxy.terminate()
+		proxy.wait(30)
+		backend.terminate()
+
+	for ((client, count), (elapsed, completed)) in zip(clients.items(), results):
+		print('%-9s %-13s %6d/%d completed in %6.1fs' % (server, client.__name__, completed, count, elapsed))
+	print('%-9s peak threads %6d  RSS idle %7d KiB  peak %8d KiB' % (server, peak[0], idleRss, peak[1]))
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark the reverse_proxy servers with slow clients')
+	parser.add_argument('--server', action='append', choices=['threaded', 'asyncio'])
+	parser.add_argument('--clients', type=int, default=10000, help='clients connected at once')
+	parser.add_argument('--slow', type=float, default=2, help='seconds each client takes to send its request head')
+	parser.add_argument('--slow-readers', dest='slow_readers', type=int, default=0, help='clients meanwhile reading a large response over --slow seconds')
+	parser.add_argument('--slow-uploaders', dest='slow_uploaders', type=int, default=0, help='clients meanwhile sending a request body over --slow seconds')
+	parser.add_argument('--size', type=int, default=4096, help='bytes in each response body')
+	parser.add_argument('--timeout', type=float, default=120)
+	args = parser.parse_args(argv)
+
+	# one descriptor per client in this process
+	(soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+	for server in args.server or ['threaded', 'asyncio']:
+		bench(server, args)
+
+if __name__ == '__main__':
+	main()
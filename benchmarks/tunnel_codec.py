@@ -0,0 +1,84 @@
+''' Encode/decode throughput of the HTTP tunnel codecs on a mix of the messages a tunnel carries
+
+	python benchmarks/tunnel_codec.py --seconds 2
+'''
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli'))
+
+from codec import CODECS
+
+BROWSER_HEADERS = {
+	'Host': 'demo.liveserve.xcloud.io',
+	'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0 Safari/537.36',
+	'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+	'Accept-Language': 'en-US,en;q=0.9',
+	'Accept-Encoding': 'gzip, deflate, br',
+	'Cookie': 'session=%s; theme=dark; _ga=GA1.2.1234567890.1697000000' % ('a' * 64,),
+	'Referer': 'https://demo.liveserve.xcloud.io/',
+	'X-Forwarded-For': '203.0.113.7',
+	'X-Forwarded-Proto': 'https',
+	'Connection': 'keep-alive',
+}
+RESPONSE_HEADERS = {
+	'Content-Type': 'text/html; charset=utf-8',
+	'Cache-Control': 'no-cache',
+	'Date': 'Sun, 18 Oct 2026 12:00:00 GMT',
+	'Server': 'uvicorn',
+	'Set-Cookie': 'session=%s; Path=/; HttpOnly' % ('b' * 64,),
+}
+
+def message_mix():
+	''' (share, name, message) of the messages of a tunnel serving a web app '''
+	body = lambda size: os.urandom(size)
+	return [
+		(40, 'GET request', {'id': 'r1', 'method': 'GET', 'uri': '/static/app.js?v=3', 'url': '/static/app.js?v=3', 'header': BROWSER_HEADERS, 'body': b''}),
+		(10, 'POST 2 KB json', {'id': 'r2', 'method': 'POST', 'uri': '/api/items', 'url': '/api/items', 'header': dict(BROWSER_HEADERS, **{'Content-Type': 'application/json'}), 'body': body(2048)}),
+		(25, '30 KB page', {'request_id': 'r1', 'token': 't' * 32, 'status': 200, 'header': RESPONSE_HEADERS, 'body': body(30 * 1024)}),
+		(15, '1 KB json', {'request_id': 'r2', 'token': 't' * 32, 'status': 201, 'header': dict(RESPONSE_HEADERS, **{'Content-Type': 'application/json'}), 'body': body(1024)}),
+		(8, '256 KB data frame', {'type': 'data', 'request_id': 'r3', 'token': 't' * 32, 'seq': 4, 'body': body(256 * 1024)}),
+		(2, 'start frame', {'type': 'start', 'request_id': 'r3', 'token': 't' * 32, 'seq': 0, 'status': 200, 'header': RESPONSE_HEADERS}),
+	]
+
+def timed_rate(function, messages, seconds):
+	(count, size, start) = (0, 0, time.perf_counter())
+	while time.perf_counter() - start < seconds:
+		for message in messages:
+			size += len(function(message))
+		count += len(messages)
+	elapsed = time.perf_counter() - start
+	return count / elapsed, size / elapsed / 1e6
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark the tunnel codecs')
+	parser.add_argument('--seconds', type=float, default=2)
+	parser.add_argument('--codec', action='append', choices=sorted(CODECS))
+	args = parser.parse_args(argv)
+
+	mix = message_mix()
+	messages = []
+	for (share, _, message) in mix:
+		messages += [message] * share
+	random.shuffle(messages)
+
+	for name in args.codec or sorted(CODECS):
+		codec = CODECS[name]
+		for (_, label, message) in mix:
+			decoded = codec.decode(codec.encode(message))
+			assert bytes(decoded.get('body') or b'') == bytes(message.get('body') or b''), (name, label)
+			assert decoded.get('header', {}) == message.get('header', {}), (name, label)
+
+		encoded = [codec.encode(message) for message in messages]
+		(encode_rate, encode_mb) = timed_rate(codec.encode, messages, args.seconds)
+		(decode_rate, _) = timed_rate(lambda data: codec.decode(data).get('body') or b'', encoded, args.seconds)
+		decode_mb = encode_mb * decode_rate / encode_rate
+		overhead = sum(len(data) - len(message.get('body') or b'') for (data, message) in zip(encoded, messages)) / len(messages)
+		print('%-7s encode %9.0f msg/s %7.0f MB/s   decode %9.0f msg/s %7.0f MB/s   %4.0f bytes/msg besides the body' % (name, encode_rate, encode_mb, decode_rate, decode_mb, overhead))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,150 @@
+''' Connections/sec through the CLI TCP tunnel, per connection (2 sockets and 2 threads each) against multiplexed
+
+	python benchmarks/tunnel_mux.py --mode legacy --mode mux --connections 2000 --concurrency 50
+
+The tunnel server is the stand-in of cli/standin.py, the local server an echo server, each in its own process.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli'))
+
+import mux
+from standin import StandInServer
+
+def echo_backend(port):
+	async def handle(reader, writer):
+		try:
+			while True:
+				data = await reader.read(65536)
+				if not data:
+					break
+				writer.write(data)
+				await writer.drain()
+		except ConnectionError:
+			pass
+		writer.close()
+
+	async def serve():
+		server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+		async with server:
+			await server.serve_forever()
+
+	asyncio.run(serve())
+
+def stand_in(ports):
+	async def serve():
+		server = await StandInServer().start()
+		ports.put(server.ports)
+		await asyncio.Event().wait()
+
+	asyncio.run(serve())
+
+def legacy_pump(read_conn, write_conn):
+	buffer = bytearray(mux.PUMP_BUFFER_SIZE)
+	view = memoryview(buffer)
+	try:
+		count = read_conn.recv_into(buffer)
+		while count:
+			write_conn.sendall(view[:count])
+			count = read_conn.recv_into(buffer)
+	except OSError:
+		pass
+	read_conn.close()
+
+def legacy_client(ports, backend_port):
+	''' What TCPClient.process does for every connection the control channel announces '''
+	control = socket.create_connection(('127.0.0.1', ports['control']))
+	for line in control.makefile('rb'):
+		message = json.loads(line)
+		if 'public_client_port' not in message:
+			continue
+		remote = socket.create_connection(('127.0.0.1', ports['private']))
+		local = socket.create_connection(('127.0.0.1', backend_port))
+		port = message['public_client_port']
+		remote.send(bytearray([port >> 8 & 0xFF, port & 0xFF]))
+		threading.Thread(target=legacy_pump, args=(remote, local)).start()
+		threading.Thread(target=legacy_pump, args=(local, remote)).start()
+
+def mux_client(ports, backend_port):
+	async def run():
+		connection = await mux.connect('127.0.0.1', ports['mux'], on_open=mux.forward_streams('127.0.0.1', backend_port))
+		await connection.run()
+
+	asyncio.run(run())
+
+def free_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+async def one_connection(port, payload):
+	(reader, writer) = await asyncio.open_connection('127.0.0.1', port)
+	writer.write(payload)
+	await writer.drain()
+	await reader.readexactly(len(payload))
+	writer.close()
+
+async def run_connections(port, total, concurrency, payload):
+	semaphore = asyncio.Semaphore(concurrency)
+	failures = 0
+
+	async def bounded():
+		nonlocal failures
+		async with semaphore:
+			try:
+				await asyncio.wait_for(one_connection(port, payload), 30)
+			except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+				failures += 1
+
+	start = time.perf_counter()
+	await asyncio.gather(*[bounded() for _ in range(total)])
+	return time.perf_counter() - start, failures
+
+def bench(mode, args):
+	backend_port = free_port()
+	backend = multiprocessing.Process(target=echo_backend, args=(backend_port,), daemon=True)
+	backend.start()
+
+	queue = multiprocessing.Queue()
+	server = multiprocessing.Process(target=stand_in, args=(queue,), daemon=True)
+	server.start()
+	ports = queue.get(timeout=10)
+
+	client = multiprocessing.Process(target=legacy_client if mode == 'legacy' else mux_client, args=(ports, backend_port), daemon=True)
+	client.start()
+	# let the client connect its control or multiplexed connection
+	time.sleep(1)
+
+	payload = b'x' * args.payload
+	try:
+		(elapsed, failures) = asyncio.run(run_connections(ports['public'], args.connections, args.concurrency, payload))
+	finally:
+		for process in (client, server, backend):
+			process.terminate()
+
+	print('%-8s %10.0f conn/s  %5d failed' % (mode, args.connections / elapsed, failures))
+
+def main(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Benchmark the CLI TCP tunnel modes')
+	parser.add_argument('--mode', action='append', choices=['legacy', 'mux'])
+	parser.add_argument('--connections', type=int, default=2000)
+	parser.add_argument('--concurrency', type=int, default=50)
+	parser.add_argument('--payload', type=int, default=512)
+	args = parser.parse_args(argv)
+
+	for mode in args.mode or ['legacy', 'mux']:
+		bench(mode, args)
+
+if __name__ == '__main__':
+	main()
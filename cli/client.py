@@ -1,5 +1,9 @@
+import os
 import sys
+import json
+import time
 from urllib.parse import urljoin
+from collections import deque
 import aiohttp
 import bson
 import threading
@@ -12,42 +16,309 @@ from rich import print as pretty_print
 from getpass import getuser
 import click
 
+import mux
+from codec import get_codec, BSONCodec
+from compression import COMPRESSION_MODES, CompressionStats, CountingDeflateFactory, BodyCompressor, zstandard
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# bytes moved per read by the TCP tunnel pumps
+PUMP_BUFFER_SIZE = 1024 * 256
+
+# requests to the local server in flight at once, and received ones waiting for a slot before the websocket is no longer read
+MAX_INFLIGHT = 32
+MAX_QUEUED = 256
+# seconds between two status lines, and the latencies the percentiles are taken over
+STATUS_INTERVAL = 5
+LATENCY_SAMPLES = 1000
+# streamed bodies: bytes per data frame, and the data frames of a request body buffered before the websocket is no longer read
+BODY_CHUNK_SIZE = 256 * 1024
+REQUEST_BODY_CHUNKS = 8
+# seconds a streamed request whose body frames filled up ahead of it waits for a slot before it is failed
+REQUEST_SLOT_TIMEOUT = 5
+# seconds before the multiplexed connection is made again after it dropped, doubled after each failed attempt up to the max
+MUX_RECONNECT_DELAY = 1
+MUX_RECONNECT_MAX_DELAY = 60
+
+def percentile(values, fraction):
+	return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+class RequestBody:
+	# the data frames of a streamed request body, in order, until its end frame
+	def __init__(self, message, received_at):
+		self.message = message
+		self.received_at = received_at
+		self.chunks = asyncio.Queue(REQUEST_BODY_CHUNKS)
+		self.next_seq = 1
+		self.started = False
+		self.failed = False
+
+	async def put(self, frame):
+		if frame.get('seq') != self.next_seq:
+			raise ValueError(f"request {frame['id']} frame {frame.get('seq')} out of order, expected {self.next_seq}")
+		self.next_seq += 1
+		await self.chunks.put(frame['body'] if frame['type'] == 'data' else None)
+
+	def fail(self):
+		self.failed = True
+		if not self.chunks.full():
+			self.chunks.put_nowait(None)
+
+	def discard(self):
+		# the request is over (the local server may answer before reading the whole body), a frame still being put
+		# must not wait for room forever
+		self.failed = True
+		while not self.chunks.empty():
+			self.chunks.get_nowait()
+
+	async def read(self):
+		while True:
+			chunk = await self.chunks.get()
+			if self.failed:
+				raise ConnectionResetError(f"request {self.message['id']} body broken off")
+			if chunk is None:
+				return
+			yield chunk
+
 class HTTPClient:
-	def __init__(self, base_uri, token):
+	def __init__(self, base_uri, token, max_inflight=MAX_INFLIGHT, max_queued=MAX_QUEUED, codec=BSONCodec, compression=None, compressor=None):
 		self.base_uri = base_uri
 		self.token = token
+		self.codec = codec
+		# the stats of the tunnel compression, and the body compressor when bodies are compressed with zstd
+		self.compression = compression
+		self.compressor = compressor
+		self.max_inflight = max_inflight
+		self.slots = asyncio.Semaphore(max_inflight)
+		self.queue = asyncio.Queue(max_queued)
+		self.session = None
+		self.websocket = None
+		self.workers = []
+		self.bodies = {}
+		self.overflow = set()
+		self.inflight = 0
+		self.served = 0
+		self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+	async def start(self, websocket):
+		# one pooled session to the local server. The bodies and their headers are passed on as they are, undecoded
+		self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), auto_decompress=False)
+		self.websocket = websocket
+		self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.max_inflight)]
+
+	async def close(self):
+		for worker in self.workers + list(self.overflow):
+			worker.cancel()
+		if self.session is not None:
+			await self.session.close()
+
+	async def send(self, message, header=None):
+		# the data frames of a streamed response are compressed or not by the headers of their start frame
+		if self.compressor is not None:
+			self.compressor.compress(message, header if header is not None else message.get('header'))
+		await self.websocket.send(self.codec.encode(message))
+
+	async def submit(self, message):
+		# a request (or the start frame of a streamed one) is queued, the data and end frames of a streamed one go to
+		# its body. Either waits while full, the websocket is not read meanwhile and the server holds the requests back
+		if self.compressor is not None:
+			self.compressor.decompress(message)
+		if message.get('type', 'start') == 'start':
+			body = None
+			if message.get('stream'):
+				body = self.bodies[message['id']] = RequestBody(message, time.monotonic())
+			await self.queue.put((message, body, time.monotonic()))
+			return
 
-	async def process(self, message, websocket):
-		async with aiohttp.ClientSession() as session:
+		body = self.bodies.get(message['id'])
+		if body is None:
+			# the request already failed
+			return
+		if body.chunks.full() and not body.started and not await self.start_overflow(body):
+			# no waiting on the queue here, the requests in flight could be waiting on frames behind this one. The request
+			# waited a while for a slot of its own and none freed up
+			pretty_print(f"[bold red]FAIL: [white]No slot for request {message['id']} in {REQUEST_SLOT_TIMEOUT}s", file=sys.stderr)
+			self.bodies.pop(message['id'], None)
+			body.fail()
+			return
+		try:
+			await body.put(message)
+		except ValueError as e:
+			pretty_print(f"[bold red]FAIL: [white]{e}", file=sys.stderr)
+			self.bodies.pop(message['id'], None)
+			body.fail()
+
+	async def start_overflow(self, body):
+		try:
+			await asyncio.wait_for(self.slots.acquire(), REQUEST_SLOT_TIMEOUT)
+		except asyncio.TimeoutError:
+			return False
+		if body.started:
+			# a worker got to it meanwhile
+			self.slots.release()
+			return True
+		body.started = True
+		task = asyncio.ensure_future(self.overflow_handle(body))
+		self.overflow.add(task)
+		task.add_done_callback(self.overflow.discard)
+		return True
+
+	async def overflow_handle(self, body):
+		try:
+			await self.handle_safely(body.message, body, body.received_at)
+		finally:
+			self.slots.release()
+
+	async def work(self):
+		while True:
+			(message, body, received_at) = await self.queue.get()
 			try:
-				response = await session.request(
-					method=message['method'],
-					url=urljoin(self.base_uri, message['uri']),
-					headers=message['header'],
-					data=message['body'],
-				)
-			except:
-				pretty_print(f"[bold red]FAIL: [white]Error Processing Request At: {message['url']}", file=sys.stderr)
-				return {
-                    'request_id': message['id'],
-                    'token': self.token,
-                    'status': 500,
-                    'header': {},
-                    'body': b'Error Performing Request',
-                }
-
-            pretty_print(f'[bold green]{"INFO:":<10} [white] {self.base_uri} - "[bold bright_red]{message["method"]} [white]{message["url"]}"[bold cyan] {response.status}')
-
-            body = await response.read()
-            response_message = {
-            	'request_id': message['id'],
-            	'token': self.token,
-            	'status': response.status,
-            	'header': dict(response.headers),
-            	'body': body,
-            }
-
-            await websocket.send(bson.dumps(response_message))
+				async with self.slots:
+					# unless its body filled up and it was started already
+					if body is None or not body.started:
+						await self.handle_safely(message, body, received_at)
+			except websockets.ConnectionClosed:
+				return
+			finally:
+				self.queue.task_done()
+
+	async def handle_safely(self, message, body, received_at):
+		# whatever goes wrong with one request, the worker goes on to the next one
+		try:
+			await self.handle(message, body, received_at)
+		except websockets.ConnectionClosed:
+			raise
+		except Exception as e:
+			pretty_print(f"[bold red]FAIL: [white]Error Processing Request At: {message.get('url')}: {type(e).__name__}: {e}", file=sys.stderr)
+			await self.send_error(message, e)
+
+	async def send_error(self, message, error):
+		# a streamed response may have started already, an end frame with an error aborts it either way
+		if message.get('stream'):
+			reply = {'type': 'end', 'request_id': message['id'], 'token': self.token, 'seq': 0, 'error': f"{type(error).__name__}: {error}"}
+		else:
+			reply = {'request_id': message['id'], 'token': self.token, 'status': 500, 'header': {}, 'body': b'Error Performing Request'}
+		try:
+			await self.websocket.send(self.codec.encode(reply))
+		except websockets.ConnectionClosed:
+			raise
+		except Exception as e:
+			pretty_print(f"[bold red]FAIL: [white]Could not report the failure of request {message['id']}: {e}", file=sys.stderr)
+
+	async def handle(self, message, body, received_at):
+		if body is not None:
+			body.started = True
+			if body.failed:
+				raise ConnectionResetError(f"request {message['id']} body broken off")
+
+		self.inflight += 1
+		try:
+			if message.get('stream'):
+				await self.process_streamed(message, body)
+			else:
+				await self.send(await self.process(message))
+		finally:
+			if body is not None:
+				body.discard()
+				if self.bodies.get(message['id']) is body:
+					del self.bodies[message['id']]
+			self.inflight -= 1
+			self.served += 1
+			self.latencies.append(time.monotonic() - received_at)
+
+	async def process(self, message):
+		try:
+			async with self.session.request(
+				method=message['method'],
+				url=urljoin(self.base_uri, message['uri']),
+				headers=message['header'],
+				data=message['body'],
+			) as response:
+				body = await response.read()
+		except Exception:
+			pretty_print(f"[bold red]FAIL: [white]Error Processing Request At: {message['url']}", file=sys.stderr)
+			return {
+				'request_id': message['id'],
+				'token': self.token,
+				'status': 500,
+				'header': {},
+				'body': b'Error Performing Request',
+			}
+
+		self.log(message, response.status)
+
+		return {
+			'request_id': message['id'],
+			'token': self.token,
+			'status': response.status,
+			'header': dict(response.headers),
+			'body': body,
+		}
+
+	async def process_streamed(self, message, body):
+		# the response goes back as a start frame with the status and headers, data frames as the local server sends the
+		# body and an end frame, all numbered. An end frame with an error aborts a response already started
+		frame = {'type': 'start', 'request_id': message['id'], 'token': self.token, 'seq': 0}
+		started = False
+		try:
+			async with self.session.request(
+				method=message['method'],
+				url=urljoin(self.base_uri, message['uri']),
+				headers=message['header'],
+				data=body.read() if body is not None else None,
+			) as response:
+				self.log(message, response.status)
+				await self.send(dict(frame, status=response.status, header=dict(response.headers)))
+				started = True
+
+				async for chunk in response.content.iter_chunked(BODY_CHUNK_SIZE):
+					frame['seq'] += 1
+					await self.send(dict(frame, type='data', body=chunk), response.headers)
+		except websockets.ConnectionClosed:
+			raise
+		except Exception as e:
+			pretty_print(f"[bold red]FAIL: [white]Error Processing Request At: {message['url']}", file=sys.stderr)
+			end = dict(frame, type='end')
+			if started:
+				# the response is broken off, the peer aborts it
+				end['error'] = str(e) or type(e).__name__
+			else:
+				# the error response stands in for the response in full
+				await self.send(dict(frame, status=500, header={}))
+				frame['seq'] += 1
+				await self.send(dict(frame, type='data', body=b'Error Performing Request'))
+			end['seq'] = frame['seq'] + 1
+			await self.send(end)
+			return
+
+		frame['seq'] += 1
+		await self.send(dict(frame, type='end'))
+
+	def log(self, message, status):
+		pretty_print(f'[bold green]{"INFO:":<10} [white] {self.base_uri} - "[bold bright_red]{message["method"]} [white]{message["url"]}"[bold cyan] {status}')
+
+	def status(self):
+		latencies = sorted(self.latencies)
+		status = (
+			f"{'Queued:':<10}{self.queue.qsize()}/{self.queue.maxsize}  {'In Flight:':<11}{self.inflight}/{self.max_inflight}  "
+			f"{'Served:':<8}{self.served}  Latency p50 {percentile(latencies, .5) * 1000:.0f}ms "
+			f"p90 {percentile(latencies, .9) * 1000:.0f}ms p99 {percentile(latencies, .99) * 1000:.0f}ms"
+		)
+		if self.compression is not None:
+			status += f"  Compressed {self.compression}"
+		return status
+
+	async def report_status(self):
+		last = None
+		while True:
+			await asyncio.sleep(STATUS_INTERVAL)
+			current = (self.served, self.queue.qsize(), self.inflight)
+			if current != last:
+				pretty_print(f"[bold cyan]{'STATUS:':<10} [white]{self.status()}")
+				last = current
 
 class TCPClient:
 	def __init__(self, remote_server_host, remote_server_port, local_server_host, local_server_port):
@@ -58,19 +329,47 @@ class TCPClient:
 
 	@staticmethod
 	def pump_read_to_write(read_conn, write_conn):
-		size = 1024 * 256
-		buffer = read_conn.recv(size)
-
-		while buffer:
-			try:
-				write_conn.send(buffer)
-				buffer = read_conn.recv(size)
-			except (ConnectionResetError, BrokenPipeError):
-				break
+		try:
+			if hasattr(os, 'splice'):
+				TCPClient.splice_read_to_write(read_conn, write_conn)
+			else:
+				TCPClient.copy_read_to_write(read_conn, write_conn)
+		except (ConnectionResetError, BrokenPipeError):
+			pass
 
 		read_conn.close()
 		pretty_print("[bold red]Connection Closed!")
 
+	@staticmethod
+	def splice_read_to_write(read_conn, write_conn):
+		# move the bytes through a kernel pipe, they never get copied into python
+		pipe_read, pipe_write = os.pipe()
+		try:
+			try:
+				fcntl.fcntl(pipe_write, fcntl.F_SETPIPE_SZ, PUMP_BUFFER_SIZE)
+			except (AttributeError, OSError):
+				pass
+
+			while True:
+				pending = os.splice(read_conn.fileno(), pipe_write, PUMP_BUFFER_SIZE, flags=os.SPLICE_F_MOVE)
+				if not pending:
+					break
+				while pending:
+					pending -= os.splice(pipe_read, write_conn.fileno(), pending, flags=os.SPLICE_F_MOVE)
+		finally:
+			os.close(pipe_read)
+			os.close(pipe_write)
+
+	@staticmethod
+	def copy_read_to_write(read_conn, write_conn):
+		buffer = bytearray(PUMP_BUFFER_SIZE)
+		view = memoryview(buffer)
+
+		count = read_conn.recv_into(buffer)
+		while count:
+			write_conn.sendall(view[:count])
+			count = read_conn.recv_into(buffer)
+
 	def process(self, message, websocket):
 		remote_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		remote_client.connect((self.remote_server_host, self.remote_server_port))
@@ -82,15 +381,39 @@ class TCPClient:
 		remote_client.send(bytearray([port >> 8 & 0xFF, port & 0xFF]))
 
 		# 2-way shit
-		therading.Therad(target=pump_read_to_write, args=(remote_client, local_client)).start()
-		therading.Therad(target=pump_read_to_write, args=(local_client, remote_client)).start()
+		threading.Thread(target=self.pump_read_to_write, args=(remote_client, local_client)).start()
+		threading.Thread(target=self.pump_read_to_write, args=(local_client, remote_client)).start()
+
+	async def process_multiplexed(self, mux_port, ssl_context):
+		# one persistent connection, every public connection is a stream of it. Made again when it drops, the server
+		# announces the public connections on the websocket meanwhile
+		def on_stream(stream):
+			pretty_print("[bold green]INFO: [bold white] New Connection +1")
+
+		delay = MUX_RECONNECT_DELAY
+		while True:
+			try:
+				connection = await mux.connect(
+					self.remote_server_host, mux_port, ssl=ssl_context,
+					on_open=mux.forward_streams(self.local_server_host, self.local_server_port, on_stream),
+				)
+				delay = MUX_RECONNECT_DELAY
+				await connection.run()
+				pretty_print(f"[bold yellow]WARNING: multiplexed connection closed, connecting again in {delay}s", file=sys.stderr)
+			except (OSError, mux.MuxError) as e:
+				pretty_print(f"[bold yellow]WARNING: multiplexed connection failed ({e}), connecting again in {delay}s", file=sys.stderr)
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, MUX_RECONNECT_MAX_DELAY)
 
 
 http_ssl_ctx = ssl.create_default_context()
 http_ssl_ctx.load_verify_locations(certifi.where())
 
-async def open_http_tunnel(ws_uri: str, http_uri):
-	async with websockets.connect(ws_uri, ssl=http_ssl_ctx) as websocket:
+async def open_http_tunnel(ws_uri: str, http_uri, max_inflight=MAX_INFLIGHT, max_queued=MAX_QUEUED, compress='off'):
+	# the hello is BSON whatever the codec, it says which one the server picked from the one offered in ws_uri
+	compression = CompressionStats(compress) if compress != 'off' else None
+	extensions = [CountingDeflateFactory(compression)] if compress == 'deflate' else None
+	async with websockets.connect(ws_uri, ssl=http_ssl_ctx, compression=None, extensions=extensions) as websocket:
 		message = bson.loads(await websocket.recv())
 
 		if message.get("warning"):
@@ -103,55 +426,90 @@ async def open_http_tunnel(ws_uri: str, http_uri):
 		host, token = message["host"], message["toke"]
 
 		pretty_print(f"{'Tunnel Status:':<25}[bold green]Online")
-        pretty_print(
-            f"{'Forwarded:':<25}{f'[bold cyan]{host} → {http_uri}'}")
-        pretty_print(f"\n[bold bright_magenta]:tada: Visit: https://{host}\n")
-
-        client = HTTPClient(http_uri, token)
-        while True:
-        	message = bson.loads(await websocket.recv())
-        	asyncio.ensure_future(client.process(message, websocket))
+		pretty_print(
+			f"{'Forwarded:':<25}{f'[bold cyan]{host} → {http_uri}'}")
+		pretty_print(f"\n[bold bright_magenta]:tada: Visit: https://{host}\n")
+
+		compressor = None
+		if compress == 'zstd':
+			if message.get("compress") == "zstd" and zstandard is not None:
+				compressor = BodyCompressor(compression)
+			else:
+				pretty_print(f"[bold yellow]WARNING: {'zstandard is not installed' if zstandard is None else 'the server does not take zstd bodies'}, bodies are sent uncompressed", file=sys.stderr)
+		if compress == 'deflate' and not compression.negotiated:
+			pretty_print("[bold yellow]WARNING: the server did not take permessage-deflate, the tunnel is uncompressed", file=sys.stderr)
+
+		codec = get_codec(message.get("codec"))
+		client = HTTPClient(http_uri, token, max_inflight, max_queued, codec, compression, compressor)
+		await client.start(websocket)
+		status = asyncio.ensure_future(client.report_status())
+		try:
+			while True:
+				await client.submit(codec.decode(await websocket.recv()))
+		finally:
+			status.cancel()
+			await client.close()
 
 
 tcp_ssl_context = ssl.create_default_context()
 tcp_ssl_context.load_verify_locations(certifi.where())
 
-async def open_tcp_tunnel(ws_uri, remote_server_host, local_server_port):
-    async with websockets.connect(ws_uri, ssl=tcp_ssl_context) as websocket:
-        message = json.loads(await websocket.recv())
-
-        if message.get("warning"):
-            pretty_print(
-                f"[bold yellow]WARNING: {message['warning']}", file=sys.stderr)
-
-        if message.get("error"):
-            pretty_print(
-                f"[bold yellow]ERROR: {message['error']}", file=sys.stderr)
-            return
+async def open_tcp_tunnel(ws_uri, remote_server_host, local_server_port, multiplex=True):
+	async with websockets.connect(ws_uri, ssl=tcp_ssl_context) as websocket:
+		message = json.loads(await websocket.recv())
 
-        local_server_host = '127.0.0.1'
-        public_server_port = message["public_server_port"]
-        private_server_port = message["private_server_port"]
-
-        pretty_print(f"{'Tunnel Status:':<25}[bold green]Online")
-        pretty_print(
-            f"{'Forwarded:':<25}{f'[bold cyan]{remote_server_host}:{public_server_port} → 127.0.0.1:{local_server_port}'}")
+		if message.get("warning"):
+			pretty_print(
+				f"[bold yellow]WARNING: {message['warning']}", file=sys.stderr)
 
-        client = TCPClient(
-            remote_server_host=remote_server_host,
-            remote_server_port=private_server_port,
-            local_server_host=local_server_host,
-            local_server_port=local_server_port,
-        )
+		if message.get("error"):
+			pretty_print(
+				f"[bold yellow]ERROR: {message['error']}", file=sys.stderr)
+			return
 
-        while True:
-            message = json.loads(await websocket.recv())
-            pretty_print("[bold green]INFO: [bold white] New Connection +1")
+		local_server_host = '127.0.0.1'
+		public_server_port = message["public_server_port"]
+		private_server_port = message["private_server_port"]
+		multiplex_port = message.get("multiplex_port") if multiplex else None
 
-            threading.Thread(
-                target=client.process,
-                args=(message, websocket)
-            ).start()
+		pretty_print(f"{'Tunnel Status:':<25}[bold green]Online")
+		pretty_print(
+			f"{'Forwarded:':<25}{f'[bold cyan]{remote_server_host}:{public_server_port} → 127.0.0.1:{local_server_port}'}")
+
+		client = TCPClient(
+			remote_server_host=remote_server_host,
+			remote_server_port=private_server_port,
+			local_server_host=local_server_host,
+			local_server_port=local_server_port,
+		)
+
+		async def accept():
+			while True:
+				message = json.loads(await websocket.recv())
+				pretty_print("[bold green]INFO: [bold white] New Connection +1")
+
+				threading.Thread(
+					target=client.process,
+					args=(message, websocket)
+				).start()
+
+		if not multiplex_port:
+			return await accept()
+
+		# servers offering it open public connections as streams, the websocket only announces the ones they
+		# could not (the multiplexed connection is down)
+		pretty_print(f"{'Multiplexed:':<25}[bold cyan]{remote_server_host}:{multiplex_port}")
+		ssl_context = tcp_ssl_context if message.get("multiplex_tls", True) else None
+		tasks = [asyncio.ensure_future(accept()), asyncio.ensure_future(client.process_multiplexed(multiplex_port, ssl_context))]
+		try:
+			# neither ends unless it fails, its error ends the tunnel
+			(done, _) = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				task.result()
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
 
 @click.group()
 def main():
@@ -175,46 +533,55 @@ banner = f"""[bold green]
 @click.argument('port')
 @click.option('-s', '--subdomain', default='')
 @click.option('--host', default='liveserve.xcloud.io')
+@click.option('--max-inflight', default=MAX_INFLIGHT, type=click.INT, help='requests to the local server at once')
+@click.option('--max-queued', default=MAX_QUEUED, type=click.INT, help='requests waiting for one of those before the tunnel is paused')
+@click.option('--codec', default='binary', type=click.Choice(['binary', 'bson']), help='wire encoding offered to the server, BSON when it does not take it')
+@click.option('--compress', default='off', type=click.Choice(COMPRESSION_MODES), help='compress the tunnel: deflate every message, or zstd the bodies worth it')
 def http(**kwargs):
-    host, port = kwargs['host'], kwargs['port']
-    username = kwargs['subdomain'] or getuser()
-
-    pretty_print(banner)
-    loop = asyncio.get_event_loop()
-
-    try:
-        loop.run_until_complete(
-            open_http_tunnel(
-                ws_uri=f'wss://{host}/_ws/?username={username}&port={port}&version={__version__}',
-                http_uri=f'http://127.0.0.1:{port}',
-            )
-        )
-    except KeyboardInterrupt:
-        pretty_print(f"[bold red]\njprq tunnel closed!")
-        sys.exit(1)
+	host, port = kwargs['host'], kwargs['port']
+	username = kwargs['subdomain'] or getuser()
+
+	pretty_print(banner)
+	loop = asyncio.get_event_loop()
+
+	try:
+		loop.run_until_complete(
+			open_http_tunnel(
+				ws_uri=f'wss://{host}/_ws/?username={username}&port={port}&version={__version__}&codec={kwargs["codec"]}&compress={kwargs["compress"]}',
+				http_uri=f'http://127.0.0.1:{port}',
+				max_inflight=kwargs['max_inflight'],
+				max_queued=kwargs['max_queued'],
+				compress=kwargs['compress'],
+			)
+		)
+	except KeyboardInterrupt:
+		pretty_print(f"[bold red]\njprq tunnel closed!")
+		sys.exit(1)
 
 
 @main.command()
 @click.argument('port', type=click.INT)
 @click.option('--host', default='liveservetcp.xcloud.io')
+@click.option('--multiplex/--no-multiplex', default=True, help='carry every connection over one tunnel connection when the server offers it')
 def tcp(**kwargs):
-    host, port = kwargs['host'], kwargs['port']
+	host, port = kwargs['host'], kwargs['port']
 
-    pretty_print(banner)
+	pretty_print(banner)
 
-    loop = asyncio.get_event_loop()
-    try:
-        loop.run_until_complete(
-            open_tcp_tunnel(
-                remote_server_host=host,
-                ws_uri=f'wss://{host}/_ws/',
-                local_server_port=port
-            )
-        )
-    except KeyboardInterrupt:
-        pretty_print(f"[bold red]\njprq tunnel closed!")
-        sys.exit(1)
+	loop = asyncio.get_event_loop()
+	try:
+		loop.run_until_complete(
+			open_tcp_tunnel(
+				remote_server_host=host,
+				ws_uri=f'wss://{host}/_ws/',
+				local_server_port=port,
+				multiplex=kwargs['multiplex'],
+			)
+		)
+	except KeyboardInterrupt:
+		pretty_print(f"[bold red]\njprq tunnel closed!")
+		sys.exit(1)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+	main()
\ No newline at end of file
@@ -0,0 +1,120 @@
+''' Wire encodings of the HTTP tunnel messages
+
+The client offers "binary" when it connects, the hello (always BSON) says which one the server picked; servers that
+do not know of it leave the tunnel on BSON. Both codecs take and give the same dicts.
+
+A binary message is a fixed 24 byte header, the strings of the message (request id, uri and url of a request, request
+id, token and error of a response), a "name: value\r\n" block of the headers and the raw body. A message without a
+'header' decodes without one. The body is decoded as
+a memoryview of the received message, it is not copied.
+'''
+
+import struct
+
+import bson
+
+# kind, flags, method, status, seq, the lengths of the three strings, of the header block and of the body
+FRAME = struct.Struct('!BBBxHIHHHII')
+# the 'type' of the message, a whole message has none
+KINDS = (None, 'start', 'data', 'end')
+KIND_NUMBERS = dict((kind, number) for (number, kind) in enumerate(KINDS))
+RESPONSE, STREAM, HAS_BODY, HAS_ERROR, ZSTD_BODY, HAS_HEADER = 1, 2, 4, 8, 16, 32
+METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS', 'PATCH', 'CONNECT', 'TRACE')
+METHOD_NUMBERS = dict((method, number + 1) for (number, method) in enumerate(METHODS))
+# other methods travel as a pseudo header
+OTHER_METHOD = 255
+METHOD_HEADER = ':method'
+
+class BSONCodec:
+	name = 'bson'
+
+	@staticmethod
+	def encode(message):
+		return bson.dumps(message)
+
+	@staticmethod
+	def decode(data):
+		return bson.loads(data)
+
+class BinaryCodec:
+	name = 'binary'
+
+	@staticmethod
+	def encode(message):
+		header = message.get('header') or {}
+		body = message.get('body')
+		flags = (HAS_BODY if body is not None else 0) | (STREAM if message.get('stream') else 0)
+		flags |= ZSTD_BODY if message.get('body_encoding') == 'zstd' else 0
+		flags |= HAS_HEADER if 'header' in message else 0
+
+		if 'request_id' in message:
+			flags |= RESPONSE | (HAS_ERROR if message.get('error') is not None else 0)
+			strings = (message['request_id'], message.get('token') or '', message.get('error') or '')
+			method = 0
+		else:
+			strings = (message['id'], message.get('uri') or '', message.get('url') or '')
+			method = METHOD_NUMBERS.get(message.get('method'), 0)
+			if method == 0 and message.get('method'):
+				method = OTHER_METHOD
+				header = dict(header, **{METHOD_HEADER: message['method']})
+
+		strings = [str(string).encode('utf-8') for string in strings]
+		header_block = ''.join(['%s: %s\r\n' % item for item in header.items()]).encode('utf-8')
+		body = body if body is not None else b''
+
+		return b''.join([
+			FRAME.pack(
+				KIND_NUMBERS[message.get('type')], flags, method, message.get('status') or 0, message.get('seq') or 0,
+				len(strings[0]), len(strings[1]), len(strings[2]), len(header_block), len(body),
+			),
+			strings[0], strings[1], strings[2], header_block, body,
+		])
+
+	@staticmethod
+	def decode(data):
+		view = memoryview(data)
+		(kind, flags, method, status, seq, first_size, second_size, third_size, header_size, body_size) = FRAME.unpack_from(view)
+
+		offset = FRAME.size
+		strings = []
+		for size in (first_size, second_size, third_size):
+			strings.append(str(view[offset:offset + size], 'utf-8'))
+			offset += size
+
+		header = {}
+		for line in str(view[offset:offset + header_size], 'utf-8').split('\r\n'):
+			if line:
+				(name, _, value) = line.partition(': ')
+				header[name] = value
+		offset += header_size
+
+		if flags & RESPONSE:
+			message = {'request_id': strings[0], 'token': strings[1]}
+			if status:
+				message['status'] = status
+			if flags & HAS_ERROR:
+				message['error'] = strings[2]
+		else:
+			message = {'id': strings[0], 'uri': strings[1], 'url': strings[2]}
+			if method == OTHER_METHOD:
+				message['method'] = header.pop(METHOD_HEADER)
+			elif method:
+				message['method'] = METHODS[method - 1]
+		if flags & HAS_HEADER:
+			message['header'] = header
+		if KINDS[kind] is not None:
+			message['type'] = KINDS[kind]
+			message['seq'] = seq
+		if flags & STREAM:
+			message['stream'] = True
+		if flags & HAS_BODY:
+			message['body'] = view[offset:offset + body_size]
+		if flags & ZSTD_BODY:
+			message['body_encoding'] = 'zstd'
+		return message
+
+CODECS = {BSONCodec.name: BSONCodec, BinaryCodec.name: BinaryCodec}
+
+def get_codec(name):
+	''' The codec the server picked, BSON when it did not say '''
+	return CODECS.get(name, BSONCodec)
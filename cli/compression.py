@@ -0,0 +1,116 @@
+''' Opt-in compression of the HTTP tunnel, and what it saves
+
+deflate  permessage-deflate on the websocket, every message compressed by the websocket library
+zstd     the bodies of the messages compressed with zstd, the websocket left as it is. Bodies below a size and bodies
+         of content that is already compressed (images, archives, a Content-Encoding) travel as they are, which
+         spares the CPU deflate spends on them. Needs the server to take it (the hello says "compress": "zstd")
+'''
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+COMPRESSION_MODES = ('off', 'deflate', 'zstd')
+DEFLATE_LEVEL = 6
+ZSTD_LEVEL = 3
+# bodies smaller than this are not worth a zstd frame
+ZSTD_MIN_BODY_SIZE = 1024
+INCOMPRESSIBLE_TYPES = (
+	'image/', 'video/', 'audio/', 'font/woff', 'application/zip', 'application/gzip', 'application/x-gzip',
+	'application/zstd', 'application/x-7z-compressed', 'application/x-rar-compressed', 'application/x-bzip2',
+	'application/x-xz', 'application/pdf',
+)
+
+def is_compressible(header):
+	''' Whether a body with these headers can shrink (svg is text) '''
+	header = dict((name.lower(), value.lower()) for (name, value) in (header or {}).items())
+	if header.get('content-encoding', 'identity') != 'identity':
+		return False
+	content_type = header.get('content-type', '')
+	return content_type.startswith('image/svg') or not content_type.startswith(INCOMPRESSIBLE_TYPES)
+
+class CompressionStats:
+	def __init__(self, mode):
+		self.mode = mode
+		(self.raw_out, self.wire_out, self.raw_in, self.wire_in) = (0, 0, 0, 0)
+		self.skipped = 0
+		# whether the server took permessage-deflate
+		self.negotiated = False
+
+	def sent(self, raw, wire):
+		self.raw_out += raw
+		self.wire_out += wire
+
+	def received(self, raw, wire):
+		self.raw_in += raw
+		self.wire_in += wire
+
+	def __str__(self):
+		ratio = lambda raw, wire: raw / wire if wire else 1
+		return '%s out %.1fx (%.1f MB -> %.1f MB) in %.1fx, %d bodies sent as they were' % (
+			self.mode, ratio(self.raw_out, self.wire_out), self.raw_out / 1e6, self.wire_out / 1e6,
+			ratio(self.raw_in, self.wire_in), self.skipped)
+
+class CountingDeflate:
+	# a permessage-deflate extension that counts the bytes before and after it
+	def __init__(self, extension, stats):
+		self.extension = extension
+		self.name = extension.name
+		self.stats = stats
+
+	def encode(self, frame):
+		encoded = self.extension.encode(frame)
+		self.stats.sent(len(frame.data), len(encoded.data))
+		return encoded
+
+	def decode(self, frame, *, max_size=None):
+		decoded = self.extension.decode(frame, max_size=max_size)
+		self.stats.received(len(decoded.data), len(frame.data))
+		return decoded
+
+class CountingDeflateFactory(ClientPerMessageDeflateFactory):
+	def __init__(self, stats, level=DEFLATE_LEVEL):
+		ClientPerMessageDeflateFactory.__init__(self, client_max_window_bits=True, compress_settings={'level': level, 'memLevel': 8})
+		self.stats = stats
+
+	def process_response_params(self, params, accepted_extensions):
+		self.stats.negotiated = True
+		return CountingDeflate(ClientPerMessageDeflateFactory.process_response_params(self, params, accepted_extensions), self.stats)
+
+class BodyCompressor:
+	''' zstd for the bodies of the messages, each on its own so every data frame of a stream decodes by itself '''
+
+	def __init__(self, stats, level=ZSTD_LEVEL, min_size=ZSTD_MIN_BODY_SIZE):
+		self.stats = stats
+		self.min_size = min_size
+		self.compressor = zstandard.ZstdCompressor(level=level)
+		self.decompressor = zstandard.ZstdDecompressor()
+
+	def compress(self, message, header):
+		body = message.get('body')
+		if not body:
+			return
+		if len(body) < self.min_size or not is_compressible(header):
+			self.stats.skipped += 1
+			self.stats.sent(len(body), len(body))
+			return
+		compressed = self.compressor.compress(body)
+		if len(compressed) >= len(body):
+			self.stats.skipped += 1
+			self.stats.sent(len(body), len(body))
+			return
+		self.stats.sent(len(body), len(compressed))
+		message['body'] = compressed
+		message['body_encoding'] = 'zstd'
+
+	def decompress(self, message):
+		body = message.get('body')
+		if message.pop('body_encoding', None) != 'zstd':
+			if body:
+				self.stats.received(len(body), len(body))
+			return
+		message['body'] = self.decompressor.decompress(body)
+		self.stats.received(len(message['body']), len(body))
@@ -0,0 +1,265 @@
+''' Many logical streams over one persistent connection to the tunnel server
+
+Every frame is a 10 byte header (type, flags, stream id, payload length) and its payload. The server opens a stream
+per public connection with an OPEN frame, so a new public connection costs a frame instead of a TCP (and TLS)
+handshake and two threads. Each direction of a stream has its own window: a sender never has more DATA in flight
+than the window the receiver granted, the receiver grants more with WINDOW frames as its side reads, so one slow
+local server cannot fill the shared connection and stall the other streams.
+'''
+
+import socket
+import struct
+import asyncio
+from collections import deque
+
+PREFACE = b'LSMUX/1\r\n'
+
+# type, flags, stream id, payload length
+HEADER = struct.Struct('!BBII')
+OPEN, DATA, WINDOW, FIN, RESET = 1, 2, 3, 4, 5
+# the public client port carried by an OPEN frame, the increment of a WINDOW frame
+OPEN_PAYLOAD = struct.Struct('!H')
+WINDOW_PAYLOAD = struct.Struct('!I')
+
+# bytes a sender may have in flight per stream and direction, granted back once half of it is read
+INITIAL_WINDOW = 256 * 1024
+MAX_FRAME_SIZE = 64 * 1024
+# bytes moved per read from the local sockets
+PUMP_BUFFER_SIZE = 64 * 1024
+
+class MuxError(Exception):
+	pass
+
+class MuxStream:
+	def __init__(self, connection, stream_id, port=None):
+		self.connection = connection
+		self.stream_id = stream_id
+		self.port = port
+
+		self.send_window = INITIAL_WINDOW
+		self.recv_window = INITIAL_WINDOW
+		self.unacked = 0
+		self.buffer = deque()
+		self.local_fin = False
+		self.remote_fin = False
+		self.is_reset = False
+		self.changed = asyncio.Event()
+
+	def wake(self):
+		self.changed.set()
+
+	async def wait(self):
+		await self.changed.wait()
+		self.changed.clear()
+
+	async def read(self):
+		''' The next bytes the peer sent, b'' once it finished sending '''
+		while not self.buffer:
+			if self.remote_fin:
+				return b''
+			if self.is_reset:
+				raise ConnectionResetError('stream %d reset' % (self.stream_id,))
+			await self.wait()
+
+		data = self.buffer.popleft()
+		self.unacked += len(data)
+		if self.unacked >= INITIAL_WINDOW // 2 and not self.remote_fin:
+			(increment, self.unacked) = (self.unacked, 0)
+			self.recv_window += increment
+			await self.connection.send(WINDOW, self.stream_id, WINDOW_PAYLOAD.pack(increment))
+		return data
+
+	async def write(self, data):
+		''' Send `data`, waiting for the peer to grant window when it is behind '''
+		view = memoryview(data)
+		while view:
+			while self.send_window <= 0 and not self.is_reset:
+				await self.wait()
+			if self.is_reset or self.local_fin:
+				raise ConnectionResetError('stream %d closed' % (self.stream_id,))
+			size = min(len(view), self.send_window, MAX_FRAME_SIZE)
+			self.send_window -= size
+			await self.connection.send(DATA, self.stream_id, view[:size])
+			view = view[size:]
+
+	async def close(self):
+		''' Done sending, the peer can still send until it closes its side '''
+		if self.local_fin or self.is_reset:
+			return
+		self.local_fin = True
+		await self.connection.send(FIN, self.stream_id)
+		self.connection.forget(self)
+
+	async def reset(self):
+		''' Abort both directions '''
+		if self.is_reset:
+			return
+		self.reset_locally()
+		if not self.connection.closed:
+			await self.connection.send(RESET, self.stream_id)
+
+	def reset_locally(self):
+		self.is_reset = True
+		self.connection.streams.pop(self.stream_id, None)
+		self.wake()
+
+	def received(self, frame_type, payload):
+		if frame_type == DATA:
+			if len(payload) > self.recv_window or self.remote_fin:
+				# the peer ignored the window it was granted
+				return False
+			self.recv_window -= len(payload)
+			self.buffer.append(payload)
+		elif frame_type == WINDOW:
+			self.send_window += WINDOW_PAYLOAD.unpack(payload)[0]
+		elif frame_type == FIN:
+			self.remote_fin = True
+			self.connection.forget(self)
+		elif frame_type == RESET:
+			self.reset_locally()
+		self.wake()
+		return True
+
+class MuxConnection:
+	''' One end of a multiplexed connection: run() reads the frames and hands the streams the peer opens to on_open(stream) '''
+
+	def __init__(self, reader, writer, is_server, on_open=None):
+		self.reader = reader
+		self.writer = writer
+		self.on_open = on_open
+		self.streams = {}
+		# the server opens odd streams, the client even ones
+		self.next_id = 1 if is_server else 2
+		self.closed = False
+
+		sock = writer.get_extra_info('socket')
+		if sock is not None:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	async def send(self, frame_type, stream_id, payload=b''):
+		if self.closed:
+			raise ConnectionResetError('tunnel connection closed')
+		# the header and its payload are queued without yielding, frames of different streams never interleave
+		self.writer.write(HEADER.pack(frame_type, 0, stream_id, len(payload)))
+		if payload:
+			self.writer.write(payload)
+		await self.writer.drain()
+
+	async def open_stream(self, port=0):
+		stream = MuxStream(self, self.next_id, port)
+		self.next_id += 2
+		self.streams[stream.stream_id] = stream
+		await self.send(OPEN, stream.stream_id, OPEN_PAYLOAD.pack(port))
+		return stream
+
+	def forget(self, stream):
+		if stream.local_fin and stream.remote_fin:
+			self.streams.pop(stream.stream_id, None)
+
+	async def run(self):
+		''' Read frames until the connection closes, then reset every stream still open '''
+		try:
+			while True:
+				(frame_type, _, stream_id, length) = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+				payload = await self.reader.readexactly(length) if length else b''
+
+				if frame_type == OPEN:
+					if stream_id in self.streams or stream_id % 2 == self.next_id % 2:
+						raise MuxError('bad stream id %d opened' % (stream_id,))
+					stream = MuxStream(self, stream_id, OPEN_PAYLOAD.unpack(payload)[0])
+					self.streams[stream_id] = stream
+					if self.on_open is not None:
+						self.on_open(stream)
+					else:
+						await stream.reset()
+					continue
+
+				stream = self.streams.get(stream_id)
+				if stream is None:
+					# a late frame of a stream already gone
+					if frame_type not in (RESET, WINDOW):
+						await self.send(RESET, stream_id)
+					continue
+				if not stream.received(frame_type, payload):
+					await stream.reset()
+		except (asyncio.IncompleteReadError, ConnectionError, OSError):
+			pass
+		finally:
+			self.close()
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		for stream in list(self.streams.values()):
+			stream.reset_locally()
+		self.writer.close()
+
+async def pump_socket_to_stream(reader, stream):
+	try:
+		while True:
+			data = await reader.read(PUMP_BUFFER_SIZE)
+			if not data:
+				break
+			await stream.write(data)
+		await stream.close()
+	except ConnectionError:
+		await stream.reset()
+
+async def pump_stream_to_socket(stream, writer):
+	try:
+		while True:
+			data = await stream.read()
+			if not data:
+				break
+			writer.write(data)
+			await writer.drain()
+		if writer.can_write_eof():
+			writer.write_eof()
+	except ConnectionError:
+		await stream.reset()
+
+async def relay(stream, reader, writer):
+	''' Move bytes both ways between `stream` and a socket until both sides are done '''
+	try:
+		await asyncio.gather(pump_socket_to_stream(reader, stream), pump_stream_to_socket(stream, writer))
+	finally:
+		writer.close()
+
+async def connect(host, port, ssl=None, on_open=None):
+	''' The client end of a multiplexed connection to `host`:`port`, over TLS when `ssl` is a context '''
+	(reader, writer) = await asyncio.open_connection(host, port, ssl=ssl, server_hostname=host if ssl else None)
+	writer.write(PREFACE)
+	await writer.drain()
+	return MuxConnection(reader, writer, False, on_open)
+
+async def accept(reader, writer, on_open=None):
+	''' The server end of a multiplexed connection a client made '''
+	preface = await reader.readexactly(len(PREFACE))
+	if preface != PREFACE:
+		writer.close()
+		raise MuxError('not a multiplexed tunnel connection: %r' % (preface,))
+	return MuxConnection(reader, writer, True, on_open)
+
+def forward_streams(local_host, local_port, on_stream=None):
+	''' An on_open() that relays every stream the server opens to a new connection to the local server '''
+	async def forward(stream):
+		try:
+			(reader, writer) = await asyncio.open_connection(local_host, local_port)
+		except OSError:
+			await stream.reset()
+			return
+		if on_stream is not None:
+			on_stream(stream)
+		await relay(stream, reader, writer)
+
+	# the loop only keeps weak references to tasks
+	tasks = set()
+
+	def on_open(stream):
+		task = asyncio.ensure_future(forward(stream))
+		tasks.add(task)
+		task.add_done_callback(tasks.discard)
+
+	return on_open
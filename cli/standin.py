@@ -0,0 +1,134 @@
+''' A local stand-in for the TCP tunnel server, to try the CLI tunnel against without the cloud
+
+	python cli/standin.py --public-port 9000
+
+It listens on four ports:
+	control  newline delimited json standing in for the websocket: the hello, then one message per public connection
+	         the client has to make a private connection for
+	public   the connections the tunnel exposes
+	private  the per connection tunnel connections, each starting with the 2 byte public client port
+	mux      multiplexed tunnel connections (see mux.py), public connections become streams of the newest one
+'''
+
+import sys
+import json
+import asyncio
+import argparse
+
+import mux
+
+class StandInServer:
+	def __init__(self, host='127.0.0.1', control_port=0, public_port=0, private_port=0, mux_port=0):
+		self.host = host
+		self.ports = {'control': control_port, 'public': public_port, 'private': private_port, 'mux': mux_port}
+		self.servers = []
+		self.controls = []
+		self.mux_connection = None
+		# public connections waiting for their private connection, by public client port
+		self.pending = {}
+
+	async def start(self):
+		handlers = {'control': self.handle_control, 'public': self.handle_public, 'private': self.handle_private, 'mux': self.handle_mux}
+		for (name, handler) in handlers.items():
+			server = await asyncio.start_server(handler, self.host, self.ports[name], backlog=4096)
+			self.ports[name] = server.sockets[0].getsockname()[1]
+			self.servers.append(server)
+		return self
+
+	def close(self):
+		for server in self.servers:
+			server.close()
+		if self.mux_connection is not None:
+			self.mux_connection.close()
+
+	def hello(self):
+		return {
+			'public_server_port': self.ports['public'],
+			'private_server_port': self.ports['private'],
+			'multiplex_port': self.ports['mux'],
+			'multiplex_tls': False,
+		}
+
+	async def handle_control(self, reader, writer):
+		writer.write(json.dumps(self.hello()).encode('utf-8') + b'\n')
+		self.controls.append(writer)
+		try:
+			await reader.read()
+		finally:
+			self.controls.remove(writer)
+			writer.close()
+
+	async def handle_mux(self, reader, writer):
+		try:
+			connection = await mux.accept(reader, writer)
+		except (mux.MuxError, asyncio.IncompleteReadError):
+			return
+		self.mux_connection = connection
+		await connection.run()
+		if self.mux_connection is connection:
+			self.mux_connection = None
+
+	async def handle_public(self, reader, writer):
+		port = writer.get_extra_info('peername')[1]
+		if self.mux_connection is not None:
+			stream = await self.mux_connection.open_stream(port)
+			await mux.relay(stream, reader, writer)
+			return
+		if not self.controls:
+			writer.close()
+			return
+
+		arrived = asyncio.get_running_loop().create_future()
+		self.pending[port] = arrived
+		message = json.dumps({'public_client_port': port}).encode('utf-8') + b'\n'
+		for control in self.controls:
+			control.write(message)
+		try:
+			(private_reader, private_writer) = await asyncio.wait_for(arrived, 30)
+		except asyncio.TimeoutError:
+			writer.close()
+			return
+		finally:
+			self.pending.pop(port, None)
+		await asyncio.gather(pump(reader, private_writer), pump(private_reader, writer))
+
+	async def handle_private(self, reader, writer):
+		try:
+			header = await reader.readexactly(2)
+		except asyncio.IncompleteReadError:
+			writer.close()
+			return
+		arrived = self.pending.get(header[0] << 8 | header[1])
+		if arrived is None or arrived.done():
+			writer.close()
+			return
+		arrived.set_result((reader, writer))
+
+async def pump(reader, writer):
+	try:
+		while True:
+			data = await reader.read(mux.PUMP_BUFFER_SIZE)
+			if not data:
+				break
+			writer.write(data)
+			await writer.drain()
+	except ConnectionError:
+		pass
+	writer.close()
+
+def parse_args(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Run a local stand-in for the TCP tunnel server')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--control-port', dest='control_port', type=int, default=0)
+	parser.add_argument('--public-port', dest='public_port', type=int, default=0)
+	parser.add_argument('--private-port', dest='private_port', type=int, default=0)
+	parser.add_argument('--mux-port', dest='mux_port', type=int, default=0)
+	return parser.parse_args(argv)
+
+async def serve(args):
+	server = await StandInServer(args.host, args.control_port, args.public_port, args.private_port, args.mux_port).start()
+	print('stand-in tunnel server on %s, ports %s' % (args.host, json.dumps(server.ports)))
+	await asyncio.Event().wait()
+
+if __name__ == '__main__':
+	asyncio.run(serve(parse_args()))
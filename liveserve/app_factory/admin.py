@@ -0,0 +1,192 @@
+
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import requests
+import threading
+from logging import getLogger
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from .caching import write_atomic
+from .urlprocessing import replace_domain, remove_anchor
+
+logger = getLogger(__name__)
+
+# the ways to pick the objects a purge drops, several given must all match
+PURGE_CRITERIA = ('url', 'prefix', 'regex', 'tag')
+# pages fetched at once by a warmup
+WARMUP_CONCURRENCY = 8
+# a warmup asked for more at once fetches this many
+WARMUP_MAX_CONCURRENCY = 32
+# pages a warmup fetches at most, the ones beyond are reported as skipped
+WARMUP_MAX_URLS = 10000
+# seconds the status of a finished warmup is kept
+WARMUP_STATUS_TTL = 24 * 3600
+# sitemap indexes are followed this deep
+SITEMAP_MAX_DEPTH = 3
+SITEMAP_NAMESPACE = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+def cache_url(url, proxy_domain, proxy_port):
+	''' The url the page at a public `url` is fetched and cached under, as general_page() rewrites it '''
+	return remove_anchor(replace_domain(url, proxy_domain, proxy_port))
+
+def cache_criteria(criteria, proxy_domain, proxy_port):
+	''' Purge criteria with their public url and prefix rewritten as cache_url() does, the regex is left as it is '''
+	criteria = dict(criteria)
+	for name in ('url', 'prefix'):
+		if criteria.get(name):
+			criteria[name] = cache_url(criteria[name], proxy_domain, proxy_port)
+	return criteria
+
+def select_keys(cache, url=None, prefix=None, regex=None, tag=None):
+	''' The keys of the cached objects matching every criterion given (urls as the pages were fetched, see cache_criteria)
+
+	An exact url is found in the index, the other criteria read the .meta file of every object.
+	'''
+	keys = [record.key for record in cache.disk.index.entries()]
+	if url:
+		# the key of a page is the md5 of its url and its suffix
+		url_prefix = '%s.' % (hashlib.md5(url.encode('utf-8')).hexdigest(),)
+		keys = [key for key in keys if key.startswith(url_prefix)]
+	if not (prefix or regex or tag):
+		return keys
+
+	pattern = re.compile(regex) if regex else None
+	selected = []
+	for key in keys:
+		entry = cache.meta(key)
+		if entry is None:
+			continue
+		if prefix and not (entry.url or '').startswith(prefix):
+			continue
+		if pattern is not None and pattern.search(entry.url or '') is None:
+			continue
+		if tag and tag not in entry.tags:
+			continue
+		selected.append(key)
+	return selected
+
+def purge(cache, **criteria):
+	''' Drop the cached objects matching `criteria` (see select_keys), returns their keys '''
+	if not any(criteria.get(name) for name in PURGE_CRITERIA):
+		raise ValueError('a purge needs one of %s' % (', '.join(PURGE_CRITERIA),))
+	keys = select_keys(cache, **criteria)
+	for key in keys:
+		cache.discard(key)
+	logger.info('Purged %d objects matching %s' % (len(keys), criteria))
+	return keys
+
+def sitemap_urls(sitemap_url, depth=0):
+	''' The page urls of a sitemap, following sitemap indexes '''
+	res = requests.get(sitemap_url, timeout=30)
+	res.raise_for_status()
+	root = ElementTree.fromstring(res.content)
+
+	urls = []
+	for location in root.iter(SITEMAP_NAMESPACE + 'loc'):
+		url = (location.text or '').strip()
+		if not url:
+			continue
+		if root.tag == SITEMAP_NAMESPACE + 'sitemapindex':
+			if depth < SITEMAP_MAX_DEPTH:
+				urls += sitemap_urls(url, depth + 1)
+		else:
+			urls.append(url)
+	return urls
+
+def warmup_concurrency(concurrency):
+	''' The pages a warmup asked for `concurrency` fetches at once, ValueError when it is not a whole number '''
+	if concurrency is None:
+		return WARMUP_CONCURRENCY
+	if isinstance(concurrency, bool) or not isinstance(concurrency, (int, str)):
+		raise ValueError('concurrency is a whole number, not %r' % (concurrency,))
+	try:
+		concurrency = int(concurrency)
+	except ValueError:
+		raise ValueError('concurrency is a whole number, not %r' % (concurrency,))
+	return min(max(1, concurrency), WARMUP_MAX_CONCURRENCY)
+
+def warmup_urls(urls):
+	''' The urls a warmup was asked for, ValueError when they are not a list of them '''
+	if urls is None:
+		return []
+	if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+		raise ValueError('urls is a list of urls')
+	return urls
+
+def warmup(urls, fetch, concurrency=WARMUP_CONCURRENCY):
+	''' fetch(url) for every url, `concurrency` at a time. Returns the urls warmed and the ones that failed
+
+	fetch() returns something true when the page is cached.
+	'''
+	def warm(url):
+		try:
+			return bool(fetch(url))
+		except Exception as e:
+			logger.warning('Warming %s failed: %s' % (url, e))
+			return False
+
+	urls = list(dict.fromkeys(urls))
+	with ThreadPoolExecutor(max(1, concurrency)) as executor:
+		results = list(executor.map(warm, urls))
+
+	warmed = [url for (url, result) in zip(urls, results) if result]
+	failed = [url for (url, result) in zip(urls, results) if not result]
+	logger.info('Warmed %d pages, %d failed' % (len(warmed), len(failed)))
+	return warmed, failed
+
+def start_warmup(job_dir, urls, sitemap, fetch, concurrency=WARMUP_CONCURRENCY, max_urls=WARMUP_MAX_URLS):
+	''' warmup() of `urls` and the pages of `sitemap` in a background thread, returns the job id to ask warmup_status() with
+
+	The status is a file in `job_dir`, so whichever worker process is asked can tell it.
+	'''
+	os.makedirs(job_dir, exist_ok=True)
+	remove_old_statuses(job_dir)
+	job_id = uuid.uuid4().hex
+	path = os.path.join(job_dir, '%s.json' % (job_id,))
+	started_at = time.time()
+	write_status(path, {'state': 'running', 'started_at': started_at})
+
+	def run():
+		try:
+			all_urls = list(urls)
+			if sitemap:
+				all_urls += sitemap_urls(sitemap)
+			all_urls = list(dict.fromkeys(all_urls))
+			write_status(path, {'state': 'running', 'started_at': started_at, 'urls': min(len(all_urls), max_urls)})
+			(warmed, failed) = warmup(all_urls[:max_urls], fetch, concurrency)
+			status = {'state': 'done', 'warmed': len(warmed), 'failed': failed, 'skipped': max(0, len(all_urls) - max_urls)}
+		except Exception as e:
+			logger.error('Warmup %s failed: %s' % (job_id, e))
+			status = {'state': 'failed', 'error': str(e)}
+		write_status(path, dict(status, started_at=started_at, finished_at=time.time()))
+
+	thread = threading.Thread(target=run)
+	thread.daemon = True
+	thread.start()
+	return job_id
+
+def warmup_status(job_dir, job_id):
+	''' The status of a warmup started by start_warmup(), None when there is no such job '''
+	if re.match(r'^[0-9a-f]{32}$', job_id) is None:
+		return None
+	try:
+		with open(os.path.join(job_dir, '%s.json' % (job_id,)), 'rb') as f:
+			return json.loads(f.read())
+	except (OSError, ValueError):
+		return None
+
+def write_status(path, status):
+	write_atomic(path, json.dumps(status).encode('utf-8'))
+
+def remove_old_statuses(job_dir):
+	for file_name in os.listdir(job_dir):
+		path = os.path.join(job_dir, file_name)
+		try:
+			if file_name.endswith('.json') and os.path.getmtime(path) < time.time() - WARMUP_STATUS_TTL:
+				os.unlink(path)
+		except OSError:
+			pass
@@ -1,14 +1,69 @@
 
 
-from flask import Flask, render_template, request
-from flask import send_from_directory
+import os
+import re
+import hmac
+from flask import Flask, abort, jsonify, render_template, request
 from .fetchpage import PageManagement
-from .import app_config, cache_config
+from .import app_config, cache_config, caching, delivery, eviction, admin
+
+def send_from_cache(page):
+	''' Serve a page from the tiered cache, hot pages straight from memory and the others by sendfile(), compressed when the client accepts it '''
+	if page is None:
+		# nothing we know how to serve at that url
+		return render_template('404.html'), 404
+
+	# a Range of an object that is not cached whole is answered from the slices it covers
+	if request.range is not None and 'If-Range' not in request.headers:
+		partial = page.get_partial(request.range)
+		if partial is not None:
+			response = delivery.deliver_partial(request, delivery.open_files, *partial)
+			if response is not None:
+				return response
+
+	response = None
+	for _ in range(2):
+		entry = page.get_entry()
+		if entry is None:
+			break
+		(encoding, data, path) = caching.page_cache.negotiate(entry, request.headers.get('Accept-Encoding', ''))
+		response = delivery.deliver(request, delivery.open_files, entry, encoding, data, path)
+		if response is not None:
+			break
+		# its file was evicted or purged since it was looked up, fetch it again
+		caching.page_cache.discard(entry.key)
+	if response is None:
+		return render_template('400.html'), 400
+
+	if entry.encodings:
+		response.headers['Vary'] = 'Accept-Encoding'
+	return response
+
+def admin_authorized():
+	''' The request carries the admin token, 404 for everyone when there is none configured '''
+	if not app_config.admin_token:
+		abort(404)
+	(scheme, _, token) = request.headers.get('Authorization', '').partition(' ')
+	if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode('utf-8'), app_config.admin_token.encode('utf-8')):
+		abort(403)
+
+def warm_page(url):
+	''' Cache the page at an origin `url`, as a visit to it would '''
+	page = PageManagement.get_page_obj(admin.cache_url(url, app_config.proxy_domain, app_config.proxy_port), headers={}, url=url)
+	return page is not None and page.get_entry() is not None
+
+def warmup_dir():
+	return os.path.join(app_config.cache_dir, '.warmup')
 
 def create_app():
 	app = Falsk(__name__, static_folder=None)
 	app.config['SECRET_KEY'] = app_config.secret_key
 	app.config['APP_HOST'] = "%s:%s" % (app_config.server_domain, app_config.server_port)
+	caching.page_cache = caching.create_cache(app_config)
+	caching.page_flights = caching.create_flights(app_config)
+	delivery.open_files = delivery.OpenFileCache(app_config.cache_open_files or delivery.OPEN_FILE_CACHE_SIZE)
+	eviction.page_evictor = eviction.create_evictor(app_config, caching.page_cache)
+	eviction.page_evictor.start()
 
 	@app.errorhandler(404)
 	def page_not_found(e):
@@ -18,6 +73,37 @@ def create_app():
 	def internal_server_error(e):
 		return render_template('500.html'), 500
 
+	@app.route('/_cache/purge', methods=['POST'])
+	def purge_cache():
+		admin_authorized()
+		criteria = request.get_json(force=True, silent=True) or {}
+		try:
+			criteria = admin.cache_criteria(dict((name, criteria.get(name)) for name in admin.PURGE_CRITERIA), app_config.proxy_domain, app_config.proxy_port)
+			keys = admin.purge(caching.page_cache, **criteria)
+		except (ValueError, re.error) as e:
+			return jsonify(error=str(e)), 400
+		return jsonify(purged=len(keys))
+
+	@app.route('/_cache/warmup', methods=['POST'])
+	def warmup_cache():
+		admin_authorized()
+		body = request.get_json(force=True, silent=True) or {}
+		try:
+			urls = admin.warmup_urls(body.get('urls'))
+			concurrency = admin.warmup_concurrency(body.get('concurrency'))
+		except ValueError as e:
+			return jsonify(error=str(e)), 400
+		job = admin.start_warmup(warmup_dir(), urls, body.get('sitemap'), warm_page, concurrency)
+		return jsonify(job=job), 202
+
+	@app.route('/_cache/warmup/<job>', methods=['GET'])
+	def warmup_job(job):
+		admin_authorized()
+		status = admin.warmup_status(warmup_dir(), job)
+		if status is None:
+			abort(404)
+		return jsonify(status)
+
 	@app.route('/', defaults={'url': ''})
 	@app.route('/<path:url>')
 	def general_page(url=None):
@@ -26,7 +112,7 @@ def create_app():
 
 		page = PageManagement.get_page_obj(new_path, headers=head_convert_to_dict(request.headers), url=request.url)
 
-		return send_from_directory(cache_dir, str(page))
+		return send_from_cache(page)
 
 	@app.route("/", subdomain="<sub>")
 	@app.route("/<path:p>", subdomain="<sub>")
@@ -36,6 +122,6 @@ def create_app():
 
 		page = PageManagement.get_page_obj(new_path, headers=head_convert_to_dict(request.headers), url=request.url)
 
-		return send_from_cache(cache, str(page))
+		return send_from_cache(page)
 
-	return app
\ No newline at end of file
+	return app
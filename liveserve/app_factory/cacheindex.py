@@ -0,0 +1,399 @@
+
+import os
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from logging import getLogger
+from collections import namedtuple
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+logger = getLogger(__name__)
+
+INDEX_MAGIC = b'LSIX'
+INDEX_VERSION = 2
+# slots of a new index, it doubles when more than half of them are taken
+INDEX_SLOTS = 64 * 1024
+# the longest key a record holds
+MAX_KEY_SIZE = 64
+
+# magic, version, retired (set once a compaction replaced the file), slot count, record capacity, records written, live keys, bytes on disk
+HEADER = struct.Struct('<4sHBxQQQQQ')
+HEADER_SIZE = 64
+# first 8 bytes of the key's md5 (0 for a free slot), number of its latest record + 1 (0 once the key is removed)
+SLOT = struct.Struct('<QQ')
+# key, stored_at, accessed_at, hits, size, bytes on disk (with the variants), suffix, encodings (bits of ENCODING_BITS), flags,
+# last_modified, source_digest (md5), etag
+RECORD = struct.Struct('<64sddI4xQQ8sBB30s16s88s')
+# accessed_at and hits, updated in place on every hit
+ACCESS = struct.Struct('<dI')
+ACCESS_OFFSET = MAX_KEY_SIZE + 8
+STORED_ACCESS = struct.Struct('<ddI')
+
+ENCODING_BITS = {'br': 1, 'zstd': 2, 'gzip': 4}
+# the validators did not fit the record, they are in the object's .meta file only
+FLAG_VALIDATORS_IN_META = 1
+# nor did the suffix (longer than SUFFIX_SIZE bytes, or not ascii)
+FLAG_SUFFIX_IN_META = 2
+SUFFIX_SIZE = 8
+
+IndexRecord = namedtuple('IndexRecord', 'key stored_at accessed_at size disk_size hits suffix encodings etag last_modified source_digest validators_in_meta suffix_in_meta')
+
+def encode_key(key):
+	''' `key` as a record holds it, ValueError when it is too long to '''
+	key_bytes = key.encode('utf-8')
+	if len(key_bytes) > MAX_KEY_SIZE:
+		raise ValueError('cache keys are at most %d bytes, not %d' % (MAX_KEY_SIZE, len(key_bytes)))
+	return key_bytes
+
+def key_hash(key_bytes):
+	# 0 marks a free slot
+	return struct.unpack_from('<Q', hashlib.md5(key_bytes).digest())[0] or 1
+
+class CacheIndex(object):
+	''' The disk tier's metadata as one memory-mapped file of fixed-size records, shared by the worker processes
+
+	The file is an open-addressed hash table of slots followed by an append-only log of records: a put appends a record
+	and points the key's slot at it, so a lookup is a probe of the mapped table, with no system call. Opening the file
+	costs an mmap() whatever its size. Writers serialise on flock() of the file, readers need no lock. When the log is
+	full it is compacted into a new file holding only the live records (with twice the slots when they run short), which
+	replaces the old one; processes still mapping the old file see its retired flag and map the new one.
+	'''
+
+	def __init__(self, path, slots=INDEX_SLOTS):
+		self.path = path
+		self.slots = slots
+		self.lock = threading.RLock()
+		self.file = None
+		self.map = None
+		self.created = False
+		self.open()
+
+	def open(self):
+		if self.map is not None:
+			self.map.close()
+			self.file.close()
+
+		try:
+			self.file = open(self.path, 'r+b')
+		except FileNotFoundError:
+			# processes starting together race to create it, the others map the winner's
+			self.created = self.write_file(self.path, self.slots, [], replace=False)
+			self.file = open(self.path, 'r+b')
+
+		self.map = mmap.mmap(self.file.fileno(), 0)
+		(magic, version, _, self.slot_count, self.capacity, _, _, _) = HEADER.unpack_from(self.map, 0)
+		if magic != INDEX_MAGIC or version != INDEX_VERSION:
+			# another version's index: start a new one, rebuilt from the .meta files
+			logger.warning('%s is not a version %d cache index, replacing it' % (self.path, INDEX_VERSION))
+			self.map.close()
+			self.file.close()
+			os.unlink(self.path)
+			self.map = None
+			return self.open()
+		self.log_offset = HEADER_SIZE + self.slot_count * SLOT.size
+
+	@staticmethod
+	def write_file(path, slot_count, records, replace=True):
+		''' A new index of `slot_count` slots holding `records` (packed records), put in place atomically
+
+		Unless `replace`, an existing index is left alone and False returned.
+		'''
+		capacity = slot_count // 2
+		slots = bytearray(slot_count * SLOT.size)
+		log = bytearray(capacity * RECORD.size)
+		disk_size = 0
+		for (number, record) in enumerate(records):
+			hash_value = key_hash(record[:MAX_KEY_SIZE].rstrip(b'\0'))
+			position = CacheIndex.probe(slots, slot_count, hash_value)
+			SLOT.pack_into(slots, position * SLOT.size, hash_value, number + 1)
+			log[number * RECORD.size:(number + 1) * RECORD.size] = record
+			disk_size += RECORD.unpack_from(record)[5]
+
+		tmp_path = '%s.%d.tmp' % (path, os.getpid())
+		with open(tmp_path, 'wb') as f:
+			f.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, slot_count, capacity, len(records), len(records), disk_size).ljust(HEADER_SIZE, b'\0'))
+			f.write(slots)
+			f.write(log)
+		if replace:
+			os.replace(tmp_path, path)
+			return True
+		try:
+			os.link(tmp_path, path)
+			return True
+		except FileExistsError:
+			return False
+		finally:
+			os.unlink(tmp_path)
+
+	@staticmethod
+	def probe(slots, slot_count, hash_value, offset=0):
+		''' The slot of `hash_value` in a table starting at `offset`, or the free slot where it would go '''
+		position = hash_value & (slot_count - 1)
+		while True:
+			(slot_value, _) = SLOT.unpack_from(slots, offset + position * SLOT.size)
+			if slot_value == 0 or slot_value == hash_value:
+				return position
+			position = (position + 1) & (slot_count - 1)
+
+	def check_retired(self):
+		if self.map[6]:
+			self.open()
+
+	def find(self, key_bytes):
+		''' (slot position, record number + 1 or 0) of a key '''
+		hash_value = key_hash(key_bytes)
+		position = hash_value & (self.slot_count - 1)
+		while True:
+			(slot_value, number) = SLOT.unpack_from(self.map, HEADER_SIZE + position * SLOT.size)
+			if slot_value == 0:
+				return position, 0
+			if slot_value == hash_value and (number == 0 or self.record_key(number - 1) == key_bytes):
+				return position, number
+			position = (position + 1) & (self.slot_count - 1)
+
+	def record_key(self, number):
+		offset = self.log_offset + number * RECORD.size
+		return self.map[offset:offset + MAX_KEY_SIZE].rstrip(b'\0')
+
+	@staticmethod
+	def unpack(record):
+		(key, stored_at, accessed_at, hits, size, disk_size, suffix, encodings, flags, last_modified, source_digest, etag) = RECORD.unpack(record)
+		return IndexRecord(
+			key.rstrip(b'\0').decode('utf-8'), stored_at, accessed_at, size, disk_size, hits,
+			suffix.rstrip(b'\0').decode('ascii'),
+			[encoding for (encoding, bit) in ENCODING_BITS.items() if encodings & bit],
+			etag.rstrip(b'\0').decode('latin-1') or None,
+			last_modified.rstrip(b'\0').decode('latin-1') or None,
+			source_digest.hex() if source_digest.strip(b'\0') else None,
+			bool(flags & FLAG_VALIDATORS_IN_META),
+			bool(flags & FLAG_SUFFIX_IN_META))
+
+	def get(self, key):
+		''' The IndexRecord of `key`, or None '''
+		with self.lock:
+			self.check_retired()
+			(_, number) = self.find(key.encode('utf-8'))
+			if number == 0:
+				return None
+			offset = self.log_offset + (number - 1) * RECORD.size
+			record = self.map[offset:offset + RECORD.size]
+		return self.unpack(record)
+
+	def record_access(self, key):
+		''' Count a hit on `key`, for the eviction policies, and return its stored_at (None when it is not indexed)
+
+		Not locked across processes, an flock() per hit would cost the system call lookups are free of. Two processes
+		writing at once can lose a count, or leave accessed_at with the low bytes of one's time and the high bytes of
+		the other's: times taken that close together differ in their low bytes only, so it is still about then. Both
+		only ever shift an object's place in the eviction order. Nothing else of a record is written in place.
+		'''
+		with self.lock:
+			self.check_retired()
+			(_, number) = self.find(key.encode('utf-8'))
+			if number == 0:
+				return None
+			offset = self.log_offset + (number - 1) * RECORD.size
+			(stored_at, _, hits) = STORED_ACCESS.unpack_from(self.map, offset + MAX_KEY_SIZE)
+			ACCESS.pack_into(self.map, offset + ACCESS_OFFSET, time.time(), hits + 1)
+			return stored_at
+
+	def put(self, key, stored_at, size, suffix, encodings=(), etag=None, last_modified=None, source_digest=None, disk_size=None):
+		''' Index `key`, keeping the hits it had. `disk_size` is what its files take, by default what they took so far (or `size`) '''
+		key_bytes = encode_key(key)
+		etag_bytes = (etag or '').encode('latin-1')
+		last_modified_bytes = (last_modified or '').encode('latin-1')
+		flags = 0
+		if len(etag_bytes) > 88 or len(last_modified_bytes) > 30:
+			etag_bytes, last_modified_bytes, flags = b'', b'', FLAG_VALIDATORS_IN_META
+		suffix_bytes = suffix.encode('utf-8')
+		if len(suffix_bytes) > SUFFIX_SIZE or not suffix.isascii():
+			suffix_bytes, flags = b'', flags | FLAG_SUFFIX_IN_META
+
+		with self.write_lock():
+			(_, _, _, _, _, used, live, total) = HEADER.unpack_from(self.map, 0)
+			if used == self.capacity:
+				# a slot is only taken by a record written since the last compaction, so half of them are always free
+				self.rewrite(grow=live >= self.capacity // 2)
+				(_, _, _, _, _, used, live, total) = HEADER.unpack_from(self.map, 0)
+			(position, number) = self.find(key_bytes)
+
+			(hits, old_disk_size) = (0, 0)
+			if number:
+				previous = RECORD.unpack_from(self.map, self.log_offset + (number - 1) * RECORD.size)
+				(hits, old_disk_size) = (previous[3], previous[5])
+			if disk_size is None:
+				disk_size = old_disk_size if number else size
+
+			record = RECORD.pack(
+				key_bytes, stored_at, time.time(), hits, size, disk_size, suffix_bytes,
+				sum(ENCODING_BITS[encoding] for encoding in encodings), flags,
+				last_modified_bytes, bytes.fromhex(source_digest) if source_digest else b'', etag_bytes)
+
+			# the record first, the slot only points at it once it is complete
+			self.map[self.log_offset + used * RECORD.size:self.log_offset + (used + 1) * RECORD.size] = record
+			SLOT.pack_into(self.map, HEADER_SIZE + position * SLOT.size, key_hash(key_bytes), used + 1)
+			self.set_counts(used + 1, live + (0 if number else 1), total + disk_size - old_disk_size)
+
+	def remove(self, key):
+		key_bytes = key.encode('utf-8')
+		with self.write_lock():
+			(position, number) = self.find(key_bytes)
+			if number == 0:
+				return
+			(_, _, _, _, _, used, live, total) = HEADER.unpack_from(self.map, 0)
+			disk_size = RECORD.unpack_from(self.map, self.log_offset + (number - 1) * RECORD.size)[5]
+			# the slot stays taken, later keys of its probe chain are found past it
+			SLOT.pack_into(self.map, HEADER_SIZE + position * SLOT.size, key_hash(key_bytes), 0)
+			self.set_counts(used, live - 1, total - disk_size)
+
+	def set_counts(self, used, live, total):
+		struct.pack_into('<QQQ', self.map, 24, used, live, total)
+
+	def __len__(self):
+		with self.lock:
+			self.check_retired()
+			return HEADER.unpack_from(self.map, 0)[6]
+
+	def disk_size(self):
+		''' Bytes the indexed objects take on disk '''
+		with self.lock:
+			self.check_retired()
+			return HEADER.unpack_from(self.map, 0)[7]
+
+	def records(self):
+		''' The packed record of every live key '''
+		records = []
+		with self.lock:
+			self.check_retired()
+			for position in range(self.slot_count):
+				(slot_value, number) = SLOT.unpack_from(self.map, HEADER_SIZE + position * SLOT.size)
+				if slot_value and number:
+					offset = self.log_offset + (number - 1) * RECORD.size
+					records.append(self.map[offset:offset + RECORD.size])
+		return records
+
+	def entries(self):
+		''' The IndexRecord of every live key '''
+		return [self.unpack(record) for record in self.records()]
+
+	def compact(self):
+		''' Rewrite the index with its live records only '''
+		with self.write_lock():
+			self.rewrite()
+
+	def rewrite(self, grow=False):
+		''' compact(), with twice the slots when `grow`. The caller holds the write lock, and holds it on the new file after '''
+		records = self.records()
+		slot_count = self.slot_count * 2 if grow else self.slot_count
+		while len(records) + 1 > slot_count // 2:
+			slot_count *= 2
+		self.write_file(self.path, slot_count, records)
+		logger.info('Compacted cache index %s, %d keys in %d slots' % (self.path, len(records), slot_count))
+
+		# the processes still mapping the old file move to the new one on their next lookup
+		self.map[6] = 1
+		self.open()
+		self.lock_file()
+
+	def lock_file(self):
+		''' flock() the current index file, moving to the new one when another process compacted it while we waited '''
+		while True:
+			if fcntl is not None:
+				fcntl.flock(self.file, fcntl.LOCK_EX)
+			if not self.map[6]:
+				return
+			if fcntl is not None:
+				fcntl.flock(self.file, fcntl.LOCK_UN)
+			self.open()
+
+	def write_lock(self):
+		return IndexWriteLock(self)
+
+	def close(self):
+		with self.lock:
+			self.map.close()
+			self.file.close()
+
+class IndexWriteLock(object):
+	''' The index's thread lock and an flock() of its file, held around every change to it '''
+
+	def __init__(self, index):
+		self.index = index
+
+	def __enter__(self):
+		self.index.lock.acquire()
+		self.index.lock_file()
+		return self
+
+	def __exit__(self, *exc_info):
+		if fcntl is not None:
+			fcntl.flock(self.index.file, fcntl.LOCK_UN)
+		self.index.lock.release()
+
+SKETCH_MAGIC = b'LSFS'
+# counters per row and rows of the frequency sketch
+SKETCH_WIDTH = 256 * 1024
+SKETCH_DEPTH = 4
+# magic, increments since the counters were last halved
+SKETCH_HEADER = struct.Struct('<4s4xQ')
+SKETCH_HEADER_SIZE = 16
+HALVE = bytes(value >> 1 for value in range(256))
+
+class FrequencySketch(object):
+	''' How often each key was asked for lately (hits and misses alike), a count-min sketch mapped from a file shared by the worker processes
+
+	Counters are a byte each, all of them are halved every `sample_size` increments so old popularity fades.
+	Increments are not locked, a lost one does no harm to an estimate.
+	'''
+
+	def __init__(self, path, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, sample_size=None):
+		self.path = path
+		self.width = width
+		self.depth = depth
+		self.sample_size = sample_size or width * 10
+
+		size = SKETCH_HEADER_SIZE + width * depth
+		if not os.path.exists(path) or os.path.getsize(path) != size:
+			tmp_path = '%s.%d.tmp' % (path, os.getpid())
+			with open(tmp_path, 'wb') as f:
+				f.write(SKETCH_HEADER.pack(SKETCH_MAGIC, 0).ljust(SKETCH_HEADER_SIZE, b'\0'))
+				f.truncate(size)
+			if os.path.exists(path):
+				# sized differently, start counting again
+				os.replace(tmp_path, path)
+			else:
+				# processes starting together race to create it, the others map the winner's
+				try:
+					os.link(tmp_path, path)
+				except FileExistsError:
+					pass
+				os.unlink(tmp_path)
+		with open(path, 'r+b') as f:
+			self.map = mmap.mmap(f.fileno(), 0)
+
+	def positions(self, key):
+		digest = hashlib.md5(key.encode('utf-8')).digest()
+		return [SKETCH_HEADER_SIZE + row * self.width + (struct.unpack_from('<I', digest, row * 4)[0] % self.width) for row in range(self.depth)]
+
+	def increment(self, key):
+		for position in self.positions(key):
+			if self.map[position] < 255:
+				self.map[position] += 1
+
+		additions = SKETCH_HEADER.unpack_from(self.map, 0)[1] + 1
+		if additions >= self.sample_size:
+			additions = 0
+			self.map[SKETCH_HEADER_SIZE:] = self.map[SKETCH_HEADER_SIZE:].translate(HALVE)
+		struct.pack_into('<Q', self.map, 8, additions)
+
+	def estimate(self, key):
+		return min(self.map[position] for position in self.positions(key))
+
+	def close(self):
+		self.map.close()
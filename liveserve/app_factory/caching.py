@@ -0,0 +1,732 @@
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import mimetypes
+from logging import getLogger
+from collections import OrderedDict
+
+from .cacheindex import CacheIndex, FrequencySketch, encode_key
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+logger = getLogger(__name__)
+
+# memory tier: total bytes held, and the largest object worth holding there
+MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+MEMORY_MAX_OBJECT_SIZE = 1024 * 1024
+# levels of hashed subdirectories on disk, 2 stores a key as cache_dir/ab/cd/<key>
+DISK_SHARD_DEPTH = 2
+# seconds an object stays fresh when its content type has no TTL of its own
+DEFAULT_TTL = 300
+# seconds past its TTL an object is still served while it is refreshed in the background,
+# and while its origin fails
+STALE_WHILE_REVALIDATE = 300
+STALE_IF_ERROR = 24 * 3600
+# lock files shared by the worker processes, a key uses the one its hash picks
+FLIGHT_LOCK_STRIPES = 1024
+# seconds a process waits for another one's fetch before fetching itself
+FLIGHT_WAIT_TIMEOUT = 30
+
+# objects fetched by Range are cached in slices of this size, and an open ended Range
+# ("bytes=0-") is answered with at most PARTIAL_WINDOW slices, the client asks again for the rest
+PARTIAL_CHUNK_SIZE = 1024 * 1024
+PARTIAL_WINDOW = 4
+
+# suffixes worth storing compressed, and the smallest body worth compressing
+COMPRESSIBLE_SUFFIXES = frozenset(['html', 'htm', 'css', 'js', 'json', 'xml', 'svg', 'txt'])
+MIN_COMPRESS_SIZE = 256
+
+# the Content-Encodings stored next to a compressible object, compressed once when it is cached, best first
+ENCODERS = OrderedDict()
+if brotli is not None:
+	ENCODERS['br'] = lambda data: brotli.compress(data, quality=11)
+if zstandard is not None:
+	ENCODERS['zstd'] = lambda data: zstandard.ZstdCompressor(level=19).compress(data)
+ENCODERS['gzip'] = lambda data: gzip.compress(data, 9)
+
+ENCODING_EXTENSIONS = {'br': '.br', 'zstd': '.zst', 'gzip': '.gz'}
+
+# the DomainSetting attribute holding the TTL of each suffix
+TTL_SETTINGS = {
+	'html': 'html_expired',
+	'htm': 'html_expired',
+	'js': 'js_css_expired',
+	'css': 'js_css_expired',
+	'jpg': 'img_expired',
+	'jpeg': 'img_expired',
+	'png': 'img_expired',
+	'gif': 'img_expired',
+	'ico': 'img_expired',
+}
+
+def write_atomic(path, data):
+	''' Write to a temporary file next to `path` and rename it over, readers see the old or the new file, never part of one '''
+	(fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+		os.replace(tmp_path, path)
+	except BaseException:
+		try:
+			os.unlink(tmp_path)
+		except OSError:
+			pass
+		raise
+
+def allocated_size(path):
+	''' Bytes `path` takes on disk, less than its size for the sparse file of a partially cached object '''
+	stat = os.stat(path)
+	blocks = getattr(stat, 'st_blocks', None)
+	return stat.st_size if blocks is None else min(stat.st_size, blocks * 512)
+
+def compress_variants(suffix, data):
+	''' Content-Encoding -> compressed data, for the encodings that make `data` smaller '''
+	variants = {}
+	if suffix not in COMPRESSIBLE_SUFFIXES or len(data) < MIN_COMPRESS_SIZE:
+		return variants
+	for (encoding, compress) in ENCODERS.items():
+		compressed = compress(data)
+		if len(compressed) < len(data):
+			variants[encoding] = compressed
+	return variants
+
+def choose_encoding(accept_encoding, encodings):
+	''' The best of `encodings` an Accept-Encoding header allows, None for the identity '''
+	if not encodings or not accept_encoding:
+		return None
+
+	weights = {}
+	for part in accept_encoding.split(','):
+		(name, _, params) = part.strip().partition(';')
+		weight = 1.0
+		params = params.strip()
+		if params.startswith('q='):
+			try:
+				weight = float(params[2:])
+			except ValueError:
+				weight = 0.0
+		weights[name.strip().lower()] = weight
+
+	best = None
+	best_weight = 0.0
+	for encoding in ENCODERS:
+		if encoding not in encodings:
+			continue
+		weight = weights.get(encoding, weights.get('*', 0.0))
+		if weight > best_weight:
+			best, best_weight = encoding, weight
+	return best
+
+class CacheEntry(object):
+	''' One cached object. `data` is None when only the disk tier holds it, read `path` then
+
+	`etag` and `last_modified` are the origin's validators, sent back to it when the object expires.
+	`source_digest` is the md5 of the origin's body before we rewrote it, an unchanged body need not be rewritten again.
+	`encodings` are the compressed variants stored next to it, `variants` holds their data when `data` is held too.
+	`url` is where it was fetched from and `tags` the origin's surrogate keys for it, both only kept in the .meta file.
+	'''
+
+	def __init__(self, key, suffix, stored_at, size, data=None, path=None, etag=None, last_modified=None, source_digest=None, encodings=(), variants=None, url=None, tags=()):
+		self.key = key
+		self.suffix = suffix
+		self.stored_at = stored_at
+		self.size = size
+		self.data = data
+		self.path = path
+		self.etag = etag
+		self.last_modified = last_modified
+		self.source_digest = source_digest
+		self.encodings = list(encodings)
+		self.variants = variants
+		self.url = url
+		self.tags = list(tags)
+
+	def replace(self, **changes):
+		fields = dict(vars(self), **changes)
+		return CacheEntry(**fields)
+
+	@property
+	def content_type(self):
+		return mimetypes.guess_type('page.%s' % (self.suffix,))[0] or 'application/octet-stream'
+
+	def age(self):
+		return time.time() - self.stored_at
+
+	def memory_size(self):
+		return self.size + sum(len(variant) for variant in (self.variants or {}).values())
+
+	def variant_path(self, encoding):
+		return self.path + ENCODING_EXTENSIONS[encoding]
+
+	def to_meta(self):
+		return {'key': self.key, 'suffix': self.suffix, 'stored_at': self.stored_at, 'size': self.size, 'etag': self.etag, 'last_modified': self.last_modified, 'source_digest': self.source_digest, 'encodings': self.encodings, 'url': self.url, 'tags': self.tags}
+
+class PartialObject(object):
+	''' An object cached slice by slice, as clients ask for ranges of it
+
+	The slices are written into a sparse file of the object's full size (`path`), the `.map` file next to it holds
+	one byte per slice, set once the slice is written. A byte each, so processes filling different slices never
+	lose each other's writes. Size and validators come from the origin's first 206 and sit in a `.json` file.
+	'''
+
+	def __init__(self, key, suffix, stored_at, size, path, chunk_size=PARTIAL_CHUNK_SIZE, etag=None, last_modified=None):
+		self.key = key
+		self.suffix = suffix
+		self.stored_at = stored_at
+		self.size = size
+		self.path = path
+		self.chunk_size = chunk_size
+		self.etag = etag
+		self.last_modified = last_modified
+
+	content_type = CacheEntry.content_type
+	age = CacheEntry.age
+
+	@property
+	def chunk_count(self):
+		return (self.size + self.chunk_size - 1) // self.chunk_size
+
+	def chunk_bounds(self, index):
+		''' [start, stop) of slice `index` '''
+		return index * self.chunk_size, min(self.size, (index + 1) * self.chunk_size)
+
+	def bounds(self, first, last):
+		''' [start, stop) to answer a Range of bytes first..last (last None when open ended) with, None when it cannot be satisfied '''
+		if first >= self.size:
+			return None
+		if last is None:
+			last = min(self.size, (first // self.chunk_size + PARTIAL_WINDOW) * self.chunk_size) - 1
+		return first, min(last + 1, self.size)
+
+	def filled(self):
+		with open(self.path + '.map', 'rb') as f:
+			return f.read()
+
+	def missing(self, start, stop):
+		''' The slices of [start, stop) nobody wrote yet '''
+		filled = self.filled()
+		return [index for index in range(start // self.chunk_size, (stop - 1) // self.chunk_size + 1) if not filled[index]]
+
+	def is_complete(self):
+		return all(self.filled())
+
+	def write_chunk(self, index, data):
+		(start, stop) = self.chunk_bounds(index)
+		if len(data) != stop - start:
+			raise ValueError('slice %d of %s is %d bytes, not %d' % (index, self.key, len(data), stop - start))
+
+		# the data first, a slice only counts as filled once its byte in the map is set
+		fd = os.open(self.path, os.O_WRONLY)
+		try:
+			os.pwrite(fd, data, start)
+		finally:
+			os.close(fd)
+		fd = os.open(self.path + '.map', os.O_WRONLY)
+		try:
+			os.pwrite(fd, b'\x01', index)
+		finally:
+			os.close(fd)
+
+	def to_meta(self):
+		return {'key': self.key, 'suffix': self.suffix, 'stored_at': self.stored_at, 'size': self.size, 'chunk_size': self.chunk_size, 'etag': self.etag, 'last_modified': self.last_modified}
+
+class MemoryCache(object):
+	''' In-process LRU tier, bounded by the total size of the objects (and their compressed variants) it holds '''
+
+	def __init__(self, max_size=MEMORY_CACHE_SIZE, max_object_size=MEMORY_MAX_OBJECT_SIZE):
+		self.max_size = max_size
+		self.max_object_size = max_object_size
+		self.entries = OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+			return entry
+
+	def put(self, entry):
+		''' Hold `entry`, evicting the least recently used objects to make room. False when it is too big to hold '''
+		with self.lock:
+			self._discard(entry.key)
+			if entry.data is None or entry.size > self.max_object_size or entry.memory_size() > self.max_size:
+				return False
+
+			self.entries[entry.key] = entry
+			self.size += entry.memory_size()
+			while self.size > self.max_size:
+				(_, evicted) = self.entries.popitem(last=False)
+				self.size -= evicted.memory_size()
+			return True
+
+	def discard(self, key):
+		with self.lock:
+			self._discard(key)
+
+	def _discard(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry.memory_size()
+
+class DiskCache(object):
+	''' On-disk tier: objects sharded into hashed subdirectories of `cache_dir`, each next to a JSON metadata file
+
+	Lookups go to a CacheIndex of the metadata mapped from `cache_dir`/index, shared with the other worker processes,
+	so they never touch the filesystem. The .meta files are what it is rebuilt from when it is missing.
+	`sketch` counts how often each key is asked for, for the eviction policies.
+	Keys must be valid file names of at most 64 bytes.
+	'''
+
+	def __init__(self, cache_dir, shard_depth=DISK_SHARD_DEPTH):
+		self.cache_dir = cache_dir
+		self.shard_depth = shard_depth
+
+		os.makedirs(cache_dir, exist_ok=True)
+		self.index = CacheIndex(os.path.join(cache_dir, 'index'))
+		if self.index.created:
+			self.load_index()
+		self.sketch = FrequencySketch(os.path.join(cache_dir, 'frequency'))
+
+	def path(self, key):
+		digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+		shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+		return os.path.join(self.cache_dir, *(shards + [key]))
+
+	def load_index(self):
+		''' Fill a new index from the .meta files of a cache that had none '''
+		for (dir_path, _, file_names) in os.walk(self.cache_dir):
+			for file_name in file_names:
+				if not file_name.endswith('.meta'):
+					continue
+				entry = self.read_meta(os.path.join(dir_path, file_name))
+				if entry is None:
+					continue
+				try:
+					disk_size = sum(os.path.getsize(path) for path in [entry.path] + [entry.variant_path(encoding) for encoding in entry.encodings])
+				except OSError:
+					continue
+				self.index_entry(entry, disk_size)
+
+	def read_meta(self, meta_path):
+		try:
+			with open(meta_path, 'rb') as f:
+				meta = json.loads(f.read())
+			return CacheEntry(meta['key'], meta['suffix'], meta['stored_at'], meta['size'], path=os.path.join(os.path.dirname(meta_path), meta['key']), etag=meta.get('etag'), last_modified=meta.get('last_modified'), source_digest=meta.get('source_digest'), encodings=meta.get('encodings', ()), url=meta.get('url'), tags=meta.get('tags', ()))
+		except (OSError, ValueError, KeyError):
+			return None
+
+	def get(self, key):
+		record = self.index.get(key)
+		if record is None:
+			return None
+		if record.validators_in_meta or record.suffix_in_meta:
+			return self.read_meta(self.path(key) + '.meta')
+		return CacheEntry(key, record.suffix, record.stored_at, record.size, path=self.path(key), etag=record.etag, last_modified=record.last_modified, source_digest=record.source_digest, encodings=record.encodings)
+
+	def index_entry(self, entry, disk_size=None):
+		self.index.put(entry.key, entry.stored_at, entry.size, entry.suffix, entry.encodings, entry.etag, entry.last_modified, entry.source_digest, disk_size)
+
+	def read(self, entry, encoding=None):
+		with open(entry.path if encoding is None else entry.variant_path(encoding), 'rb') as f:
+			return f.read()
+
+	def put(self, key, suffix, data, etag=None, last_modified=None, source_digest=None, variants=None, url=None, tags=()):
+		# a key the index cannot hold fails before any file is written
+		encode_key(key)
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		variants = variants or {}
+		entry = CacheEntry(key, suffix, time.time(), len(data), path=path, etag=etag, last_modified=last_modified, source_digest=source_digest, encodings=sorted(variants), url=url, tags=tags)
+		# the data first, an object only counts as cached once its metadata exists
+		write_atomic(path, data)
+		for (encoding, variant) in variants.items():
+			write_atomic(entry.variant_path(encoding), variant)
+		return self.write_meta(entry, len(data) + sum(len(variant) for variant in variants.values()))
+
+	def touch(self, entry, **validators):
+		''' Restart the age of an object the origin says is unchanged, its data stays as it is '''
+		if entry.url is None:
+			# looked up in the index, which does not hold the url and tags
+			previous = self.read_meta(entry.path + '.meta')
+			if previous is not None:
+				entry = entry.replace(url=previous.url, tags=previous.tags)
+		return self.write_meta(entry.replace(stored_at=time.time(), data=None, variants=None, **validators))
+
+	def write_meta(self, entry, disk_size=None):
+		write_atomic(entry.path + '.meta', json.dumps(entry.to_meta()).encode('utf-8'))
+		self.index_entry(entry, disk_size)
+		return entry
+
+	def discard(self, key):
+		self.discard_partial(key)
+		entry = self.get(key)
+		if entry is None:
+			return
+		self.index.remove(key)
+		for path in [entry.path + '.meta', entry.path] + [entry.variant_path(encoding) for encoding in entry.encodings]:
+			try:
+				os.unlink(path)
+			except OSError:
+				pass
+
+	def partial_path(self, key):
+		return self.path(key) + '.part'
+
+	def get_partial(self, key):
+		''' The PartialObject of `key`, None when no slice of it is cached '''
+		path = self.partial_path(key)
+		try:
+			with open(path + '.json', 'rb') as f:
+				meta = json.loads(f.read())
+			return PartialObject(meta['key'], meta['suffix'], meta['stored_at'], meta['size'], path, meta['chunk_size'], meta.get('etag'), meta.get('last_modified'))
+		except (OSError, ValueError, KeyError):
+			return None
+
+	def put_partial(self, key, suffix, size, etag=None, last_modified=None, chunk_size=PARTIAL_CHUNK_SIZE):
+		''' An empty PartialObject for an object of `size` bytes, replacing any slices cached before '''
+		encode_key(key)
+		path = self.partial_path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		partial = PartialObject(key, suffix, time.time(), size, path, chunk_size, etag, last_modified)
+		(fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+		try:
+			os.ftruncate(fd, size)
+		finally:
+			os.close(fd)
+		os.replace(tmp_path, path)
+		write_atomic(path + '.map', bytes(partial.chunk_count))
+		# as for whole objects, it only exists once its metadata does
+		write_atomic(path + '.json', json.dumps(partial.to_meta()).encode('utf-8'))
+		return partial
+
+	def complete_partial(self, partial):
+		''' Turn a PartialObject with every slice filled into a whole cached object '''
+		entry = CacheEntry(partial.key, partial.suffix, partial.stored_at, partial.size, path=self.path(partial.key), etag=partial.etag, last_modified=partial.last_modified)
+		try:
+			os.replace(partial.path, entry.path)
+		except FileNotFoundError:
+			# another process completed it first
+			return self.get(partial.key)
+		self.write_meta(entry)
+		self.discard_partial(partial.key)
+		return entry
+
+	def partials(self):
+		''' (PartialObject, bytes it takes on disk) of every partially cached object, they are not in the index '''
+		for (dir_path, _, file_names) in os.walk(self.cache_dir):
+			for file_name in file_names:
+				if not file_name.endswith('.part.json'):
+					continue
+				partial = self.get_partial(file_name[:-len('.part.json')])
+				if partial is None:
+					continue
+				try:
+					disk_size = sum(allocated_size(path) for path in (partial.path, partial.path + '.map', partial.path + '.json'))
+				except OSError:
+					continue
+				yield partial, disk_size
+
+	def discard_partial(self, key):
+		path = self.partial_path(key)
+		for path in (path + '.json', path + '.map', path):
+			try:
+				os.unlink(path)
+			except OSError:
+				pass
+
+class CacheStats(object):
+	''' Lookups and evictions of this process, for the hit ratio and the eviction rate '''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.memory_hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.evicted_bytes = 0
+
+	def count(self, name, amount=1):
+		with self.lock:
+			setattr(self, name, getattr(self, name) + amount)
+
+	def snapshot(self):
+		with self.lock:
+			hits = self.memory_hits + self.disk_hits
+			minutes = max(time.time() - self.started, 1) / 60.0
+			return {
+				'memory_hits': self.memory_hits,
+				'disk_hits': self.disk_hits,
+				'misses': self.misses,
+				'hit_ratio': hits / float(hits + self.misses) if hits + self.misses else 0.0,
+				'evictions': self.evictions,
+				'evicted_bytes': self.evicted_bytes,
+				'evictions_per_minute': self.evictions / minutes,
+			}
+
+	def __str__(self):
+		return 'memory_hits=%(memory_hits)d disk_hits=%(disk_hits)d misses=%(misses)d hit_ratio=%(hit_ratio).3f evictions=%(evictions)d evicted_bytes=%(evicted_bytes)d evictions_per_minute=%(evictions_per_minute).1f' % self.snapshot()
+
+class TieredCache(object):
+	''' The memory tier in front of the disk tier, with a TTL per content type (suffix)
+
+	Hits in the memory tier never touch the filesystem. Disk hits small enough for memory are promoted to it.
+	The disk tier's index is shared, what one worker process cached is a hit for the others at once.
+	Expired objects are kept for get_stale() until they are replaced or evicted.
+	'''
+
+	def __init__(self, memory, disk, ttls=None, default_ttl=DEFAULT_TTL, stale_while_revalidate=STALE_WHILE_REVALIDATE, stale_if_error=STALE_IF_ERROR):
+		self.memory = memory
+		self.disk = disk
+		self.ttls = ttls or {}
+		self.default_ttl = default_ttl
+		self.stale_while_revalidate = stale_while_revalidate
+		self.stale_if_error = stale_if_error
+		self.stats = CacheStats()
+
+	def ttl(self, suffix):
+		return self.ttls.get(suffix, self.default_ttl)
+
+	def fresh(self, entry, max_age=None):
+		return entry.age() < (self.ttl(entry.suffix) if max_age is None else max_age)
+
+	def get(self, key, max_age=None):
+		''' The fresh entry of `key`, or None. `max_age` overrides the TTL of its content type '''
+		self.disk.sketch.increment(key)
+		entry = self.memory.get(key)
+		if entry is not None and self.disk.index.record_access(key) != entry.stored_at:
+			# replaced, purged or evicted by another process since we held it
+			self.memory.discard(key)
+			entry = None
+		tier = 'memory_hits'
+		if entry is None or not self.fresh(entry, max_age):
+			entry = self.disk.get(key)
+			tier = 'disk_hits'
+			if entry is None or not self.fresh(entry, max_age):
+				self.stats.count('misses')
+				return None
+			self.disk.index.record_access(key)
+		self.stats.count(tier)
+		return self.load(entry)
+
+	def get_stale(self, key, max_stale):
+		''' The entry of `key` if it expired less than `max_stale` seconds ago, or None '''
+		entry = self.memory.get(key) or self.disk.get(key)
+		if entry is None or entry.age() >= self.ttl(entry.suffix) + max_stale:
+			return None
+		self.disk.index.record_access(key)
+		return self.load(entry)
+
+	def load(self, entry):
+		''' Promote a disk-only entry small enough for the memory tier '''
+		if entry.data is not None or entry.size > self.memory.max_object_size:
+			return entry
+		try:
+			data = self.disk.read(entry)
+			variants = dict((encoding, self.disk.read(entry, encoding)) for encoding in entry.encodings)
+		except OSError:
+			self.disk.discard(entry.key)
+			return None
+		entry = entry.replace(data=data, size=len(data), variants=variants)
+		self.memory.put(entry)
+		return entry
+
+	def put(self, key, suffix, data, etag=None, last_modified=None, source_digest=None, url=None, tags=()):
+		''' Cache `data`, with its compressed variants when its content type compresses '''
+		variants = compress_variants(suffix, data)
+		entry = self.disk.put(key, suffix, data, etag, last_modified, source_digest, variants, url, tags)
+		entry = entry.replace(data=data, variants=variants)
+		self.memory.put(entry)
+		return entry
+
+	def revalidate(self, entry, **validators):
+		''' The origin says `entry` is unchanged (a 304, or the same body): fresh again, without rewriting its data '''
+		revalidated = self.disk.touch(entry, **validators).replace(data=entry.data, variants=entry.variants)
+		self.memory.put(revalidated)
+		return revalidated
+
+	def negotiate(self, entry, accept_encoding):
+		''' (Content-Encoding or None, data, path) of the variant of `entry` to send for an Accept-Encoding header
+
+		data is None when only the disk tier holds the object, send the file at path then.
+		'''
+		encoding = choose_encoding(accept_encoding, entry.encodings)
+		if encoding is None:
+			return None, entry.data, entry.path
+		if entry.variants is not None:
+			return encoding, entry.variants[encoding], entry.variant_path(encoding)
+		return encoding, None, entry.variant_path(encoding)
+
+	def get_partial(self, key):
+		''' The fresh PartialObject of `key`, an expired one is dropped '''
+		partial = self.disk.get_partial(key)
+		if partial is not None and not self.fresh(partial):
+			self.disk.discard_partial(key)
+			return None
+		return partial
+
+	def put_partial(self, key, suffix, size, etag=None, last_modified=None):
+		return self.disk.put_partial(key, suffix, size, etag, last_modified)
+
+	def complete_partial(self, partial):
+		return self.disk.complete_partial(partial)
+
+	def sweep_partials(self):
+		''' Drop the expired partially cached objects, returns (PartialObject, disk size) of the others '''
+		partials = []
+		for (partial, disk_size) in self.disk.partials():
+			if self.fresh(partial):
+				partials.append((partial, disk_size))
+			else:
+				self.disk.discard_partial(partial.key)
+		return partials
+
+	def discard(self, key):
+		self.memory.discard(key)
+		self.disk.discard(key)
+
+	def meta(self, key):
+		''' The entry of `key` with its url and tags, read from its .meta file '''
+		return self.disk.read_meta(self.disk.path(key) + '.meta')
+
+class Flight(object):
+	''' A fetch in progress, the threads waiting for it share its result '''
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+class SingleFlight(object):
+	''' At most one fetch per key in flight: one per key across threads (a table of flights), one per lock stripe across processes (flock on files in `lock_dir`) '''
+
+	def __init__(self, lock_dir, stripes=FLIGHT_LOCK_STRIPES, wait_timeout=FLIGHT_WAIT_TIMEOUT):
+		self.lock_dir = lock_dir
+		self.stripes = stripes
+		self.wait_timeout = wait_timeout
+		self.flights = {}
+		self.lock = threading.Lock()
+
+		os.makedirs(lock_dir, exist_ok=True)
+
+	def do(self, key, fetch, recheck):
+		''' fetch() unless a thread or process is already fetching `key`, in which case share its result
+
+		recheck() looks the key up again once another process's fetch finished, fetch() only runs when it finds nothing.
+		'''
+		with self.lock:
+			flight = self.flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self.flights[key] = Flight()
+
+		if not leader:
+			flight.done.wait()
+			if flight.error is not None:
+				raise flight.error
+			return flight.result
+
+		try:
+			flight.result = self.fetch_once(key, fetch, recheck)
+			return flight.result
+		except Exception as e:
+			flight.error = e
+			raise
+		finally:
+			with self.lock:
+				del self.flights[key]
+			flight.done.set()
+
+	def do_async(self, key, fetch, recheck):
+		''' do() in a background thread, unless `key` is already being fetched '''
+		with self.lock:
+			if key in self.flights:
+				return
+
+		def run():
+			try:
+				self.do(key, fetch, recheck)
+			except Exception as e:
+				logger.warning('Background refresh of %s failed: %s' % (key, e))
+
+		thread = threading.Thread(target=run)
+		thread.daemon = True
+		thread.start()
+
+	def fetch_once(self, key, fetch, recheck):
+		''' fetch() holding the key's lock file, unless another process filled the cache while we waited for it '''
+		lock_file = self.acquire_lock_file(key)
+		try:
+			if lock_file is not None and lock_file.waited:
+				result = recheck()
+				if result:
+					return result
+			return fetch()
+		finally:
+			if lock_file is not None:
+				lock_file.close()
+
+	def acquire_lock_file(self, key):
+		if fcntl is None:
+			return None
+
+		stripe = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % self.stripes
+		lock_file = open(os.path.join(self.lock_dir, '%04d.lock' % (stripe,)), 'wb')
+		lock_file.waited = False
+		deadline = time.time() + self.wait_timeout
+		while True:
+			try:
+				fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				return lock_file
+			except BlockingIOError:
+				if time.time() > deadline:
+					# the other fetch is stuck, do not wait on it forever
+					lock_file.close()
+					return None
+				lock_file.waited = True
+				time.sleep(.05)
+
+def ttls_from_setting(setting):
+	''' Suffix -> TTL in seconds, from the *_expired times of a DomainSetting '''
+	ttls = {}
+	for suffix, attr in TTL_SETTINGS.items():
+		if getattr(setting, attr, None) is not None:
+			ttls[suffix] = getattr(setting, attr)
+	return ttls
+
+def create_cache(setting):
+	memory = MemoryCache(setting.cache_memory_size or MEMORY_CACHE_SIZE, setting.cache_memory_max_object or MEMORY_MAX_OBJECT_SIZE)
+	disk = DiskCache(setting.cache_dir)
+	default_ttl = setting.common_expired if setting.common_expired is not None else DEFAULT_TTL
+	stale_while_revalidate = setting.cache_stale_while_revalidate if setting.cache_stale_while_revalidate is not None else STALE_WHILE_REVALIDATE
+	stale_if_error = setting.cache_stale_if_error if setting.cache_stale_if_error is not None else STALE_IF_ERROR
+	return TieredCache(memory, disk, ttls_from_setting(setting), default_ttl, stale_while_revalidate, stale_if_error)
+
+def create_flights(setting):
+	return SingleFlight(os.path.join(setting.cache_dir, '.locks'))
+
+# the cache of the running app and its page fetches in flight, set up by create_app()
+page_cache = None
+page_flights = None
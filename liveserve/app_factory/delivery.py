@@ -0,0 +1,222 @@
+
+import os
+import time
+import threading
+from datetime import datetime, timezone
+from logging import getLogger
+from collections import OrderedDict
+
+from flask import Response
+from werkzeug.http import http_date, parse_date, quote_etag, unquote_etag, is_resource_modified
+from werkzeug.wsgi import wrap_file
+
+logger = getLogger(__name__)
+
+# open descriptors kept for hot cached objects, and seconds one is trusted before its path is checked again
+OPEN_FILE_CACHE_SIZE = 1024
+OPEN_FILE_VALID = 5
+# bytes read at a time when the WSGI server cannot sendfile() for us
+SEND_BLOCK_SIZE = 64 * 1024
+
+class OpenFile(object):
+	''' One open descriptor of a cached object, with what fstat() said about it when it was opened '''
+
+	def __init__(self, path, fd):
+		self.path = path
+		self.fd = fd
+		stat = os.fstat(fd)
+		self.inode = (stat.st_dev, stat.st_ino)
+		self.size = stat.st_size
+		self.checked = time.time()
+
+	def close(self):
+		os.close(self.fd)
+
+class OpenFileCache(object):
+	''' Open descriptors of hot cached objects, so a hit costs neither an open() nor an fstat()
+
+	A descriptor is lent to one response at a time, each has a file offset of its own which sendfile() starts from,
+	and comes back when the response is closed. Cache files are replaced and never rewritten in place, so an idle
+	descriptor is trusted for `valid` seconds and then kept only while its path still names the same inode.
+	'''
+
+	def __init__(self, max_open=OPEN_FILE_CACHE_SIZE, valid=OPEN_FILE_VALID):
+		self.max_open = max_open
+		self.valid = valid
+		self.lock = threading.Lock()
+		# path -> idle OpenFiles, least recently returned path first
+		self.idle = OrderedDict()
+		self.count = 0
+
+	def acquire(self, path):
+		open_file = None
+		with self.lock:
+			idle = self.idle.get(path)
+			if idle:
+				open_file = idle.pop()
+				self.count -= 1
+				if not idle:
+					del self.idle[path]
+
+		if open_file is not None and time.time() - open_file.checked > self.valid:
+			try:
+				stat = os.stat(path)
+			except OSError:
+				stat = None
+			if stat is None or (stat.st_dev, stat.st_ino) != open_file.inode:
+				open_file.close()
+				open_file = None
+			else:
+				open_file.checked = time.time()
+
+		if open_file is None:
+			open_file = OpenFile(path, os.open(path, os.O_RDONLY))
+		return open_file
+
+	def release(self, open_file):
+		evicted = []
+		with self.lock:
+			self.idle.setdefault(open_file.path, []).append(open_file)
+			self.idle.move_to_end(open_file.path)
+			self.count += 1
+			while self.count > self.max_open:
+				(path, idle) = next(iter(self.idle.items()))
+				evicted.append(idle.pop(0))
+				self.count -= 1
+				if not idle:
+					del self.idle[path]
+
+		for open_file in evicted:
+			open_file.close()
+
+	def close(self):
+		with self.lock:
+			idle = [open_file for files in self.idle.values() for open_file in files]
+			self.idle.clear()
+			self.count = 0
+		for open_file in idle:
+			open_file.close()
+
+class FileRange(object):
+	''' Bytes [start, start + length) of an OpenFile, as the file object of a WSGI file_wrapper
+
+	Servers that sendfile() (gunicorn) take fileno() and send Content-Length bytes from the current offset,
+	which is set to `start` here; the others read() it, which goes through pread() and stops at the end of the range.
+	'''
+
+	def __init__(self, open_files, open_file, start, length):
+		self.open_files = open_files
+		self.open_file = open_file
+		self.position = start
+		self.end = start + length
+		os.lseek(open_file.fd, start, os.SEEK_SET)
+
+	def fileno(self):
+		return self.open_file.fd
+
+	def read(self, size=-1):
+		if self.open_file is None:
+			return b''
+		remaining = self.end - self.position
+		if size is None or size < 0 or size > remaining:
+			size = remaining
+		data = os.pread(self.open_file.fd, size, self.position) if size > 0 else b''
+		self.position += len(data)
+		return data
+
+	def close(self):
+		if self.open_file is not None:
+			self.open_files.release(self.open_file)
+			self.open_file = None
+
+def entry_validators(entry, encoding=None):
+	''' (ETag, Last-Modified datetime) of a cached object, each encoding a representation of its own '''
+	if entry.etag:
+		tag = unquote_etag(entry.etag)[0]
+	else:
+		tag = '%x-%x' % (int(entry.stored_at), entry.size)
+	if encoding is not None:
+		tag = '%s-%s' % (tag, encoding)
+
+	last_modified = parse_date(entry.last_modified) if entry.last_modified else None
+	if last_modified is None:
+		last_modified = datetime.fromtimestamp(int(entry.stored_at), timezone.utc)
+	return tag, last_modified
+
+def range_allowed(request, tag, last_modified):
+	''' False when an If-Range says the client holds another version, send it all then '''
+	if_range = request.if_range
+	if if_range.etag is not None:
+		return if_range.etag == tag
+	if if_range.date is not None:
+		return last_modified <= if_range.date
+	return True
+
+def deliver(request, open_files, entry, encoding, data, path):
+	''' The response for a cache hit: a 304 when the client's copy is current, 206 for a Range, from memory or by sendfile()
+
+	None when the file at `path` is gone, evicted or purged since the entry was looked up.
+	'''
+	(tag, last_modified) = entry_validators(entry, encoding)
+	headers = {'ETag': quote_etag(tag), 'Last-Modified': http_date(last_modified), 'Accept-Ranges': 'bytes'}
+
+	if not is_resource_modified(request.environ, tag, last_modified=last_modified):
+		return Response(status=304, headers=headers)
+
+	open_file = None
+	if data is None:
+		try:
+			open_file = open_files.acquire(path)
+		except FileNotFoundError:
+			return None
+		length = open_file.size
+	else:
+		length = len(data)
+
+	(start, stop, status) = (0, length, 200)
+	if request.range is not None and range_allowed(request, tag, last_modified):
+		byte_range = request.range.range_for_length(length)
+		if byte_range is not None:
+			(start, stop, status) = (byte_range[0], byte_range[1], 206)
+			headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, length)
+		elif len(request.range.ranges) == 1:
+			# several ranges we just ignore and send it all, one we cannot satisfy is an error
+			if open_file is not None:
+				open_files.release(open_file)
+			headers['Content-Range'] = 'bytes */%d' % (length,)
+			return Response(status=416, headers=headers, mimetype=entry.content_type)
+
+	# only a response with a body is encoded
+	if encoding is not None:
+		headers['Content-Encoding'] = encoding
+	if open_file is None:
+		return Response(data[start:stop], status=status, headers=headers, mimetype=entry.content_type)
+	return file_response(request, open_files, open_file, start, stop, status, headers, entry.content_type)
+
+def deliver_partial(request, open_files, partial, bounds):
+	''' The 206 for a Range answered from the cached slices of a PartialObject, 416 when `bounds` is None
+
+	None when the slices are gone, another process made a whole object of them since.
+	'''
+	(tag, last_modified) = entry_validators(partial)
+	headers = {'ETag': quote_etag(tag), 'Last-Modified': http_date(last_modified), 'Accept-Ranges': 'bytes'}
+	if bounds is None:
+		headers['Content-Range'] = 'bytes */%d' % (partial.size,)
+		return Response(status=416, headers=headers, mimetype=partial.content_type)
+
+	try:
+		open_file = open_files.acquire(partial.path)
+	except FileNotFoundError:
+		return None
+	(start, stop) = bounds
+	headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, partial.size)
+	return file_response(request, open_files, open_file, start, stop, 206, headers, partial.content_type)
+
+def file_response(request, open_files, open_file, start, stop, status, headers, mimetype):
+	body = wrap_file(request.environ, FileRange(open_files, open_file, start, stop - start), SEND_BLOCK_SIZE)
+	response = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+	response.content_length = stop - start
+	return response
+
+# the open descriptors of the running app, set up by create_app()
+open_files = None
@@ -0,0 +1,176 @@
+
+import os
+import time
+import threading
+from logging import getLogger
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+logger = getLogger(__name__)
+
+# what the disk tier may hold by default
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024 * 1024
+DEFAULT_MAX_ENTRIES = 1000000
+DEFAULT_POLICY = 'tinylfu'
+# seconds between two checks of the budget, and the share of it an eviction pass frees the cache down to
+EVICTION_INTERVAL = 2
+EVICTION_LOW_WATER = 0.9
+# seconds between two sweeps of the partially cached objects, which are not in the index
+PARTIAL_SWEEP_INTERVAL = 300
+
+def lru_victims(records, sketch, since):
+	''' Least recently used first '''
+	return sorted(records, key=lambda record: record.accessed_at)
+
+def lfu_victims(records, sketch, since):
+	''' Least hit first, the least recently used of those first '''
+	return sorted(records, key=lambda record: (record.hits, record.accessed_at))
+
+def tinylfu_victims(records, sketch, since):
+	''' Least recently used first, unless the sketch says the victim is asked for more often than the newest arrival
+
+	The arrivals (objects stored since the last pass, least asked for first) are the candidates for admission: one that
+	is asked for less often than the object it would push out goes instead, so one-off requests cannot flush the cache.
+	'''
+	lru = sorted(records, key=lambda record: record.accessed_at)
+	arrivals = sorted((record for record in records if record.stored_at >= since), key=lambda record: sketch.estimate(record.key))
+
+	evicted = set()
+	(victim_index, arrival_index) = (0, 0)
+	while victim_index < len(lru):
+		victim = lru[victim_index]
+		if victim.key in evicted:
+			victim_index += 1
+			continue
+		while arrival_index < len(arrivals) and arrivals[arrival_index].key in evicted:
+			arrival_index += 1
+
+		if arrival_index < len(arrivals) and arrivals[arrival_index].key != victim.key and sketch.estimate(arrivals[arrival_index].key) < sketch.estimate(victim.key):
+			chosen = arrivals[arrival_index]
+		else:
+			chosen = victim
+			victim_index += 1
+		evicted.add(chosen.key)
+		yield chosen
+
+EVICTION_POLICIES = {
+	'lru': lru_victims,
+	'lfu': lfu_victims,
+	'tinylfu': tinylfu_victims,
+}
+
+class Evictor(threading.Thread):
+	''' Keeps the disk tier of a TieredCache within a byte and an entry budget, in the background
+
+	Every worker process runs one, the one that gets the eviction lock does the pass, the others skip it.
+	A pass starts once either budget is exceeded and evicts, in the order of the policy, down to `low_water` of both.
+	Partially cached objects count against both budgets as of the last sweep of them, which drops the expired ones.
+	When evicting every whole object is not enough, the oldest of them go too.
+	'''
+
+	def __init__(self, cache, max_size=DEFAULT_MAX_SIZE, max_entries=DEFAULT_MAX_ENTRIES, policy=DEFAULT_POLICY, interval=EVICTION_INTERVAL, low_water=EVICTION_LOW_WATER, sweep_interval=PARTIAL_SWEEP_INTERVAL):
+		threading.Thread.__init__(self)
+		self.daemon = True
+
+		if policy not in EVICTION_POLICIES:
+			logger.error('Unknown eviction policy "%s", using "%s"' % (policy, DEFAULT_POLICY))
+			policy = DEFAULT_POLICY
+
+		self.cache = cache
+		self.max_size = max_size
+		self.max_entries = max_entries
+		self.policy = policy
+		self.interval = interval
+		self.low_water = low_water
+		self.last_pass = time.time()
+		self.sweep_interval = sweep_interval
+		self.last_sweep = 0
+		self.partials = []
+		self.stopped = threading.Event()
+		self.lock_path = os.path.join(cache.disk.cache_dir, '.locks', 'evict.lock')
+
+	def stop(self):
+		self.stopped.set()
+
+	def over_budget(self):
+		index = self.cache.disk.index
+		partial_size = sum(disk_size for (_, disk_size) in self.partials)
+		return index.disk_size() + partial_size > self.max_size or len(index) + len(self.partials) > self.max_entries
+
+	def sweep(self):
+		self.partials = self.cache.sweep_partials()
+		self.last_sweep = time.time()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			try:
+				if time.time() - self.last_sweep > self.sweep_interval:
+					self.sweep()
+				if self.over_budget():
+					self.evict_locked()
+			except Exception as e:
+				logger.error('Cache eviction failed: %s' % (e,))
+
+	def evict_locked(self):
+		''' evict() unless another process is already at it '''
+		if fcntl is None:
+			return self.evict()
+
+		os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+		with open(self.lock_path, 'wb') as lock_file:
+			try:
+				fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				return 0
+			return self.evict()
+
+	def evict(self):
+		''' One eviction pass, returns the number of objects evicted '''
+		started = time.time()
+		self.sweep()
+		index = self.cache.disk.index
+		records = index.entries()
+		(size, entries) = (sum(record.disk_size for record in records), len(records))
+		size += sum(disk_size for (_, disk_size) in self.partials)
+		entries += len(self.partials)
+		(target_size, target_entries) = (self.max_size * self.low_water, self.max_entries * self.low_water)
+
+		(evicted, evicted_bytes) = (0, 0)
+		for record in EVICTION_POLICIES[self.policy](records, self.cache.disk.sketch, self.last_pass):
+			if size <= target_size and entries <= target_entries:
+				break
+			self.cache.discard(record.key)
+			size -= record.disk_size
+			entries -= 1
+			evicted += 1
+			evicted_bytes += record.disk_size
+
+		# a slice being written into an evicted partial fails and is fetched again, as when it expires
+		partials = sorted(self.partials, key=lambda item: item[0].stored_at)
+		while partials and (size > target_size or entries > target_entries):
+			(partial, disk_size) = partials.pop(0)
+			self.cache.disk.discard_partial(partial.key)
+			size -= disk_size
+			entries -= 1
+			evicted += 1
+			evicted_bytes += disk_size
+		self.partials = partials
+
+		self.last_pass = started
+		self.cache.stats.count('evictions', evicted)
+		self.cache.stats.count('evicted_bytes', evicted_bytes)
+		logger.info('Evicted %d objects (%d bytes) in %.2fs by %s, %s' % (evicted, evicted_bytes, time.time() - started, self.policy, self.cache.stats))
+		return evicted
+
+def create_evictor(setting, cache):
+	return Evictor(
+		cache,
+		setting.cache_max_size if setting.cache_max_size is not None else DEFAULT_MAX_SIZE,
+		setting.cache_max_entries if setting.cache_max_entries is not None else DEFAULT_MAX_ENTRIES,
+		setting.cache_eviction or DEFAULT_POLICY)
+
+# the evictor of the running app, started by create_app()
+page_evictor = None
@@ -0,0 +1,117 @@
+
+import re
+
+# attributes holding one url, as lxml.html.defs.link_attrs
+LINK_ATTRIBUTES = frozenset(['action', 'background', 'cite', 'classid', 'codebase', 'data', 'dynsrc', 'formaction', 'href', 'longdesc', 'lowsrc', 'profile', 'src', 'usemap', 'xlink:href'])
+# elements whose content is text, not markup; links in a <style> are still rewritten
+RAW_TEXT_ELEMENTS = ('script', 'style', 'textarea', 'title')
+
+# the markup tokens that may need rewriting: a comment (never), a raw text element with its content, or a start tag
+# followed by the origin before the next '<' (or holding a '<' itself). Other tags never reach python code, which is what makes it fast
+# The attributes are matched a character (or a quoted value) at a time, one way only: a tag that never closes fails in
+# linear time instead of backtracking through every way of splitting it, and is left as it is
+TOKEN_PATTERN = r'''
+	<!--.*?-->
+	| <(?P<raw>%s)\b(?P<raw_attrs>(?:[^'"<>]|"[^"]*"|'[^']*')*)>(?P<raw_text>.*?)</(?P=raw)\s*>
+	| <(?P<tag>[a-zA-Z][^\s/>]*)(?=[^<]*?%%(origin)s|[^>]*<)(?P<attrs>(?:[^'"<>]|"[^"]*"|'[^']*')*)>
+''' % ('|'.join(RAW_TEXT_ELEMENTS),)
+# an attribute that may hold a link to the origin
+ATTRIBUTE_PATTERN = r'''(?<![^\s"'])(?P<name>%s)(?P<equals>\s*=\s*)(?P<value>"[^"]*?%%(origin)s[^"]*"|'[^']*?%%(origin)s[^']*'|[^\s"'=<>`]*?%%(origin)s[^\s"'=<>`]*)''' % (
+	'|'.join(re.escape(name) for name in sorted(LINK_ATTRIBUTES | set(['style', 'archive', 'content']))),)
+
+class LinkRewriter(object):
+	''' Points the links to the origin domain (and its subdomains) at the proxy domain, every other link is left as it is
+
+	rewrite_html() does it in one pass over the markup, rewrite_dom() through the lxml tree as before.
+	'''
+
+	def __init__(self, origin_domain, target_domain, target_port=None):
+		self.origin_domain = origin_domain.lower()
+		self.target_domain = target_domain
+		self.target_port = int(target_port) if target_port else None
+
+		# scheme (or scheme relative //), optional subdomains, the origin, optional port, then the end of the host
+		origin_url = r'((?:https?:)?//)((?:[\w-]+\.)*?)%s(?::\d+)?(?=[/?#&\s"\')]|$)' % (re.escape(origin_domain),)
+		self.url_re = re.compile(r'^(\s*)' + origin_url, re.I)
+		# urls inside a css text or a meta refresh, wherever they start
+		self.embedded_url_re = re.compile(r'(^|[\s"\'(=,;])' + origin_url, re.I)
+		self.token_re = re.compile(TOKEN_PATTERN % {'origin': re.escape(origin_domain)}, re.S | re.I | re.X)
+		self.attribute_re = re.compile(ATTRIBUTE_PATTERN % {'origin': re.escape(origin_domain)}, re.I)
+		self.netlocs = {}
+
+	def target_netloc(self, subdomains):
+		netloc = self.netlocs.get(subdomains)
+		if netloc is None:
+			if self.target_port in (None, 80, 443):
+				netloc = '%s%s' % (subdomains, self.target_domain)
+			else:
+				netloc = '%s%s:%d' % (subdomains, self.target_domain, self.target_port)
+			self.netlocs[subdomains] = netloc
+		return netloc
+
+	def _replace_url(self, match):
+		return '%s%s%s' % (match.group(1), match.group(2), self.target_netloc(match.group(3)))
+
+	def rewrite_url(self, url):
+		match = self.url_re.match(url)
+		if match is None:
+			return url
+		# like lxml, a rewritten link loses its surrounding whitespace
+		return (match.group(2) + self.target_netloc(match.group(3)) + url[match.end():]).strip()
+
+	def rewrite_text(self, text):
+		''' Every origin url in a css text (style) or a meta refresh content '''
+		return self.embedded_url_re.sub(self._replace_url, text)
+
+	def rewrite_attributes(self, tag, attrs):
+		is_refresh = tag == 'meta' and re.search(r'http-equiv\s*=\s*["\']?refresh', attrs, re.I) is not None
+
+		def replace(match):
+			name = match.group('name').lower()
+			if name in LINK_ATTRIBUTES:
+				rewrite = self.rewrite_url
+			elif name == 'style' or name == 'archive' or (name == 'content' and is_refresh):
+				rewrite = self.rewrite_text
+			else:
+				return match.group(0)
+
+			value = match.group('value')
+			if value[:1] in ('"', "'"):
+				new_value = value[0] + rewrite(value[1:-1]) + value[-1]
+			else:
+				new_value = rewrite(value)
+			if new_value == value:
+				return match.group(0)
+			return match.group('name') + match.group('equals') + new_value
+
+		return self.attribute_re.sub(replace, attrs)
+
+	def _replace_token(self, match):
+		raw = match.group('raw')
+		if raw is not None:
+			attrs = self.rewrite_attributes(raw.lower(), match.group('raw_attrs'))
+			text = match.group('raw_text')
+			if raw.lower() == 'style':
+				text = self.rewrite_text(text)
+			close_start = match.end('raw_text') - match.start(0)
+			return '<%s%s>%s%s' % (raw, attrs, text, match.group(0)[close_start:])
+
+		tag = match.group('tag')
+		if tag is None or self.origin_domain not in match.group('attrs').lower():
+			# a comment, or nothing to rewrite
+			return match.group(0)
+		return '<%s%s>' % (tag, self.rewrite_attributes(tag.lower(), match.group('attrs')))
+
+	def rewrite_html(self, page_content):
+		''' Rewrite the links of an html page (str) in a single pass, no tree is built '''
+		if self.target_domain is None or self.origin_domain not in page_content.lower():
+			return page_content
+		return self.token_re.sub(self._replace_token, page_content)
+
+	def rewrite_dom(self, page_content):
+		''' Rewrite the links of an html page (str) through the lxml tree, returns utf-8 bytes '''
+		from lxml import html
+
+		page_tree = html.document_fromstring(page_content)
+		page_tree.rewrite_links(self.rewrite_url, resolve_base_href=False)
+		return html.tostring(page_tree, encoding='utf-8')
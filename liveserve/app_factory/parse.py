@@ -1,44 +1,134 @@
 
 
+import re
 import requests
 import hashlib
-import os
-import time
-from lxml import html
-from . import caching, app_setting
+from logging import getLogger
+from . import caching, app_setting, app_config
+from .linkrewrite import LinkRewriter
+from .urlprocessing import remember_url_suffix, page_request_headers, CLASSIFIED_SUFFIXES
+
+logger = getLogger(__name__)
+
+# the suffix of an object whose suffix is not a short [a-z0-9]+, the last dot segment of its path may be anything
+FALLBACK_SUFFIX = 'bin'
+SUFFIX_PATTERN = re.compile(r'^[a-z0-9]{1,8}$')
+
+def parse_content_range(value):
+	''' (start, size) from a "bytes start-end/size" Content-Range, None when it is not one '''
+	try:
+		(unit, _, spec) = value.partition(' ')
+		(span, _, size) = spec.partition('/')
+		if unit != 'bytes' or size == '*':
+			return None
+		return int(span.partition('-')[0]), int(size)
+	except (AttributeError, ValueError):
+		return None
+
+def cache_suffix(suffix):
+	''' `suffix` as objects are cached under it, keys stay short file names and the index holds the suffix '''
+	suffix = (suffix or '').lower()
+	return suffix if SUFFIX_PATTERN.match(suffix) else FALLBACK_SUFFIX
+
+def cache_key(url, suffix):
+	''' The name `url` is cached under '''
+	return "%s.%s" % (hashlib.md5(url.encode('utf-8')).hexdigest(), suffix)
+
+def cached_suffix(url):
+	''' The suffix the page at `url` is cached under (fresh or not), None when it is not cached '''
+	for suffix in CLASSIFIED_SUFFIXES:
+		if caching.page_cache.disk.index.get(cache_key(url, suffix)) is not None:
+			return suffix
+	return None
+
+def surrogate_keys(headers):
+	''' The tags an origin gave a response to purge it by: Surrogate-Key (space separated) and Cache-Tag (comma separated) '''
+	tags = (headers.get('surrogate-key') or '').split()
+	tags += [tag.strip() for tag in (headers.get('cache-tag') or '').split(',') if tag.strip()]
+	return tags
 
 class PageParse(object):
 
 	def __init__(self, new_path, suffix, **kwargs):
-		md5_val = hashlib.md5(new_path.encode('utf-8')).hexdigest()
 		self.headers = kwargs['headers']
 		self.url = new_path
-		self.file_name = "%s%s" % (md5_val, ".%s" % (suffix))
+		self.suffix = cache_suffix(suffix)
+		self.file_name = cache_key(new_path, self.suffix)
+		self.entry = None
+		# the GET the url was classified by, the first fetch of the page uses it
+		self.response = kwargs.get('response')
+		# our expired copy of the page, revalidated with the origin instead of fetched whole
+		self.stale = None
 
 	def __str__(self):
 		return self.get_file()
 
 	def get_file(self):
-		path = self._is_cached()
-		return path if path else self.get_content()
+		return self.file_name if self._is_cached() else self.get_content()
 
-	def _is_cached(self, expired_time):
-		''' Check if the current url is cached in the static directory '''
-		file_path = "%s%s" % (cache_dir, self.file_name)
-		if not os.path.isfile(file_path):
-			return False
+	def get_entry(self):
+		''' The cached page, fetched first if needed. None when it could not be fetched '''
+		entry = self._is_cached()
+		if entry:
+			return entry
 
-		modfified_time = os.path.getmtime(file_path)
-		cur_time = time.time()
-		if cur_time - modfified_time < expired_time:
-			return self.file_name
-		else:
+		# stale-while-revalidate: answer with the expired copy now, refresh it in the background
+		self.stale = caching.page_cache.get_stale(self.file_name, caching.page_cache.stale_while_revalidate)
+		if self.stale is not None:
+			caching.page_flights.do_async(self.file_name, self._fetch_entry, self._is_cached)
+			return self.stale
+
+		# when a popular page expires, only one request (in any worker process) fetches it again
+		self.stale = caching.page_cache.get_stale(self.file_name, caching.page_cache.stale_if_error)
+		return caching.page_flights.do(self.file_name, self._fetch_entry, self._is_cached)
+
+	def get_partial(self, byte_range):
+		''' (PartialObject, bounds) to answer a client's Range from cached slices, None to answer it from the whole page '''
+		return None
+
+	def _fetch_entry(self):
+		self.get_content()
+		# stale-if-error: an expired copy beats an error page
+		return self.entry or self.stale
+
+	def _get(self):
+		''' GET the page, unless get_url_suffix() already did '''
+		(res, self.response) = (self.response, None)
+		if res is None:
+			res = requests.get(self.url, headers=self._request_headers())
+		return res
+
+	def _request_headers(self):
+		''' The client's headers, made conditional on the validators of our expired copy '''
+		headers = page_request_headers(self.headers)
+		if self.stale is not None:
+			if self.stale.etag:
+				headers['If-None-Match'] = self.stale.etag
+			if self.stale.last_modified:
+				headers['If-Modified-Since'] = self.stale.last_modified
+		return headers
+
+	def _revalidated(self, res):
+		''' Keep our expired copy when the origin says it did not change, True if it did so '''
+		if res.status_code != 304 or self.stale is None:
 			return False
+		self.entry = caching.page_cache.revalidate(self.stale)
+		return True
 
-	def _cache_file(self, page_content):
-		''' Save html, js or css file to cache and return the path of the file '''
-		with open("%s%s" % (cache_dir, self.file_name), 'wb') as file:
-			file.write(page_content)
+	def _is_cached(self, expired_time=None):
+		''' Check if the current url is cached and younger than `expired_time` (by default the TTL of its content type) '''
+		entry = caching.page_cache.get(self.file_name, expired_time)
+		return entry if entry is not None else False
+
+	def _cache_file(self, page_content, res=None, source_digest=None):
+		''' Save html, js or css file to cache and return the name of the file '''
+		etag = last_modified = None
+		tags = []
+		if res is not None:
+			etag = res.headers.get('etag')
+			last_modified = res.headers.get('last-modified')
+			tags = surrogate_keys(res.headers)
+		self.entry = caching.page_cache.put(self.file_name, self.suffix, page_content, etag, last_modified, source_digest, self.url, tags)
 		return self.file_name
 
 class HTMLParse(PageParse):
@@ -49,12 +139,24 @@ class HTMLParse(PageParse):
 	def get_content(self):
 		''' Get the url's content from the replaced url and do modifications '''
 		try:
-			res = requests.get(self.url, headers=self.headers)
-		except:
-			pass
+			res = self._get()
+		except requests.RequestException:
+			return 'templates/400.html'
+
+		# unchanged upstream, no need to parse and rewrite it again
+		if self._revalidated(res):
+			return self.file_name
 
 		if res.status_code != 200:
 			return 'templates/400.html'
+		# classify the url by what it really is, next time it needs no HEAD request
+		remember_url_suffix(self.url, res)
+
+		# the origin ignored our validators but sent the same page, our rewrite of it still holds
+		source_digest = hashlib.md5(res.content).hexdigest()
+		if self.stale is not None and self.stale.source_digest == source_digest:
+			self.entry = caching.page_cache.revalidate(self.stale, etag=res.headers.get('etag'), last_modified=res.headers.get('last-modified'))
+			return self.file_name
 
 		# the encoding of the page is by default ISO-8859-1 if no charset is specified
 		# in the header
@@ -62,18 +164,140 @@ class HTMLParse(PageParse):
 			res.encoding = res.apparent_encoding
 		page_content = res.text
 
-		# generate a string from the html document 
-		page_tree = html.document_fromstring(page_content)
-		# dynamically change links in the page
-		page_tree = self._convert_links(page_tree)
+		# dynamically change links in the page, the rewritten page is what gets cached
+		page_content = self._convert_links(page_content)
 
-		# generate the page from the modified page tree
-		page_content = html.tostring(page_tree, encoding="utf-8")
 		# cache the file
-		return self._cache_file(page_content)
+		return self._cache_file(page_content, res, source_digest)
+
+	def _convert_links(self, page_content):
+		''' Point the links to the origin at us, returns the page as utf-8 bytes
+
+		In one pass over the markup, or through the lxml tree when the `link_rewrite` setting is "dom"
+		'''
+		rewriter = LinkRewriter(app_config.proxy_domain, app_config.server_domain, app_config.server_port)
+		if app_config.link_rewrite == 'dom':
+			return rewriter.rewrite_dom(page_content)
+		return rewriter.rewrite_html(page_content).encode('utf-8')
+
+class ObjectParse(PageParse):
+	''' Objects cached as the origin sends them
+
+	A Range of one that is not cached whole is answered from slices of it, fetched from the origin as clients ask for them,
+	so a video plays (and seeks) without waiting for the whole file.
+	'''
+
+	def get_content(self):
+		try:
+			res = self._get()
+		except requests.RequestException:
+			return 'templates/400.html'
+
+		if self._revalidated(res):
+			return self.file_name
+		if res.status_code != 200:
+			return 'templates/400.html'
+		remember_url_suffix(self.url, res)
+		return self._cache_file(res.content, res)
+
+	def get_partial(self, byte_range):
+		''' (PartialObject, bounds) with the slices a client's Range covers cached, None to answer it from the whole object
+
+		bounds is the [start, stop) to send, None when the Range cannot be satisfied.
+		'''
+		if len(byte_range.ranges) != 1 or self._is_cached():
+			return None
+		(start, stop) = byte_range.ranges[0]
+
+		partial = caching.page_cache.get_partial(self.file_name)
+		if partial is None:
+			if self.response is not None:
+				# not the whole object, the slices are fetched instead
+				self.response.close()
+				self.response = None
+			first = max(start, 0) // caching.PARTIAL_CHUNK_SIZE
+			partial = caching.page_flights.do(self.file_name + '.part', lambda: self._start_partial(first), lambda: caching.page_cache.get_partial(self.file_name))
+			if partial is None:
+				return None
+
+		if start < 0:
+			bounds = partial.bounds(max(0, partial.size + start), partial.size - 1)
+		else:
+			bounds = partial.bounds(start, None if stop is None else stop - 1)
+		if bounds is None:
+			return partial, None
+
+		for index in partial.missing(*bounds):
+			filled = caching.page_flights.do('%s#%d' % (self.file_name, index), lambda: self._fetch_chunk(partial, index), lambda: not partial.missing(*partial.chunk_bounds(index)))
+			if not filled:
+				return None
+
+		if partial.is_complete():
+			# every slice is here now, it is served as a whole object from now on
+			caching.page_cache.complete_partial(partial)
+			return None
+		return partial, bounds
+
+	def _range_headers(self, start, stop):
+		headers = self._request_headers()
+		headers['Range'] = 'bytes=%d-%d' % (start, stop - 1)
+		# the slices must be the bytes of the object itself
+		headers['Accept-Encoding'] = 'identity'
+		return headers
+
+	def _start_partial(self, index):
+		''' Fetch slice `index`, which tells the object's size. None when the origin cannot do ranges, the object is cached whole then '''
+		chunk_size = caching.PARTIAL_CHUNK_SIZE
+		try:
+			res = requests.get(self.url, headers=self._range_headers(index * chunk_size, (index + 1) * chunk_size))
+		except requests.RequestException:
+			return None
+
+		if res.status_code in (200, 206):
+			remember_url_suffix(self.url, res)
+		if res.status_code == 200:
+			self._cache_file(res.content, res)
+			return None
+		content_range = parse_content_range(res.headers.get('content-range'))
+		if res.status_code != 206 or content_range is None:
+			return None
+
+		partial = caching.page_cache.put_partial(self.file_name, self.suffix, content_range[1], res.headers.get('etag'), res.headers.get('last-modified'))
+		return partial if self._write_chunk(partial, index, res) else None
+
+	def _fetch_chunk(self, partial, index):
+		''' Fill slice `index` of `partial` from the origin, False when it failed or the object changed there '''
+		headers = self._range_headers(*partial.chunk_bounds(index))
+		# a weak etag cannot be used for If-Range
+		if partial.etag and not partial.etag.startswith('W/'):
+			headers['If-Range'] = partial.etag
+		elif partial.last_modified:
+			headers['If-Range'] = partial.last_modified
+
+		try:
+			res = requests.get(self.url, headers=headers)
+		except requests.RequestException:
+			return False
+
+		content_range = parse_content_range(res.headers.get('content-range'))
+		if res.status_code != 206 or content_range is None or content_range[1] != partial.size:
+			# the origin sent the whole, changed, object: start over
+			caching.page_cache.discard(self.file_name)
+			return False
+		return self._write_chunk(partial, index, res)
+
+	def _write_chunk(self, partial, index, res):
+		if parse_content_range(res.headers.get('content-range'))[0] != partial.chunk_bounds(index)[0]:
+			return False
+		try:
+			partial.write_chunk(index, res.content)
+		except (OSError, ValueError) as e:
+			logger.warning('Could not cache slice %d of %s: %s' % (index, self.url, e))
+			return False
+		return True
 
-	def _is_cached(self, expired=None):
-		return PageParse._is_cached(self, app_config.html_expired)
+class ImageParse(ObjectParse):
+	''' Images, cached as they are '''
 
-	def _convert_links(self, page_tree):
-		
\ No newline at end of file
+class CommonParse(ObjectParse):
+	''' Any other content type, cached as it is '''
@@ -0,0 +1,97 @@
+''' Purge and warm the page cache of a running server through its admin api
+
+	python -m liveserve.cache_admin --server http://127.0.0.1:5000 purge --prefix https://example.com/blog/
+	python -m liveserve.cache_admin --server http://127.0.0.1:5000 warmup --sitemap https://example.com/sitemap.xml
+
+Urls are the public ones, as clients ask for them: the server rewrites them to the proxied domain, as it does for a
+visit, before it looks them up. A --regex is matched against the rewritten url (http://<proxy domain>:<port>/...).
+A warmup runs in the background on the server, this waits for it to finish.
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import requests
+
+# seconds between two questions about a warmup in progress
+POLL_INTERVAL = 2
+
+def parse_args(argv=sys.argv[1:]):
+	parser = argparse.ArgumentParser(description='Purge and warm the page cache')
+	parser.add_argument('--server', dest='server', type=str, default='http://127.0.0.1:5000',
+						help='base url of the server (default: http://127.0.0.1:5000)')
+	parser.add_argument('--token', dest='token', type=str, default=os.environ.get('LIVESERVE_ADMIN_TOKEN'),
+						help='admin token of the server (default: $LIVESERVE_ADMIN_TOKEN)')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	purge = commands.add_parser('purge', help='drop cached objects, matching every criterion given')
+	purge.add_argument('--url', help='a public url, exactly')
+	purge.add_argument('--prefix', help='public urls starting with this')
+	purge.add_argument('--regex', help='urls this regular expression matches, once rewritten to the proxied domain')
+	purge.add_argument('--tag', help='objects the origin tagged so (Surrogate-Key or Cache-Tag)')
+
+	warmup = commands.add_parser('warmup', help='fetch pages into the cache')
+	warmup.add_argument('urls', nargs='*', help='public urls to fetch')
+	warmup.add_argument('--file', dest='url_file', help='a file of public urls, one per line')
+	warmup.add_argument('--sitemap', help='the url of a sitemap (or sitemap index) of the pages to fetch')
+	warmup.add_argument('--concurrency', type=int, default=8, help='pages fetched at once (default: 8)')
+	return parser.parse_args(argv)
+
+def call(args, path, body=None):
+	''' POST `body` to the admin api, or GET when there is none '''
+	method = requests.post if body is not None else requests.get
+	res = method(args.server.rstrip('/') + path, json=body, headers={'Authorization': 'Bearer %s' % (args.token or '',)})
+	try:
+		result = res.json()
+	except ValueError:
+		result = {'error': res.text.strip() or res.reason}
+	if res.status_code not in (200, 202):
+		print('%s failed (%d): %s' % (path, res.status_code, result.get('error', result)))
+		return None
+	return result
+
+def main(argv=sys.argv[1:]):
+	args = parse_args(argv)
+
+	if args.command == 'purge':
+		criteria = dict((name, getattr(args, name)) for name in ('url', 'prefix', 'regex', 'tag') if getattr(args, name))
+		if not criteria:
+			print('purge needs --url, --prefix, --regex or --tag')
+			return 2
+		result = call(args, '/_cache/purge', criteria)
+		if result is None:
+			return 1
+		print('purged %d objects' % (result['purged'],))
+		return 0
+
+	urls = list(args.urls)
+	if args.url_file:
+		with open(args.url_file) as f:
+			urls += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+	if not urls and not args.sitemap:
+		print('warmup needs urls, --file or --sitemap')
+		return 2
+	result = call(args, '/_cache/warmup', {'urls': urls, 'sitemap': args.sitemap, 'concurrency': args.concurrency})
+	if result is None:
+		return 1
+	job = result['job']
+	print('warmup %s started' % (job,))
+	result = {'state': 'running'}
+	while result['state'] == 'running':
+		time.sleep(POLL_INTERVAL)
+		result = call(args, '/_cache/warmup/%s' % (job,))
+		if result is None:
+			return 1
+
+	if result['state'] == 'failed':
+		print('warmup failed: %s' % (result['error'],))
+		return 1
+	print('warmed %d pages, %d failed, %d skipped' % (result['warmed'], len(result['failed']), result['skipped']))
+	for url in result['failed']:
+		print('  failed %s' % (url,))
+	return 0 if not result['failed'] else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,7 +1,14 @@
 
 
-import urlparse
+import time
 import requests
+import threading
+from collections import OrderedDict
+
+try:
+	import urlparse
+except ImportError:
+	from urllib import parse as urlparse
 
 def replace_domain(original_url, target_dom, port=80):
 	''' Replace the domain of the original url 
@@ -34,16 +41,66 @@ def remove_anchor(original_url):
 	result = urlparse.urlparse(original_url)
 	return result._replace(fragment=None).geturl()
 
-def get_url_suffix(path):
-	''' Get the requested type of resource
+# seconds a url keeps its classification, and a failed classification is remembered
+SUFFIX_CACHE_TTL = 600
+SUFFIX_NEGATIVE_TTL = 30
+# urls remembered at most, the oldest are forgotten first
+SUFFIX_CACHE_SIZE = 10000
 
-	Use HEAD request is to check the content type of the URL
-	We need to allow redirect in 'request.head' method, otherwise we may get wrong
-	info
-	'''
-	res = requests.head(path, allow_redirects=True)
-	content_type = res.headers.get('content-type', None) or res.headers.get('Content-Type', None)
+# extensions trusted without asking the origin, and the suffix they classify as
+STATIC_EXTENSIONS = {
+	'html': 'html',
+	'htm': 'html',
+	'jpg': 'jpg',
+	'jpeg': 'jpeg',
+	'png': 'png',
+	'gif': 'gif',
+	'ico': 'ico',
+	'css': 'css',
+	'js': 'js',
+}
+# what a Content-Type classifies as (content_type_suffix), the suffixes a page without a known extension is cached under
+CLASSIFIED_SUFFIXES = ('html', 'jpg', 'png', 'gif', 'css', 'js')
+# an error from the origin that says nothing else is answered as a page, with our error page
+ERROR_SUFFIX = 'html'
+# client headers left out of the fetch of a page, it is only made conditional on our own copy
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since', 'range', 'if-range')
+
+class SuffixCache(object):
+	''' url -> classified suffix, with a TTL. Urls the origin could not classify are remembered for negative_ttl only '''
+
+	def __init__(self, ttl=SUFFIX_CACHE_TTL, negative_ttl=SUFFIX_NEGATIVE_TTL, max_entries=SUFFIX_CACHE_SIZE):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
 
+	def get(self, url):
+		''' (found, suffix) '''
+		with self.lock:
+			entry = self.entries.get(url)
+			if entry is None:
+				return False, None
+			(suffix, expires) = entry
+			if expires <= time.time():
+				del self.entries[url]
+				return False, None
+			return True, suffix
+
+	def put(self, url, suffix, ttl=None):
+		if ttl is None:
+			ttl = self.ttl if suffix is not None else self.negative_ttl
+		with self.lock:
+			self.entries.pop(url, None)
+			self.entries[url] = (suffix, time.time() + ttl)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+suffix_cache = SuffixCache()
+
+def content_type_suffix(content_type):
+	''' The suffix of a Content-Type header value, None when we have no special handling for it '''
 	if content_type:
 		if any(x in content_type for x in ["html", "htm"]):
 			return "html"
@@ -57,12 +114,58 @@ def get_url_suffix(path):
 			return "css"
 		elif any(x in content_type for x in ["javascript", "js", "x-javascript"]):
 			return "js"
-		else:
-			pass
+	return None
 
+def extension_suffix(path):
+	''' The extension of the url path, None when it has none '''
 	url_path = urlparse.urlparse(path).path
 	url_path_l = url_path.split(".")
 	if len(url_path_l) != 1:
 		return url_path_l[-1]
 	else:
-		return None
\ No newline at end of file
+		return None
+
+def remember_url_suffix(path, res):
+	''' Classify `path` by the real response fetched for it, so its next request needs no guessing '''
+	suffix = content_type_suffix(res.headers.get('content-type')) or extension_suffix(path)
+	suffix_cache.put(path, suffix)
+	return suffix
+
+def page_request_headers(headers):
+	''' The client's `headers` a page is fetched from the origin with '''
+	return dict((key, value) for key, value in (headers or {}).items() if key.lower() not in CONDITIONAL_HEADERS)
+
+def get_url_suffix(path, cached_suffix=None, headers=None):
+	''' Get the requested type of resource, (suffix, the response it was classified by or None)
+
+	Answered from the suffix cache, which the real GET responses keep up to date (remember_url_suffix),
+	then from the extension when it is a well known static one, then by `cached_suffix(path)`, the suffix
+	the page is cached under. Only urls none of them know are classified by the origin: by a GET with the
+	client's `headers` (redirects followed, the body not read yet) that the page object takes over, so it
+	costs no extra request and is the page the client would get.
+	'''
+	(found, suffix) = suffix_cache.get(path)
+	if found:
+		return suffix, None
+
+	extension = extension_suffix(path)
+	if extension and extension.lower() in STATIC_EXTENSIONS:
+		return STATIC_EXTENSIONS[extension.lower()], None
+
+	suffix = cached_suffix(path) if cached_suffix is not None else None
+	if suffix is not None:
+		suffix_cache.put(path, suffix)
+		return suffix, None
+
+	try:
+		res = requests.get(path, headers=page_request_headers(headers), stream=True)
+	except requests.RequestException:
+		# the origin could not tell, go by the extension and ask again soon
+		suffix = extension_suffix(path) or ERROR_SUFFIX
+		suffix_cache.put(path, suffix, suffix_cache.negative_ttl)
+		return suffix, None
+
+	if not res.ok:
+		# an error page, not what the url is: the page object answers with it and the next request asks again
+		return content_type_suffix(res.headers.get('content-type')) or extension_suffix(path) or ERROR_SUFFIX, res
+	return remember_url_suffix(path, res), res
@@ -1,3 +1,4 @@
+import os
 import sys
 import socket
 try:
@@ -5,7 +6,9 @@ try:
 except:
 	from configparser import ConfigParser
 
-from .constants import DEFAULT_BUFFER_SIZE
+from .constants import DEFAULT_BUFFER_SIZE, RELAY_MODES, DEFAULT_CONNECT_TIMEOUT, DEFAULT_CONNECT_RETRIES, DEFAULT_LISTEN_BACKLOG
+from .strategy import STRATEGIES, DEFAULT_STRATEGY
+from .health import DEFAULT_HEALTH_CHECK
 from logging import getLogger
 
 logger = getLogger(__name__)
@@ -13,16 +16,18 @@ logger = getLogger(__name__)
 class WorkerClientMapping(object):
 	''' Mapping client-worker '''
 	
-	def __init__(self, localAddr, localPort, workers):
+	def __init__(self, localAddr, localPort, workers, strategy=DEFAULT_STRATEGY):
 		self.localAddr = localAddr or ''
 		self.localPort = int(localPort)
 		self.workers = workers
+		# name of the lbr.strategy used to pick a worker per client
+		self.strategy = strategy
 
 	def getListenerArgs(self):
 		return [self.localAddr, self.localPort, self.workers]
 
-	def addWorker(self, workerAddr, workerPort):
-		self.workers.append({'port': int(workerPort), 'addr': workerAddr})
+	def addWorker(self, workerAddr, workerPort, weight=1):
+		self.workers.append({'port': int(workerPort), 'addr': workerAddr, 'weight': int(weight)})
 
 	def removeWorker(self, workerAddr, workerPort):
 		newWorkers = []
@@ -42,11 +47,23 @@ class WorkerClientMapping(object):
 class LBConfig(ConfigParser):
 
 	def __init__(self, configFilename):
-		ConfigParser.__init__(self)
+		# only "=" separates keys from values, mapping keys are addr:port
+		ConfigParser.__init__(self, delimiters=('=',))
 		self.configFilename = configFilename
 		self._options = {
 			'pre_resolve_workers': True,
-			'buffer_size': DEFAULT_BUFFER_SIZE
+			'buffer_size': DEFAULT_BUFFER_SIZE,
+			'relay_mode': 'process',
+			'relay_loops': 1,
+			'zero_copy': True,
+			'strategy': DEFAULT_STRATEGY,
+			'connect_timeout': DEFAULT_CONNECT_TIMEOUT,
+			'connect_retries': DEFAULT_CONNECT_RETRIES,
+			'listen_backlog': DEFAULT_LISTEN_BACKLOG,
+			'listen_shards': 1,
+			'defer_accept': 0,
+			# dict of lbr.health options when [options] -> health_check is on
+			'health_check': None
 		}
 
 		self._mappings = {}
@@ -62,6 +79,7 @@ class LBConfig(ConfigParser):
 		f.close()
 
 		self._processOptions()
+		self._processHealthOptions()
 		self._processMappings()
 
 	def getOptions(self):
@@ -97,7 +115,112 @@ class LBConfig(ConfigParser):
 		except Exception as e:
 			logger.error('Error parsing [options]->buffer_size : %s. Retaining default, %s\n' % (str(e), str(DEFAULT_BUFFER_SIZE)))
 
+		if self.has_option('options', 'zero_copy'):
+			zeroCopy = self.get('options', 'zero_copy').strip()
+			if zeroCopy == '1' or zeroCopy.lower() == 'true':
+				self._options['zero_copy'] = True
+			elif zeroCopy == '0' or zeroCopy.lower() == 'false':
+				self._options['zero_copy'] = False
+			else:
+				logger.warn('Unknown value for [options] -> zero_copy "%s" -- ignoring value, retaining previous "%s"\n' % (zeroCopy, str(self._options['zero_copy'])))
+
+		if self.has_option('options', 'strategy'):
+			strategy = self.get('options', 'strategy').strip().lower()
+			if strategy in STRATEGIES:
+				self._options['strategy'] = strategy
+			else:
+				logger.error('strategy must be one of %s. Got "%s" -- ignoring value, retaining previous "%s"\n' % (', '.join(sorted(STRATEGIES)), strategy, self._options['strategy']))
+
+		if self.has_option('options', 'connect_timeout'):
+			connectTimeout = self.get('options', 'connect_timeout').strip()
+			try:
+				if float(connectTimeout) <= 0:
+					raise ValueError('must be > 0')
+				self._options['connect_timeout'] = float(connectTimeout)
+			except ValueError as e:
+				logger.error('connect_timeout must be a number of seconds > 0. Got "%s" -- ignoring value, retaining previous "%s"\n' % (connectTimeout, str(self._options['connect_timeout'])))
+
+		if self.has_option('options', 'connect_retries'):
+			connectRetries = self.get('options', 'connect_retries').strip()
+			if connectRetries.isdigit():
+				self._options['connect_retries'] = int(connectRetries)
+			else:
+				logger.error('connect_retries must be an integer >= 0. Got "%s" -- ignoring value, retaining previous "%s"\n' % (connectRetries, str(self._options['connect_retries'])))
+
+		if self.has_option('options', 'listen_backlog'):
+			listenBacklog = self.get('options', 'listen_backlog').strip()
+			if listenBacklog.isdigit() and int(listenBacklog) > 0:
+				self._options['listen_backlog'] = int(listenBacklog)
+			else:
+				logger.error('listen_backlog must be an integer > 0. Got "%s" -- ignoring value, retaining previous "%s"\n' % (listenBacklog, str(self._options['listen_backlog'])))
+
+		if self.has_option('options', 'listen_shards'):
+			listenShards = self.get('options', 'listen_shards').strip().lower()
+			if listenShards == 'auto':
+				self._options['listen_shards'] = os.cpu_count() or 1
+			elif listenShards.isdigit() and int(listenShards) > 0:
+				self._options['listen_shards'] = int(listenShards)
+			else:
+				logger.error('listen_shards must be an integer > 0 or "auto". Got "%s" -- ignoring value, retaining previous "%s"\n' % (listenShards, str(self._options['listen_shards'])))
+
+		if self.has_option('options', 'defer_accept'):
+			deferAccept = self.get('options', 'defer_accept').strip()
+			if deferAccept.isdigit():
+				self._options['defer_accept'] = int(deferAccept)
+			else:
+				logger.error('defer_accept must be a number of seconds >= 0. Got "%s" -- ignoring value, retaining previous "%s"\n' % (deferAccept, str(self._options['defer_accept'])))
+
+		if self.has_option('options', 'relay_mode'):
+			relayMode = self.get('options', 'relay_mode').strip().lower()
+			if relayMode in RELAY_MODES:
+				self._options['relay_mode'] = relayMode
+			else:
+				logger.error('relay_mode must be one of %s. Got "%s" -- ignoring value, retaining previous "%s"\n' % (', '.join(RELAY_MODES), relayMode, self._options['relay_mode']))
+
+		if self.has_option('options', 'relay_loops'):
+			relayLoops = self.get('options', 'relay_loops').strip().lower()
+			if relayLoops == 'auto':
+				self._options['relay_loops'] = os.cpu_count() or 1
+			elif relayLoops.isdigit() and int(relayLoops) > 0:
+				self._options['relay_loops'] = int(relayLoops)
+			else:
+				logger.error('relay_loops must be an integer > 0 or "auto". Got "%s" -- ignoring value, retaining previous "%s"\n' % (relayLoops, str(self._options['relay_loops'])))
+
+	def _processHealthOptions(self):
+		''' [options] health_check = true, plus health_<name> overrides of lbr.health.DEFAULT_HEALTH_CHECK '''
+		if not self.has_option('options', 'health_check'):
+			return
+
+		healthCheck = self.get('options', 'health_check').strip()
+		if healthCheck == '0' or healthCheck.lower() == 'false':
+			self._options['health_check'] = None
+			return
+		if healthCheck != '1' and healthCheck.lower() != 'true':
+			logger.warn('Unknown value for [options] -> health_check "%s" -- ignoring value\n' % (healthCheck,))
+			return
+
+		options = dict(DEFAULT_HEALTH_CHECK)
+		for (name, default) in DEFAULT_HEALTH_CHECK.items():
+			optionName = 'health_%s' % (name,)
+			if not self.has_option('options', optionName):
+				continue
+
+			value = self.get('options', optionName).strip()
+			if isinstance(default, str):
+				options[name] = value
+				continue
+			try:
+				value = type(default)(value)
+				if value <= 0:
+					raise ValueError('must be > 0')
+				options[name] = value
+			except ValueError as e:
+				logger.error('Error parsing [options]->%s "%s": %s. Retaining default, %s\n' % (optionName, value, str(e), str(default)))
+
+		self._options['health_check'] = options
+
 	def _processMappings(self):
+		''' Each mapping is  [addr:]port = host:port[:weight], ... [; strategy=name]  '''
 		if 'mappings' not in self._sections:
 			raise ConfigException('ERROR : Config is missing required "mappings" section\n')
 
@@ -106,7 +229,7 @@ class LBConfig(ConfigParser):
 		mappings = {}
 		mappingSectionItems = self.items('mappings')
 
-		if (addrPort, workers) in mappingSectionItems:
+		for (addrPort, workers) in mappingSectionItems:
 			addrPortSplit = addrPort.split(':')
 			addrPortSplitLen = len(addrPortSplit)
 			if not workers:
@@ -126,31 +249,62 @@ class LBConfig(ConfigParser):
 				logger.error('Skipping Invalid mapping, cannot convert port : %s\n' % (addrPort,))
 				continue
 
+			(workerList, strategy) = self._splitMappingOptions(addrPort, workers)
+
 			workers = []
-			for worker in workers.split(','):
-				workerSplit = worker.split(':')
+			for worker in workerList.split(','):
+				workerSplit = worker.strip().split(':')
+				weight = 1
+				if len(workerSplit) == 3:
+					try:
+						weight = int(workerSplit.pop())
+					except ValueError:
+						weight = 0
+					if weight < 1:
+						logger.warn('Skipping worker, weight must be an integer > 0 %s\n' % (worker))
+						continue
 				if len(workerSplit) != 2 or len(workerSplit[0]) < 3 or len(workerSplit[1]) == 0:
 					logger.warn('Skipping Invalud worker %s\n' % (worker))
+					continue
 
 				if preResolveWorkers is True:
 					try:
 						addr = socket.gethostbyname(workerSplit[0])
 					except:
 						logger.warn('Skipping Worker, could not resolve %s' % (workerSplit[0]))
+						continue
 				else:
 					addr = workerSplit[0]
 				try:
 					port = int(workerSplit[1])
 				except ValueError:
 					logger.warn('Skipping worker, could not parse port %s\n' % (workerSplit[1]))
-				workers.append({'addr': addr, 'port': port})
+					continue
+				workers.append({'addr': addr, 'port': port, 'weight': weight})
 
 			keyname = "%s:%s" % (localAddr, addrPort)
 			if keyname in mappings:
 				logger.warn('Overriding existing mapping of %s with %s\n' % (addrPort, str(workers)))
-			mappings[addrPort] = WorkerClientMapping(localAddr, localPort, workers)
+			mappings[addrPort] = WorkerClientMapping(localAddr, localPort, workers, strategy)
 		self._mappings = mappings
 
+	def _splitMappingOptions(self, addrPort, value):
+		''' Split the "; name=value" options off a mapping value. Returns the worker list and the strategy '''
+		parts = value.split(';')
+		strategy = self._options['strategy']
+
+		for option in parts[1:]:
+			optionSplit = [o.strip() for o in option.split('=', 1)]
+			if len(optionSplit) != 2 or optionSplit[0].lower() != 'strategy':
+				logger.warn('Ignoring unknown option "%s" on mapping %s\n' % (option.strip(), addrPort))
+				continue
+			if optionSplit[1].lower() not in STRATEGIES:
+				logger.error('Unknown strategy "%s" on mapping %s, using "%s"\n' % (optionSplit[1], addrPort, strategy))
+				continue
+			strategy = optionSplit[1].lower()
+
+		return (parts[0], strategy)
+
 class ConfigException(Exception):
 	pass
 
@@ -0,0 +1,16 @@
+
+# the default size is 4096 bytes
+DEFAULT_BUFFER_SIZE = 4096
+
+# how client connections are relayed to the workers
+#   process   : one Worker process per accepted client
+#   eventloop : a few RelayLoop processes multiplex every client
+RELAY_MODES = ('process', 'eventloop')
+
+# pending connections the kernel queues per listening socket
+DEFAULT_LISTEN_BACKLOG = 1024
+
+# seconds a connect to a worker may take before the next worker is tried
+DEFAULT_CONNECT_TIMEOUT = 1.0
+# workers tried after the first one failed, before the client is dropped
+DEFAULT_CONNECT_RETRIES = 2
@@ -0,0 +1,157 @@
+
+import time
+import socket
+import threading
+from logging import getLogger
+
+from .strategy import workerKey
+
+logger = getLogger(__name__)
+
+DEFAULT_HEALTH_CHECK = {
+	# seconds between two probes of a worker
+	'interval': 2.0,
+	# seconds a probe may take before the worker counts as failed
+	'timeout': 1.0,
+	# consecutive failures (probes or client connects) before a worker is ejected
+	'fails': 2,
+	# consecutive successful probes before an ejected worker is reinstated
+	'rises': 2,
+	# also send "GET <path>" and expect a 2xx/3xx, plain TCP connect when empty
+	'http_path': '',
+	# first and longest wait before probing an ejected worker again, doubled on every failed attempt
+	'backoff': 1.0,
+	'max_backoff': 60.0,
+}
+
+class BackendHealth(object):
+	''' Health state of one worker '''
+
+	def __init__(self, workerInfo):
+		self.workerInfo = workerInfo
+		self.healthy = True
+		self.failures = 0
+		self.successes = 0
+		self.backoff = 0.0
+		self.nextProbe = 0.0
+
+class HealthChecker(threading.Thread):
+	''' Probes the workers of a WorkerClientMapping, ejects unhealthy ones from `mapping.workers` and reinstates them with backoff
+
+	`onChange` is called with the new list of healthy workers whenever one is ejected or reinstated.
+	'''
+
+	def __init__(self, mapping, healthCheck=None, onChange=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+
+		self.mapping = mapping
+		self.options = dict(DEFAULT_HEALTH_CHECK, **(healthCheck or {}))
+		self.onChange = onChange
+
+		self.lock = threading.Lock()
+		self.health = dict((workerKey(worker), BackendHealth(worker)) for worker in mapping.workers)
+		self.keepGoing = True
+
+	def stop(self):
+		self.keepGoing = False
+
+	def isHealthy(self, workerInfo):
+		backendHealth = self.health.get(workerKey(workerInfo))
+		return backendHealth is None or backendHealth.healthy
+
+	def reportFailure(self, workerInfo):
+		''' Passive check: a client could not connect to the worker '''
+		self.recordFailure(workerInfo)
+
+	def reportSuccess(self, workerInfo):
+		''' Passive check: a client connected to the worker '''
+		backendHealth = self.health.get(workerKey(workerInfo))
+		if backendHealth is not None and backendHealth.healthy:
+			backendHealth.failures = 0
+
+	def recordFailure(self, workerInfo):
+		with self.lock:
+			backendHealth = self.health.get(workerKey(workerInfo))
+			if backendHealth is None:
+				return
+			backendHealth.successes = 0
+			backendHealth.failures += 1
+
+			if backendHealth.healthy is False:
+				# still down, wait longer before the next attempt
+				backendHealth.backoff = min(backendHealth.backoff * 2, self.options['max_backoff'])
+				backendHealth.nextProbe = time.time() + backendHealth.backoff
+				return
+
+			if backendHealth.failures < self.options['fails']:
+				return
+
+			backendHealth.healthy = False
+			backendHealth.backoff = self.options['backoff']
+			backendHealth.nextProbe = time.time() + backendHealth.backoff
+			self.mapping.removeWorker(workerInfo['addr'], workerInfo['port'])
+			logger.warn('Ejected worker %s:%d after %d failures\n' % (workerInfo['addr'], workerInfo['port'], backendHealth.failures))
+
+		self.notify()
+
+	def recordSuccess(self, workerInfo):
+		with self.lock:
+			backendHealth = self.health.get(workerKey(workerInfo))
+			if backendHealth is None:
+				return
+			backendHealth.failures = 0
+			backendHealth.successes += 1
+
+			if backendHealth.healthy is True or backendHealth.successes < self.options['rises']:
+				return
+
+			backendHealth.healthy = True
+			backendHealth.backoff = 0.0
+			self.mapping.addWorker(workerInfo['addr'], workerInfo['port'], workerInfo.get('weight', 1))
+			logger.warn('Reinstated worker %s:%d\n' % (workerInfo['addr'], workerInfo['port']))
+
+		self.notify()
+
+	def notify(self):
+		if self.onChange is not None:
+			self.onChange(list(self.mapping.workers))
+
+	def probe(self, workerInfo):
+		''' True when the worker accepts a connection (and answers the HTTP probe, if configured) '''
+		try:
+			probeSocket = socket.create_connection((workerInfo['addr'], workerInfo['port']), self.options['timeout'])
+		except (OSError, socket.timeout):
+			return False
+
+		try:
+			if not self.options['http_path']:
+				return True
+
+			probeSocket.sendall(('GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n' % (self.options['http_path'], workerInfo['addr'])).encode('latin-1'))
+			statusLine = probeSocket.makefile('rb').readline(256).split()
+			return len(statusLine) >= 2 and statusLine[1][:1] in (b'2', b'3')
+		except (OSError, socket.timeout):
+			return False
+		finally:
+			probeSocket.close()
+
+	def run(self):
+		while self.keepGoing is True:
+			now = time.time()
+			for backendHealth in list(self.health.values()):
+				if backendHealth.nextProbe > now:
+					continue
+
+				if self.probe(backendHealth.workerInfo):
+					self.recordSuccess(backendHealth.workerInfo)
+				else:
+					self.recordFailure(backendHealth.workerInfo)
+
+				if backendHealth.healthy is True:
+					backendHealth.nextProbe = time.time() + self.options['interval']
+				elif backendHealth.nextProbe <= now:
+					# ejected but recovering, confirm quickly
+					backendHealth.nextProbe = time.time() + min(self.options['interval'], self.options['backoff'])
+
+			time.sleep(min(.25, self.options['interval']))
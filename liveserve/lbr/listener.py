@@ -1,15 +1,22 @@
 
 import sys
 import os
-import random
 import socket
 import signal
 import time
+import random
 import threading
 import multiprocessing
 from logging import getLogger
 
 from .worker import Worker
+from .relay import RelayListener
+from .strategy import createStrategy
+from .health import HealthChecker
+from .config import WorkerClientMapping
+from .metrics import ConnectMetrics
+from .constants import DEFAULT_CONNECT_TIMEOUT, DEFAULT_CONNECT_RETRIES, DEFAULT_LISTEN_BACKLOG
+from .listensocket import bindListenSocket
 
 DEFAULT_BUFFER_SIZE = 4096
 
@@ -18,12 +25,28 @@ logger = getLogger(__name__)
 class RequestListener(multiprocessing.Process):
 	''' Listens for client connections and assigns them to workers '''
 
-	def __init__(self, localAddr, localPort, workers, bufferSize=DEFAULT_BUFFER_SIZE):
-		multiprocessing.Process.__init__()
+	def __init__(self, localAddr, localPort, workers, bufferSize=DEFAULT_BUFFER_SIZE, zeroCopy=True, strategy=None, healthCheck=None, connectTimeout=DEFAULT_CONNECT_TIMEOUT, connectRetries=DEFAULT_CONNECT_RETRIES, listenBacklog=DEFAULT_LISTEN_BACKLOG, reusePort=False, deferAccept=0):
+		multiprocessing.Process.__init__(self)
 		self.localAddr = localAddr
 		self.localPort = localPort
 		self.workers = workers
 		self.bufferSize = bufferSize
+		self.zeroCopy = zeroCopy
+		self.strategy = createStrategy(strategy, workers, connectTimeout)
+		# the accept loop, cleanup and health threads all feed the strategy counters
+		self.strategyLock = threading.Lock()
+		# options of the lbr.health checker, None to route to every worker blindly
+		self.healthCheck = healthCheck
+		self.healthChecker = None
+		# a Worker tries connectRetries other workers, each within connectTimeout, before giving up on its client
+		self.connectTimeout = connectTimeout
+		self.connectRetries = connectRetries
+		# readable from the process that created the listener as well
+		self.connectMetrics = ConnectMetrics()
+		# see listensocket.bindListenSocket
+		self.listenBacklog = listenBacklog
+		self.reusePort = reusePort
+		self.deferAccept = deferAccept
 
 		self.activeWorkers = []
 		self.listenSocket = None
@@ -36,15 +59,64 @@ class RequestListener(multiprocessing.Process):
 			currentWorkers = self.activeWorkers[:]
 			for worker in currentWorkers:
 				worker.join(.02)
+				self.reportConnect(worker)
 				# if the worker is done
 				if worker.is_alive() == False:
 					self.activeWorkers.remove(worker)
+					if worker.connectedIndex.value >= 0:
+						with self.strategyLock:
+							self.strategy.onRelease(worker.getWorkerInfo())
 
 			time.sleep(1.5)
 
 
+	def reportConnect(self, worker):
+		''' Feed how the connect of a worker went into the strategy and the health checker, once it is over '''
+		connectedIndex = worker.connectedIndex.value
+		if worker.connectReported is True or (connectedIndex < 0 and worker.is_alive()):
+			return
+		worker.connectReported = True
+
+		failedWorkers = worker.candidates[:connectedIndex] if connectedIndex >= 0 else worker.candidates[:worker.attempts.value]
+		with self.strategyLock:
+			# startWorker counted the connection against the first candidate
+			if connectedIndex != 0:
+				self.strategy.onRelease(worker.candidates[0])
+			if connectedIndex > 0:
+				self.strategy.onConnect(worker.getWorkerInfo())
+			if connectedIndex >= 0:
+				self.strategy.getStats(worker.getWorkerInfo()).addLatency(worker.connectLatency.value)
+			for workerInfo in failedWorkers:
+				self.strategy.onFailure(workerInfo)
+
+		if self.healthChecker is not None:
+			for workerInfo in failedWorkers:
+				self.healthChecker.reportFailure(workerInfo)
+			if connectedIndex >= 0:
+				self.healthChecker.reportSuccess(worker.getWorkerInfo())
+
+	def onWorkersChanged(self, workers):
+		''' The health checker ejected or reinstated a worker '''
+		with self.strategyLock:
+			self.strategy.setWorkers(workers)
+
+	def startWorker(self, clientConn, clientAddr, workerInfo):
+		with self.strategyLock:
+			fallbackWorkers = self.strategy.candidates(exclude=[workerInfo])
+			self.strategy.onConnect(workerInfo)
+		random.shuffle(fallbackWorkers)
+
+		worker = Worker(clientConn, clientAddr, workerInfo['addr'], workerInfo['port'], self.bufferSize, self.zeroCopy, fallbackWorkers[:self.connectRetries], self.connectTimeout, self.connectMetrics)
+		self.activeWorkers.append(worker)
+		worker.start()
+		# the worker owns the client now, failover included
+		clientConn.close()
+		return worker
+
 	def closeWorkers(self, *args):
 		self.keepGoing = False
+		self.healthChecker and self.healthChecker.stop()
+		logger.info('Connect metrics on %s:%d: %s\n' % (self.localAddr, self.localPort, str(self.connectMetrics)))
 		time.sleep(1)
 
 		try:
@@ -85,88 +157,37 @@ class RequestListener(multiprocessing.Process):
 		signal.signal(signal.SIGTERM, signal.SIG_DFL)
 		sys.exit(0)
 
-	def retryFailedWorkers(self, *args):
-		''' Loops over the activeWorkers and checks for shared `failedToConnect` value and then we pick a diffrent worker and assign the client to new worker '''
-
-		time.sleep(2)
-		successfulRuns = 0
-
-		while self.keepGoing is True:
-			currentWorkers = self.activeWorkers[:]
-			for worker in currentWorkers:
-				if worker.failedToConnect.value == 1:
-					successfulRuns = -1
-					logger.warn('Found a `failuretoConnect` worker\n')
-
-					numWorkers = len(self.workers)
-
-					if numWorkers > 1:
-						nextWorkerInfo = None
-						while (nextWorkerInfo is None) or (worker.workerAddr == nextWorkerInfo['addr'] and worker.workerPort == nextWorkerInfo['port']):
-							nextWorkerInfo = self.workers[random.randint(0, numWorkers-1)]
-					else:
-						nextWorkerInfo = self.workers[0]
-
-					logger.debug('Retrying request from %s from %s:%d on %s:%d\n' % (worker.clientAddr, worker.workerAddr, worker.workerPort))
-
-					nextWorker = Worker(worker.clientSocket, worker.clientAddr, nextWorkerInfo['addr'], nextWorkerInfo['port'], self.bufferSize)
-					nextWorker.start()
-					self.activeWorkers.append(nextWorker)
-					worker.failedToConnect.value = 0
-
-			successfulRuns += 1
-			if successfulRuns > self.maxActiveWorkers:
-				successfulRuns = 6
-			if successfulRuns > 5:
-				time.sleep(2)
-			else:
-				time.sleep(.05)
-
 	def run(self):
 		signal.signal(signal.SIGTERM, self.closeWorkers)
 
-		while True:
-			try:
-				listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				try:
-					listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-				except:
-					pass
-				listenSocket.bind((self.localAddr, self.localPort))
-				self.listenSocket = listenSocket
-				break
-
-			except Exception as e:
-				logger.error('Failed to bind to %s:%d. "%s" Retrying in 5 sec...\n' % (self.localAddr, self.localPort, str(e)))
-				time.sleep(5)
+		self.listenSocket = listenSocket = bindListenSocket(self.localAddr, self.localPort, self.listenBacklog, self.reusePort, self.deferAccept)
 
-		# Take 5 connections at a time
-		listenSocket.listen(5)
+		if self.healthCheck is not None:
+			self.healthChecker = HealthChecker(WorkerClientMapping(self.localAddr, self.localPort, list(self.workers)), self.healthCheck, self.onWorkersChanged)
+			self.healthChecker.start()
 
 		# Create thread that will cleanup completed tasks
 		self.cleanupTh = cleanupTh = threading.Thread(target=self.cleanup)
 		cleanupTh.start()
 
-		# create thread that will retry failed tasks
-		retryThread = threading.Thread(target=self.retryFailedWorkers)
-		retryThread.start()
-
 		try:
 			while self.keepGoing is True:
-				for workerInfo in self.workers:
-					if self.keepGoing is False:
-						break
-					try:
-						(clientConn, clientAddr) = listenSocket.accept()
-					except:
-						logger.error('Cannot bind to %s:%s\n' % (self.localAddr, self.localPort))
-						if self.keepGoing is True:
-							time.sleep(3)
-							continue
-						raise
-					worker = Worker(clientConn, clientAddr, workerInfo['addr'], workerInfo['port'], self.bufferSize)
-					self.activeWorkers.append(worker)
-					worker.start()
+				try:
+					(clientConn, clientAddr) = listenSocket.accept()
+				except:
+					logger.error('Cannot bind to %s:%s\n' % (self.localAddr, self.localPort))
+					if self.keepGoing is True:
+						time.sleep(3)
+						continue
+					raise
+
+				with self.strategyLock:
+					workerInfo = self.strategy.pick(clientAddr)
+				if workerInfo is None:
+					logger.error('No healthy worker to serve %s on %s:%d\n' % (str(clientAddr), self.localAddr, self.localPort))
+					clientConn.close()
+					continue
+				self.startWorker(clientConn, clientAddr, workerInfo)
 		except Exception as e:
 			logger.error('Got exception : %s, shutting down workers on %s:%d\n' % (str(e), self.localAddr, self.localPort))
 			self.closeWorkers()
@@ -175,4 +196,61 @@ class RequestListener(multiprocessing.Process):
 		self.closeWorkers()
 
 
-
+class ShardedListener(object):
+	''' Runs several listeners bound to the same localAddr:localPort with SO_REUSEPORT, the kernel spreads the accepts over them
+
+	Started, stopped and joined like the single listener it stands in for.
+	'''
+
+	def __init__(self, shards):
+		self.shards = shards
+
+	def start(self):
+		for shard in self.shards:
+			shard.start()
+
+	def terminate(self):
+		for shard in self.shards:
+			shard.terminate()
+
+	def join(self, timeout=None):
+		deadline = None if timeout is None else time.time() + timeout
+		for shard in self.shards:
+			shard.join(None if deadline is None else max(0, deadline - time.time()))
+
+	def is_alive(self):
+		return any(shard.is_alive() for shard in self.shards)
+
+	@property
+	def pid(self):
+		return self.shards[0].pid
+
+	@property
+	def pids(self):
+		return [shard.pid for shard in self.shards]
+
+	@property
+	def connectMetrics(self):
+		return [shard.connectMetrics for shard in self.shards]
+
+def createListener(mapping, options):
+	''' Create the listener for a WorkerClientMapping, as selected by [options] -> relay_mode and listen_shards '''
+	(localAddr, localPort, workers) = mapping.getListenerArgs()
+	bufferSize = options.get('buffer_size', DEFAULT_BUFFER_SIZE)
+	zeroCopy = options.get('zero_copy', True)
+	healthCheck = options.get('health_check')
+	connectTimeout = options.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+	connectRetries = options.get('connect_retries', DEFAULT_CONNECT_RETRIES)
+	listenBacklog = options.get('listen_backlog', DEFAULT_LISTEN_BACKLOG)
+	deferAccept = options.get('defer_accept', 0)
+	listenShards = options.get('listen_shards', 1)
+	reusePort = listenShards > 1
+
+	def createShard():
+		if options.get('relay_mode') == 'eventloop':
+			return RelayListener(localAddr, localPort, workers, bufferSize, options.get('relay_loops', 1), zeroCopy, mapping.strategy, healthCheck, connectTimeout, connectRetries, listenBacklog, reusePort, deferAccept)
+		return RequestListener(localAddr, localPort, workers, bufferSize, zeroCopy, mapping.strategy, healthCheck, connectTimeout, connectRetries, listenBacklog, reusePort, deferAccept)
+
+	if listenShards > 1:
+		return ShardedListener([createShard() for _ in range(listenShards)])
+	return createShard()
@@ -0,0 +1,40 @@
+
+import time
+import socket
+from logging import getLogger
+
+from .constants import DEFAULT_LISTEN_BACKLOG
+
+logger = getLogger(__name__)
+
+def bindListenSocket(localAddr, localPort, backlog=DEFAULT_LISTEN_BACKLOG, reusePort=False, deferAccept=0):
+	''' Bind and listen on localAddr:localPort, retrying every 5 seconds until the address is free
+
+	reusePort   lets several listeners bind the same address (SO_REUSEPORT), the kernel spreads new connections over them
+	deferAccept only wake accept() once the client sent data, or after that many seconds (TCP_DEFER_ACCEPT, linux).
+	            Leave it off for protocols where the server speaks first (MySQL, SMTP, ...)
+	'''
+	while True:
+		try:
+			listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			try:
+				listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			except:
+				pass
+			if reusePort is True:
+				listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+			listenSocket.bind((localAddr, localPort))
+			break
+
+		except Exception as e:
+			logger.error('Failed to bind to %s:%d. "%s" Retrying in 5 sec...\n' % (localAddr, localPort, str(e)))
+			time.sleep(5)
+
+	if deferAccept > 0:
+		if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+			listenSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, int(deferAccept))
+		else:
+			logger.warn('TCP_DEFER_ACCEPT is not available on this platform -- ignoring defer_accept\n')
+
+	listenSocket.listen(backlog)
+	return listenSocket
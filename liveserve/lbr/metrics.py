@@ -0,0 +1,49 @@
+
+import multiprocessing
+
+class ConnectMetrics(object):
+	''' Counters of worker connects and their failovers, shared by the listener and the processes it starts
+
+	Create it before starting the processes that record into it (they inherit it), read it from any of them.
+	'''
+
+	def __init__(self):
+		self.lock = multiprocessing.Lock()
+		# client connections that needed a worker
+		self.connects = multiprocessing.Value('L', 0, lock=False)
+		# connect attempts beyond the first one
+		self.retries = multiprocessing.Value('L', 0, lock=False)
+		# connections that got a worker only after one or more retries
+		self.failovers = multiprocessing.Value('L', 0, lock=False)
+		# connections dropped because every attempt in the retry budget failed
+		self.exhausted = multiprocessing.Value('L', 0, lock=False)
+		# seconds spent on failed attempts before the successful one
+		self.addedLatencyTotal = multiprocessing.Value('d', 0.0, lock=False)
+		self.addedLatencyMax = multiprocessing.Value('d', 0.0, lock=False)
+
+	def record(self, retries, addedLatency, connected):
+		with self.lock:
+			self.connects.value += 1
+			self.retries.value += retries
+			if connected is False:
+				self.exhausted.value += 1
+				return
+			if retries > 0:
+				self.failovers.value += 1
+				self.addedLatencyTotal.value += addedLatency
+				self.addedLatencyMax.value = max(self.addedLatencyMax.value, addedLatency)
+
+	def snapshot(self):
+		with self.lock:
+			failovers = self.failovers.value
+			return {
+				'connects': self.connects.value,
+				'retries': self.retries.value,
+				'failovers': failovers,
+				'exhausted': self.exhausted.value,
+				'failover_latency_avg': self.addedLatencyTotal.value / failovers if failovers else 0.0,
+				'failover_latency_max': self.addedLatencyMax.value,
+			}
+
+	def __str__(self):
+		return 'connects=%(connects)d retries=%(retries)d failovers=%(failovers)d exhausted=%(exhausted)d failover_latency_avg=%(failover_latency_avg).4fs failover_latency_max=%(failover_latency_max).4fs' % self.snapshot()
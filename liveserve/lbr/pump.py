@@ -0,0 +1,128 @@
+
+import os
+import fcntl
+from logging import getLogger
+
+from .constants import DEFAULT_BUFFER_SIZE
+
+logger = getLogger(__name__)
+
+# largest pipe we ask the kernel for, /proc/sys/fs/pipe-max-size may cap it lower
+MAX_PIPE_SIZE = 1024 * 1024
+
+HAS_SPLICE = hasattr(os, 'splice')
+
+class BufferPump(object):
+	''' Moves bytes from `src` to `dst` through a preallocated buffer, without allocating per read '''
+
+	def __init__(self, src, dst, bufferSize=DEFAULT_BUFFER_SIZE):
+		self.src = src
+		self.dst = dst
+		self.capacity = bufferSize
+
+		self.buffer = bytearray(bufferSize)
+		self.view = memoryview(self.buffer)
+		self.start = 0
+		self.end = 0
+
+	@property
+	def pending(self):
+		return self.end - self.start
+
+	@property
+	def full(self):
+		return self.pending == self.capacity
+
+	def fill(self):
+		''' Read what `src` has into the free tail of the buffer. Returns 0 on EOF '''
+		if self.start == self.end:
+			self.start = self.end = 0
+		elif self.end == self.capacity:
+			pending = self.end - self.start
+			self.buffer[:pending] = self.view[self.start:self.end]
+			self.start, self.end = 0, pending
+		count = self.src.recv_into(self.view[self.end:])
+		self.end += count
+		return count
+
+	def flush(self):
+		''' Write pending bytes to `dst`. Returns the number of bytes written '''
+		sent = self.dst.send(self.view[self.start:self.end])
+		self.start += sent
+		return sent
+
+	def close(self):
+		self.view.release()
+
+class SplicePump(object):
+	''' Moves bytes from `src` to `dst` through a kernel pipe with splice(2), the data never enters userspace '''
+
+	def __init__(self, src, dst, bufferSize=DEFAULT_BUFFER_SIZE):
+		self.src = src
+		self.dst = dst
+
+		(self.pipeRead, self.pipeWrite) = os.pipe()
+		self.capacity = bufferSize
+		try:
+			self.capacity = fcntl.fcntl(self.pipeWrite, fcntl.F_SETPIPE_SZ, min(max(bufferSize, 65536), MAX_PIPE_SIZE))
+		except (AttributeError, OSError):
+			self.capacity = fcntl.fcntl(self.pipeWrite, fcntl.F_GETPIPE_SZ) if hasattr(fcntl, 'F_GETPIPE_SZ') else 65536
+
+		self.pending = 0
+		# the pipe fills by slots (a page or a received packet each), not bytes: set when it had no room left for a
+		# fill before `pending` reached `capacity`, until a flush makes room again
+		self.pipeFull = False
+
+	@property
+	def full(self):
+		return self.pipeFull or self.pending >= self.capacity
+
+	def fill(self):
+		''' Splice what `src` has into the pipe. Returns 0 on EOF, raises BlockingIOError if the pipe has no room left '''
+		# never block on the pipe itself, only on `src` when it is a blocking socket
+		try:
+			count = os.splice(self.src.fileno(), self.pipeWrite, self.capacity - self.pending, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+		except BlockingIOError:
+			# with nothing in the pipe it was `src` that had nothing to read
+			if self.pending:
+				self.pipeFull = True
+			raise
+		self.pending += count
+		return count
+
+	def flush(self):
+		''' Splice the pipe into `dst`. Returns the number of bytes written '''
+		sent = os.splice(self.pipeRead, self.dst.fileno(), self.pending, flags=os.SPLICE_F_MOVE)
+		self.pending -= sent
+		if sent:
+			self.pipeFull = False
+		return sent
+
+	def close(self):
+		for fd in (self.pipeRead, self.pipeWrite):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+def createPump(src, dst, bufferSize=DEFAULT_BUFFER_SIZE, zeroCopy=True):
+	''' A SplicePump where the platform has splice(2), a BufferPump otherwise '''
+	if zeroCopy is True and HAS_SPLICE:
+		try:
+			return SplicePump(src, dst, bufferSize)
+		except OSError as e:
+			# usually out of descriptors for the pipe
+			logger.warn('Falling back to buffered pump: %s\n' % (str(e),))
+	return BufferPump(src, dst, bufferSize)
+
+def pumpUntilEof(src, dst, bufferSize=DEFAULT_BUFFER_SIZE, zeroCopy=True):
+	''' Blocking one-way copy of `src` into `dst` until `src` reaches EOF. Returns the bytes copied '''
+	pump = createPump(src, dst, bufferSize, zeroCopy)
+	total = 0
+	try:
+		while pump.fill():
+			while pump.pending:
+				total += pump.flush()
+	finally:
+		pump.close()
+	return total
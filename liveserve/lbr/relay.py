@@ -0,0 +1,410 @@
+
+import sys
+import errno
+import socket
+import signal
+import time
+import selectors
+import multiprocessing
+from logging import getLogger
+
+from .constants import DEFAULT_BUFFER_SIZE
+from .pump import createPump
+from .strategy import createStrategy
+from .health import HealthChecker
+from .config import WorkerClientMapping
+from .metrics import ConnectMetrics
+from .constants import DEFAULT_CONNECT_TIMEOUT, DEFAULT_CONNECT_RETRIES, DEFAULT_LISTEN_BACKLOG
+from .listensocket import bindListenSocket
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+logger = getLogger(__name__)
+
+class RelayConnection(object):
+	''' A client socket and its backend socket, relayed by a RelayLoop '''
+
+	def __init__(self, clientSocket, clientAddr):
+		self.clientSocket = clientSocket
+		self.clientAddr = clientAddr
+
+		self.workerSocket = None
+		self.workerInfo = None
+		self.connected = False
+		self.firstConnectStart = None
+		self.connectStart = None
+		self.failedWorkers = []
+
+		self.fromClient = None
+		self.toClient = None
+		self.clientDone = False
+		self.workerDone = False
+		self.clientShut = False
+		self.workerShut = False
+
+		# events currently registered with the selector, per socket
+		self.clientEvents = 0
+		self.workerEvents = 0
+
+class RelayLoop(object):
+	''' Multiplexes many client/worker socket pairs from a single selector (epoll on linux) '''
+
+	def __init__(self, listenSocket, workers, bufferSize=DEFAULT_BUFFER_SIZE, zeroCopy=True, strategy=None, healthCheck=None, connectTimeout=DEFAULT_CONNECT_TIMEOUT, connectRetries=DEFAULT_CONNECT_RETRIES, metrics=None):
+		self.listenSocket = listenSocket
+		self.workers = workers
+		self.bufferSize = bufferSize
+		self.zeroCopy = zeroCopy
+		# each loop keeps its own counters, they only see their own connections
+		self.strategy = createStrategy(strategy, workers, connectTimeout)
+		self.healthCheck = healthCheck
+		self.healthChecker = None
+		# healthy workers handed over by the checker thread, applied from the loop
+		self.pendingWorkers = None
+		self.connectTimeout = connectTimeout
+		self.connectRetries = connectRetries
+		self.metrics = metrics
+
+		self.selector = None
+		self.connections = set()
+		# connections waiting on a worker connect, checked against connectTimeout
+		self.connecting = set()
+		self.keepGoing = True
+
+	def stop(self, *args):
+		self.keepGoing = False
+
+	def onWorkersChanged(self, workers):
+		self.pendingWorkers = workers
+
+	def run(self):
+		signal.signal(signal.SIGTERM, self.stop)
+
+		self.selector = selectors.DefaultSelector()
+		self.listenSocket.setblocking(False)
+		self.selector.register(self.listenSocket, selectors.EVENT_READ, None)
+
+		if self.healthCheck is not None:
+			listenAddr = self.listenSocket.getsockname()
+			self.healthChecker = HealthChecker(WorkerClientMapping(listenAddr[0], listenAddr[1], list(self.workers)), self.healthCheck, self.onWorkersChanged)
+			self.healthChecker.start()
+
+		try:
+			while self.keepGoing is True:
+				if self.pendingWorkers is not None:
+					(workers, self.pendingWorkers) = (self.pendingWorkers, None)
+					self.strategy.setWorkers(workers)
+
+				try:
+					events = self.selector.select(min(.5, self.connectTimeout / 4) if self.connecting else .5)
+				except KeyboardInterrupt:
+					break
+
+				for (key, mask) in events:
+					if key.data is None:
+						self.acceptClients()
+						continue
+
+					(conn, isClient) = key.data
+					try:
+						if isClient is True:
+							self.handleClient(conn, mask)
+						else:
+							self.handleWorker(conn, mask)
+					except Exception as e:
+						logger.error('Error relaying %s on %s: %s\n' % (str(conn.clientAddr), str(conn.workerInfo), str(e)))
+						self.closeConnection(conn)
+
+				self.expireConnects()
+		finally:
+			self.healthChecker and self.healthChecker.stop()
+			for conn in list(self.connections):
+				self.closeConnection(conn)
+			self.selector.close()
+
+	def acceptClients(self):
+		while True:
+			try:
+				(clientConn, clientAddr) = self.listenSocket.accept()
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError as e:
+				# out of file descriptors and friends, leave the rest in the backlog
+				logger.error('Failed to accept on %s: %s\n' % (str(self.listenSocket.getsockname()), str(e)))
+				return
+
+			clientConn.setblocking(False)
+			conn = RelayConnection(clientConn, clientAddr)
+			self.connections.add(conn)
+
+			workerInfo = self.strategy.pick(clientAddr)
+			if workerInfo is None:
+				logger.error('No healthy worker to serve %s\n' % (str(clientAddr),))
+				self.closeConnection(conn)
+				continue
+			self.connectWorker(conn, workerInfo)
+
+	def connectWorker(self, conn, workerInfo):
+		conn.workerInfo = workerInfo
+		conn.connectStart = time.time()
+		conn.firstConnectStart = conn.firstConnectStart or conn.connectStart
+		self.connecting.add(conn)
+		conn.workerSocket = workerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		workerSocket.setblocking(False)
+
+		err = workerSocket.connect_ex((workerInfo['addr'], workerInfo['port']))
+		if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+			self.retryConnection(conn)
+			return
+
+		# writable once the connect has completed (or failed)
+		self.setEvents(conn, False, selectors.EVENT_WRITE)
+
+	def expireConnects(self):
+		now = time.time()
+		for conn in [conn for conn in self.connecting if now - conn.connectStart > self.connectTimeout]:
+			self.retryConnection(conn)
+
+	def retryConnection(self, conn):
+		''' The worker refused or timed out the connection, move straight on to the next worker within the retry budget '''
+		workerInfo = conn.workerInfo
+		logger.error('Could not connect to worker %s:%d\n' % (workerInfo['addr'], workerInfo['port']))
+		self.connecting.discard(conn)
+
+		self.setEvents(conn, False, 0)
+		self.closeSocket(conn.workerSocket)
+		conn.workerSocket = None
+		conn.failedWorkers.append(workerInfo)
+		self.strategy.onFailure(workerInfo)
+		if self.healthChecker is not None:
+			self.healthChecker.reportFailure(workerInfo)
+
+		nextWorkerInfo = None
+		if len(conn.failedWorkers) <= self.connectRetries:
+			nextWorkerInfo = self.strategy.pick(conn.clientAddr, exclude=conn.failedWorkers)
+		if nextWorkerInfo is None:
+			logger.error('No worker accepted %s after %d attempts\n' % (str(conn.clientAddr), len(conn.failedWorkers)))
+			if self.metrics is not None:
+				self.metrics.record(len(conn.failedWorkers) - 1, time.time() - conn.firstConnectStart, False)
+			self.closeConnection(conn)
+			return
+
+		logger.debug('Retrying request from %s from %s:%d on %s:%d\n' % (str(conn.clientAddr), workerInfo['addr'], workerInfo['port'], nextWorkerInfo['addr'], nextWorkerInfo['port']))
+		self.connectWorker(conn, nextWorkerInfo)
+
+	def handleClient(self, conn, mask):
+		if mask & selectors.EVENT_READ:
+			try:
+				if conn.fromClient.fill() == 0:
+					conn.clientDone = True
+			except BlockingIOError:
+				pass
+
+		if mask & selectors.EVENT_WRITE and conn.toClient.pending:
+			try:
+				conn.toClient.flush()
+			except BlockingIOError:
+				pass
+
+		self.updateConnection(conn)
+
+	def handleWorker(self, conn, mask):
+		if conn.connected is False:
+			err = conn.workerSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if err != 0:
+				self.retryConnection(conn)
+				return
+			conn.connected = True
+			self.connecting.discard(conn)
+			if self.metrics is not None:
+				self.metrics.record(len(conn.failedWorkers), conn.connectStart - conn.firstConnectStart, True)
+			self.strategy.onConnect(conn.workerInfo, time.time() - conn.connectStart)
+			if self.healthChecker is not None:
+				self.healthChecker.reportSuccess(conn.workerInfo)
+			conn.fromClient = createPump(conn.clientSocket, conn.workerSocket, self.bufferSize, self.zeroCopy)
+			conn.toClient = createPump(conn.workerSocket, conn.clientSocket, self.bufferSize, self.zeroCopy)
+			self.updateConnection(conn)
+			return
+
+		if mask & selectors.EVENT_READ:
+			try:
+				if conn.toClient.fill() == 0:
+					conn.workerDone = True
+			except BlockingIOError:
+				pass
+
+		if mask & selectors.EVENT_WRITE and conn.fromClient.pending:
+			try:
+				conn.fromClient.flush()
+			except BlockingIOError:
+				pass
+
+		self.updateConnection(conn)
+
+	def updateConnection(self, conn):
+		''' Recompute which events each side of the pair is interested in '''
+		if not conn.connected:
+			return
+
+		# Pass half-closes along once everything the finished side sent has been flushed
+		if conn.clientDone and not conn.fromClient.pending and not conn.workerShut:
+			conn.workerSocket.shutdown(socket.SHUT_WR)
+			conn.workerShut = True
+		if conn.workerDone and not conn.toClient.pending and not conn.clientShut:
+			conn.clientSocket.shutdown(socket.SHUT_WR)
+			conn.clientShut = True
+
+		if conn.clientShut and conn.workerShut:
+			self.closeConnection(conn)
+			return
+
+		clientEvents = 0
+		if not conn.clientDone and not conn.fromClient.full:
+			clientEvents |= selectors.EVENT_READ
+		if conn.toClient.pending:
+			clientEvents |= selectors.EVENT_WRITE
+
+		workerEvents = 0
+		if not conn.workerDone and not conn.toClient.full:
+			workerEvents |= selectors.EVENT_READ
+		if conn.fromClient.pending:
+			workerEvents |= selectors.EVENT_WRITE
+
+		self.setEvents(conn, True, clientEvents)
+		self.setEvents(conn, False, workerEvents)
+
+	def setEvents(self, conn, isClient, events):
+		if isClient is True:
+			(sock, current) = (conn.clientSocket, conn.clientEvents)
+		else:
+			(sock, current) = (conn.workerSocket, conn.workerEvents)
+
+		if events == current:
+			return
+
+		if current == 0:
+			self.selector.register(sock, events, (conn, isClient))
+		elif events == 0:
+			self.selector.unregister(sock)
+		else:
+			self.selector.modify(sock, events, (conn, isClient))
+
+		if isClient is True:
+			conn.clientEvents = events
+		else:
+			conn.workerEvents = events
+
+	def closeSocket(self, sock):
+		if sock is None:
+			return
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except:
+			pass
+		try:
+			sock.close()
+		except:
+			pass
+
+	def closeConnection(self, conn):
+		if conn not in self.connections:
+			return
+		self.connections.discard(conn)
+		self.connecting.discard(conn)
+		if conn.connected is True:
+			self.strategy.onRelease(conn.workerInfo)
+
+		for (isClient, sock) in ((True, conn.clientSocket), (False, conn.workerSocket)):
+			if sock is not None and (conn.clientEvents if isClient else conn.workerEvents):
+				try:
+					self.selector.unregister(sock)
+				except (KeyError, ValueError):
+					pass
+			self.closeSocket(sock)
+
+		conn.clientEvents = conn.workerEvents = 0
+		for pump in (conn.fromClient, conn.toClient):
+			pump and pump.close()
+
+class RelayListener(multiprocessing.Process):
+	''' Listens for client connections and relays them to workers from `numLoops` event-loop processes instead of a process per client '''
+
+	def __init__(self, localAddr, localPort, workers, bufferSize=DEFAULT_BUFFER_SIZE, numLoops=1, zeroCopy=True, strategy=None, healthCheck=None, connectTimeout=DEFAULT_CONNECT_TIMEOUT, connectRetries=DEFAULT_CONNECT_RETRIES, listenBacklog=DEFAULT_LISTEN_BACKLOG, reusePort=False, deferAccept=0):
+		multiprocessing.Process.__init__(self)
+		self.localAddr = localAddr
+		self.localPort = localPort
+		self.workers = workers
+		self.bufferSize = bufferSize
+		self.numLoops = max(1, int(numLoops))
+		self.zeroCopy = zeroCopy
+		self.strategy = strategy
+		self.healthCheck = healthCheck
+		self.connectTimeout = connectTimeout
+		self.connectRetries = connectRetries
+		# shared by every loop, readable from the process that created the listener as well
+		self.connectMetrics = ConnectMetrics()
+		# see listensocket.bindListenSocket
+		self.listenBacklog = listenBacklog
+		self.reusePort = reusePort
+		self.deferAccept = deferAccept
+
+		self.listenSocket = None
+		self.loop = None
+		self.loopProcesses = []
+
+	def closeLoops(self, *args):
+		self.loop and self.loop.stop()
+
+		for loopProcess in self.loopProcesses:
+			try:
+				loopProcess.terminate()
+			except:
+				pass
+
+	def createLoop(self, listenSocket):
+		return RelayLoop(listenSocket, self.workers, self.bufferSize, self.zeroCopy, self.strategy, self.healthCheck, self.connectTimeout, self.connectRetries, self.connectMetrics)
+
+	def raiseFileLimit(self):
+		''' Every relayed client costs two descriptors, so go as high as we are allowed to '''
+		if resource is None:
+			return
+		try:
+			(soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+			if hard == resource.RLIM_INFINITY or hard > soft:
+				resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+		except (ValueError, OSError) as e:
+			logger.warn('Could not raise the open file limit: %s\n' % (str(e),))
+
+	def run(self):
+		self.raiseFileLimit()
+
+		self.listenSocket = listenSocket = bindListenSocket(self.localAddr, self.localPort, self.listenBacklog, self.reusePort, self.deferAccept)
+
+		# The other loops inherit the listening socket and all accept from it
+		for _ in range(self.numLoops - 1):
+			loopProcess = multiprocessing.Process(target=self.createLoop(listenSocket).run)
+			loopProcess.start()
+			self.loopProcesses.append(loopProcess)
+
+		signal.signal(signal.SIGTERM, self.closeLoops)
+
+		self.loop = self.createLoop(listenSocket)
+		try:
+			self.loop.run()
+		except Exception as e:
+			logger.error('Got exception : %s, shutting down relay on %s:%d\n' % (str(e), self.localAddr, self.localPort))
+
+		self.closeLoops()
+		for loopProcess in self.loopProcesses:
+			loopProcess.join(2)
+		logger.info('Connect metrics on %s:%d: %s\n' % (self.localAddr, self.localPort, str(self.connectMetrics)))
+
+		try:
+			listenSocket.close()
+		except:
+			pass
+
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		sys.exit(0)
@@ -0,0 +1,220 @@
+
+import bisect
+import random
+import hashlib
+from logging import getLogger
+
+from .constants import DEFAULT_CONNECT_TIMEOUT
+
+logger = getLogger(__name__)
+
+# virtual nodes per unit of weight on the consistent hashing ring
+HASH_RING_REPLICAS = 100
+# weight of the newest sample in the latency moving average
+EWMA_ALPHA = 0.3
+
+def workerKey(workerInfo):
+	return (workerInfo['addr'], workerInfo['port'])
+
+def workerWeight(workerInfo):
+	return max(1, int(workerInfo.get('weight', 1)))
+
+class BackendStats(object):
+	''' Live counters of one worker, fed by the listener as connections come and go '''
+
+	def __init__(self):
+		self.active = 0
+		self.total = 0
+		self.failures = 0
+		self.samples = 0
+		self.ewmaLatency = 0.0
+
+	def addLatency(self, latency):
+		self.samples += 1
+		if self.samples == 1:
+			self.ewmaLatency = latency
+		else:
+			self.ewmaLatency = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewmaLatency
+
+class Strategy(object):
+	''' Picks the worker a new client connection goes to '''
+
+	name = None
+
+	def __init__(self, workers, failurePenalty=DEFAULT_CONNECT_TIMEOUT):
+		# the latency sample a failed or timed out connect counts as
+		self.failurePenalty = failurePenalty
+		self.stats = {}
+		self.setWorkers(workers)
+
+	def setWorkers(self, workers):
+		''' Replace the candidate workers, keeping the counters of the ones we already know '''
+		self.workers = list(workers)
+		self.stats = dict((workerKey(worker), self.stats.get(workerKey(worker)) or BackendStats()) for worker in self.workers)
+
+	def getStats(self, workerInfo):
+		key = workerKey(workerInfo)
+		if key not in self.stats:
+			self.stats[key] = BackendStats()
+		return self.stats[key]
+
+	def candidates(self, exclude=()):
+		excluded = set(workerKey(worker) for worker in exclude)
+		return [worker for worker in self.workers if workerKey(worker) not in excluded]
+
+	def pick(self, clientAddr=None, exclude=()):
+		''' The worker for a client at `clientAddr` (host, port), skipping the workers in `exclude`. None when nothing is left '''
+		candidates = self.candidates(exclude)
+		if not candidates:
+			return None
+		return self.choose(candidates, clientAddr)
+
+	def choose(self, candidates, clientAddr):
+		raise NotImplementedError()
+
+	def onConnect(self, workerInfo, latency=None):
+		stats = self.getStats(workerInfo)
+		stats.active += 1
+		stats.total += 1
+		if latency is not None:
+			stats.addLatency(latency)
+
+	def onRelease(self, workerInfo):
+		stats = self.getStats(workerInfo)
+		stats.active = max(0, stats.active - 1)
+
+	def onFailure(self, workerInfo):
+		stats = self.getStats(workerInfo)
+		stats.failures += 1
+		stats.addLatency(self.failurePenalty)
+
+class RoundRobinStrategy(Strategy):
+	''' Every worker in turn, in config order '''
+
+	name = 'round_robin'
+
+	def __init__(self, workers, failurePenalty=DEFAULT_CONNECT_TIMEOUT):
+		self.nextIndex = 0
+		Strategy.__init__(self, workers, failurePenalty)
+
+	def choose(self, candidates, clientAddr):
+		workerInfo = candidates[self.nextIndex % len(candidates)]
+		self.nextIndex += 1
+		return workerInfo
+
+class LeastConnectionsStrategy(Strategy):
+	''' The worker with the fewest active connections relative to its weight '''
+
+	name = 'least_conn'
+
+	def choose(self, candidates, clientAddr):
+		return min(candidates, key=lambda worker: (self.getStats(worker).active + 1) / float(workerWeight(worker)))
+
+class PowerOfTwoStrategy(Strategy):
+	''' The less loaded of two workers picked at random '''
+
+	name = 'p2c'
+
+	def choose(self, candidates, clientAddr):
+		if len(candidates) == 1:
+			return candidates[0]
+		(first, second) = random.sample(candidates, 2)
+		firstStats, secondStats = self.getStats(first), self.getStats(second)
+		if (firstStats.active, firstStats.ewmaLatency) <= (secondStats.active, secondStats.ewmaLatency):
+			return first
+		return second
+
+class EwmaLatencyStrategy(Strategy):
+	''' The worker with the lowest moving average connect latency, scaled by its active connections '''
+
+	name = 'ewma'
+
+	def choose(self, candidates, clientAddr):
+		# workers without a sample yet count as the mean of the others, so they get measured without being preferred
+		sampled = [self.getStats(worker).ewmaLatency for worker in candidates if self.getStats(worker).samples]
+		meanLatency = sum(sampled) / len(sampled) if sampled else 0.0
+
+		def score(worker):
+			stats = self.getStats(worker)
+			latency = stats.ewmaLatency if stats.samples else meanLatency
+			# on a tie the least measured one, so a new worker gets its probe
+			return (latency * (stats.active + 1) / workerWeight(worker), stats.samples)
+
+		return min(candidates, key=score)
+
+class WeightedRoundRobinStrategy(Strategy):
+	''' Smooth weighted round-robin (as nginx does it), a worker with weight 3 gets 3 of every N picks, interleaved '''
+
+	name = 'weighted_round_robin'
+
+	def __init__(self, workers, failurePenalty=DEFAULT_CONNECT_TIMEOUT):
+		self.currentWeights = {}
+		Strategy.__init__(self, workers, failurePenalty)
+
+	def choose(self, candidates, clientAddr):
+		totalWeight = 0
+		best = None
+		for worker in candidates:
+			key = workerKey(worker)
+			weight = workerWeight(worker)
+			self.currentWeights[key] = self.currentWeights.get(key, 0) + weight
+			totalWeight += weight
+			if best is None or self.currentWeights[key] > self.currentWeights[workerKey(best)]:
+				best = worker
+
+		self.currentWeights[workerKey(best)] -= totalWeight
+		return best
+
+class ConsistentHashStrategy(Strategy):
+	''' Hashes the client IP onto a ring of workers, a client keeps its worker while the worker set is unchanged '''
+
+	name = 'ip_hash'
+
+	def setWorkers(self, workers):
+		Strategy.setWorkers(self, workers)
+
+		ring = []
+		for worker in self.workers:
+			for replica in range(HASH_RING_REPLICAS * workerWeight(worker)):
+				ring.append((self.hash('%s:%d#%d' % (worker['addr'], worker['port'], replica)), worker))
+		ring.sort(key=lambda point: point[0])
+
+		self.ring = ring
+		self.ringHashes = [point[0] for point in ring]
+
+	@staticmethod
+	def hash(value):
+		return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+	def choose(self, candidates, clientAddr):
+		if not self.ring:
+			return candidates[0]
+
+		allowed = set(workerKey(worker) for worker in candidates)
+		clientIp = clientAddr[0] if clientAddr else ''
+		index = bisect.bisect(self.ringHashes, self.hash(clientIp))
+
+		# walk clockwise past excluded workers
+		for offset in range(len(self.ring)):
+			worker = self.ring[(index + offset) % len(self.ring)][1]
+			if workerKey(worker) in allowed:
+				return worker
+		return candidates[0]
+
+STRATEGIES = dict((strategy.name, strategy) for strategy in (
+	RoundRobinStrategy,
+	LeastConnectionsStrategy,
+	PowerOfTwoStrategy,
+	EwmaLatencyStrategy,
+	WeightedRoundRobinStrategy,
+	ConsistentHashStrategy,
+))
+
+DEFAULT_STRATEGY = RoundRobinStrategy.name
+
+def createStrategy(name, workers, failurePenalty=DEFAULT_CONNECT_TIMEOUT):
+	name = name or DEFAULT_STRATEGY
+	if name not in STRATEGIES:
+		logger.error('Unknown strategy "%s", using "%s"\n' % (name, DEFAULT_STRATEGY))
+		name = DEFAULT_STRATEGY
+	return STRATEGIES[name](workers, failurePenalty)
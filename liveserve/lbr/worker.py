@@ -6,15 +6,17 @@ import select
 import socket
 from logging import getLogger
 
+from .pump import createPump
+from .constants import DEFAULT_CONNECT_TIMEOUT
+
 logger = getLogger(__name__)
 
 DEFAULT_BUFFER_SIZE = 4096
-GRACEFUL_SHUTDOWN_TIME = 6
 
 class Worker(multiprocessing.Process):
 	''' Worker handles the worker-side of processing a request (communicating with a backend and the client ) '''
 
-	def __init__(self, clientSocket, clientAddr, workerAddr, workerPort, bufferSize=DEFAULT_BUFFER_SIZE):
+	def __init__(self, clientSocket, clientAddr, workerAddr, workerPort, bufferSize=DEFAULT_BUFFER_SIZE, zeroCopy=True, fallbackWorkers=(), connectTimeout=DEFAULT_CONNECT_TIMEOUT, metrics=None):
 		multiprocessing.Process.__init__(self)
 
 		self.clientSocket = clientSocket
@@ -25,8 +27,23 @@ class Worker(multiprocessing.Process):
 		self.workerSocket = None
 		# the default size is 4096 bytes
 		self.bufferSize = bufferSize
+		# splice(2) the data between the sockets when the platform allows it
+		self.zeroCopy = zeroCopy
+
+		# workers tried in order, each within connectTimeout, until one accepts
+		self.candidates = [{'addr': workerAddr, 'port': workerPort}] + list(fallbackWorkers)
+		self.connectTimeout = connectTimeout
+		self.metrics = metrics
+
+		# shared with the listener, which feeds them to its strategy and health checker
+		self.attempts = multiprocessing.Value('i', 0)
+		self.connectedIndex = multiprocessing.Value('i', -1)
+		self.connectLatency = multiprocessing.Value('d', 0.0)
+		self.connectReported = False
 
-		self.failedToConnect = multiprocessing.Value('i', 0)
+	def getWorkerInfo(self):
+		''' The candidate we are connected to, the first one until then '''
+		return self.candidates[max(0, self.connectedIndex.value)]
 
 	def closeConnections(self):
 		try:
@@ -55,63 +72,88 @@ class Worker(multiprocessing.Process):
 		self.closeConnections()
 		sys.exit(0)
 
+	def connectWorker(self):
+		''' Connect to the first candidate that accepts within connectTimeout. Returns the socket, None when every candidate failed '''
+		firstStart = time.time()
+
+		for (index, workerInfo) in enumerate(self.candidates):
+			self.attempts.value = index + 1
+			workerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			workerSocket.settimeout(self.connectTimeout)
+
+			connectStart = time.time()
+			try:
+				workerSocket.connect((workerInfo['addr'], workerInfo['port']))
+			except (OSError, socket.timeout) as e:
+				logger.error('Could not connect to worker %s:%d: %s\n' % (workerInfo['addr'], workerInfo['port'], str(e)))
+				workerSocket.close()
+				continue
+
+			workerSocket.settimeout(None)
+			self.connectLatency.value = max(time.time() - connectStart, 1e-6)
+			self.connectedIndex.value = index
+			(self.workerAddr, self.workerPort) = (workerInfo['addr'], workerInfo['port'])
+			if self.metrics is not None:
+				self.metrics.record(index, connectStart - firstStart, True)
+			return workerSocket
+
+		if self.metrics is not None:
+			self.metrics.record(len(self.candidates) - 1, time.time() - firstStart, False)
+		return None
+
 	def run(self):
-		workerSocket = self.workerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		# forked from the listener, do not run its handler
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
 		clientSocket = self.clientSocket
 		bufferSize = self.bufferSize
 
-		try:
-			workerSocket.connect((self.workerAddr, self.workerPort))
-		except:
-			logger.error('Could not connect to worker %s:%d\n' % (self.workerAddr, self.workerPort))
-			self.failedToConnect.value = 1
-			time.sleep(GRACEFUL_SHUTDOWN_TIME)
-			return
+		workerSocket = self.workerSocket = self.connectWorker()
+		if workerSocket is None:
+			logger.error('No worker accepted %s after %d attempts\n' % (str(self.clientAddr), len(self.candidates)))
+			self.closeConnectionsAndExit()
 
-		signal.signal(signal.SIGTERM, self.closeConnectionsAndExit())
+		signal.signal(signal.SIGTERM, lambda *args: self.closeConnectionsAndExit())
+
+		fromClient = createPump(clientSocket, workerSocket, bufferSize, self.zeroCopy)
+		toClient = createPump(workerSocket, clientSocket, bufferSize, self.zeroCopy)
+		pumps = (fromClient, toClient)
 
 		try:
-			dataToClient = b''
-			dataFromClient = b''
-			while True:
-				waitingToWrite = []
-				if dataToClient:
-					waitingToWrite.append(clientSocket)
-				if dataFromClient:
-					waitingToWrite.append(workerSocket)
+			done = False
+			while not done:
+				waitingToRead = [pump.src for pump in pumps if not pump.full]
+				waitingToWrite = [pump.dst for pump in pumps if pump.pending]
 
 				try:
-					(hasDataForRead, readyForWrite, hasErr) = select.select([clientSocket, workerSocket], waitingToWrite, [clientSocket, workerSocket], .3)
+					(hasDataForRead, readyForWrite, hasErr) = select.select(waitingToRead, waitingToWrite, [clientSocket, workerSocket], .3)
 				except KeyboardInterrupt:
 					break
 
 				if hasErr:
 					break
 
-				if clientSocket in hasDataForRead:
-					nextData = clientSocket.recv(bufferSize)
-					if not nextData:
-						break
-					dataFromClient += nextData
-
-				if workerSocket in hasDataForRead:
-					nextData = workerSocket.recv(bufferSize)
-					if not nextData:
-						break
-					dataToClient += nextData
+				for pump in pumps:
+					if pump.src in hasDataForRead:
+						try:
+							if pump.fill() == 0:
+								done = True
+						except BlockingIOError:
+							pass
 
-				if workerSocket in readyForWrite:
-					while dataFromClient:
-						workerSocket.send(dataFromClient[:bufferSize])
-						dataFromClient = dataFromClient[bufferSize:]
+					if pump.dst in readyForWrite:
+						pump.flush()
 
-				if clientSocket in readyForWrite:
-					while dataToClient:
-						clientSocket.send(dataToClient[:bufferSize])
-						dataToClient = dataToClient[bufferSize:]
+			# hand over whatever was already read before closing
+			for pump in pumps:
+				while pump.pending:
+					pump.flush()
 
 		except Exception as e:
 			logger.error("Error on %s:%d: %s\n" % (self.workerAddr, self.workerPort, str(e)))
+		finally:
+			fromClient.close()
+			toClient.close()
 
 		self.closeConnectionsAndExit()
 
@@ -30,13 +30,28 @@ class DomainSetting(Setting):
 		Setting.__init__(self, path)
 
 		self.secret_key = self._get('flask', 'secret_key')
+		# bearer token of the cache admin api (/_cache/purge, /_cache/warmup), which is off without one
+		self.admin_token = self._get('flask', 'admin_token')
 		self.server_domain = self._get('domain', 'server_domain')
 		self.server_port = self._get('domain', 'server_port')
 
 		self.proxy_domain = self._get('domain', 'proxy_domain')
 		self.proxy_port = self._getint('domain', 'proxy_port')
+		# how page links are pointed at us: "stream" (one pass over the markup) or "dom" (through lxml)
+		self.link_rewrite = self._get('domain', 'link_rewrite', 'stream')
 
 		self.html_expired = self._getint("time", "html_expired")
 		self.js_css_expired = self._getint("time", "js_css_expired")
 		self.img_expired = self._getint("time", "img_expired")
 		self.common_expired = self._getint("time", "common_expired")
+
+		self.cache_dir = self._get("cache", "cache_dir", "cache/")
+		self.cache_memory_size = self._getint("cache", "memory_size")
+		self.cache_memory_max_object = self._getint("cache", "memory_max_object")
+		self.cache_stale_while_revalidate = self._getint("cache", "stale_while_revalidate")
+		self.cache_stale_if_error = self._getint("cache", "stale_if_error")
+		self.cache_open_files = self._getint("cache", "open_files")
+		# what the disk cache may hold, and which objects go first past that: "lru", "lfu" or "tinylfu"
+		self.cache_max_size = self._getint("cache", "max_size")
+		self.cache_max_entries = self._getint("cache", "max_entries")
+		self.cache_eviction = self._get("cache", "eviction")
@@ -1,7 +1,7 @@
 
 
 from .urlprocessing import get_url_suffix
-from .pageparse import HTMLParser, JSCSSParse, ImageParse, CommonParse
+from .pageparse import HTMLParser, JSCSSParse, ImageParse, CommonParse, cached_suffix
 
 class PageManagment(object):
 
@@ -12,7 +12,10 @@ class PageManagment(object):
 		headers : used in the methods: requests.get()
 		kwargs[ip] : visiotr's ip address
 		'''
-		suffix = get_url_suffix(new_path)
+		(suffix, response) = get_url_suffix(new_path, cached_suffix, kwargs.get('headers'))
+		if response is not None:
+			# the page's own GET, it was classified by
+			kwargs['response'] = response
 		if suffix == "html":
 			return HTMLParser(new_path, **kwargs)
 		elif suffix in ["js", "css"]:
@@ -21,5 +24,5 @@ class PageManagment(object):
 			return ImageParse(new_path, suffix, **kwargs)
 		elif suffix:
 			return CommonParse(new_path, suffix, **kwargs)
-		else:
-			pass
\ No newline at end of file
+		elif response is not None:
+			response.close()
\ No newline at end of file
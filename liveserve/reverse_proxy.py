@@ -1,17 +1,83 @@
 
 
+import io
 import os
-import argparse
-import random
+import ssl
 import sys
+import time
+import random
+import signal
+import asyncio
+import argparse
+import contextlib
+import resource
 import requests
 import threading
+import http.client
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 from socketserver import ThreadingMixIn
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
 # the hostname
 hostname = 'en.wikipedia.org'
+# how the upstream is reached, http for a plain local upstream
+upstream_scheme = 'https'
+
+# connections kept open per upstream host
+POOL_SIZE = 32
+# seconds a pooled connection may sit unused before it is dropped
+POOL_IDLE_TIMEOUT = 30
+# seconds after which a pooled connection is dropped however busy it is
+POOL_MAX_LIFETIME = 300
+
+# bytes relayed per read of an upstream body, the most a request holds in memory
+CHUNK_SIZE = 64 * 1024
+
+# asyncio server: most clients served at once, and how many wait in the accept backlog
+ASYNC_MAX_CONNECTIONS = 10000
+ASYNC_LISTEN_BACKLOG = 1024
+# asyncio server: seconds a client may take to send a request head, and in-flight requests get to finish on shutdown
+ASYNC_HEADER_TIMEOUT = 60
+ASYNC_DRAIN_TIMEOUT = 30
+# longest request or response head accepted by the asyncio server
+MAX_HEADER_SIZE = 64 * 1024
+# asyncio server: upstream connections open at once (requests uploading or responses being relayed to a client), and
+# seconds a request waits for one of them or for an in-flight slot before it gets a 503
+ASYNC_MAX_UPSTREAM_CONNECTIONS = 512
+ASYNC_ACQUIRE_TIMEOUT = 10
+# asyncio server: request bodies up to this size are read from the client before anything upstream is taken
+ASYNC_BUFFERED_BODY_SIZE = 64 * 1024
+
+# headers that only describe one hop, never forwarded either way
+HOP_BY_HOP_HEADERS = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade']
+
+# added to every response sent to a client
+DEFAULT_RESPONSE_HEADERS = [('User-Agent', 'GoLive DNet Server/0.1')]
+
+def filter_request_headers(headers):
+	''' The client request headers worth forwarding upstream '''
+	req_header = {}
+	for key, value in headers.items():
+		# the client's keep-alive is not the upstream's
+		if key.lower() not in HOP_BY_HOP_HEADERS:
+			req_header[key] = value.strip()
+	return req_header
+
+def filter_response_headers(headers):
+	''' The upstream response headers worth relaying to the client, as (key, value) pairs '''
+	# the body is relayed as the upstream encoded it, so Content-Encoding and Content-Length still hold
+	return [(key, value) for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS]
+
+def response_framing(headers, status, body, request_version):
+	''' How the relayed body ends: None with a Content-Length (or no body), 'chunked', or 'close' for HTTP/1.0 clients '''
+	if not body or status in (204, 304) or 'content-length' in headers:
+		return None
+	if request_version == 'HTTP/1.1':
+		return 'chunked'
+	return 'close'
 
 def merget_dicts(x, y):
 	return x | y
@@ -23,9 +89,141 @@ def set_header():
 
 	return headers
 
+class AgingPoolMixin(object):
+	''' Drops pooled connections that sat idle longer than `idle_timeout` or are older than `max_lifetime` '''
+	idle_timeout = POOL_IDLE_TIMEOUT
+	max_lifetime = POOL_MAX_LIFETIME
+
+	def _get_conn(self, timeout=None):
+		conn = super()._get_conn(timeout)
+		born = getattr(conn, 'pool_born', None)
+		now = time.monotonic()
+		if born is not None and (now - conn.pool_last_used > self.idle_timeout or now - born > self.max_lifetime):
+			# reconnects on its next request
+			conn.close()
+			conn.pool_born = None
+		return conn
+
+	def _put_conn(self, conn):
+		if conn is not None:
+			now = time.monotonic()
+			if getattr(conn, 'pool_born', None) is None:
+				conn.pool_born = now
+			conn.pool_last_used = now
+		super()._put_conn(conn)
+
+class AgingHTTPConnectionPool(AgingPoolMixin, HTTPConnectionPool):
+	pass
+
+class AgingHTTPSConnectionPool(AgingPoolMixin, HTTPSConnectionPool):
+	pass
+
+class UpstreamPool(object):
+	''' One requests session per upstream host, shared by every handler thread so connections (and TLS sessions) are reused '''
+
+	def __init__(self, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, max_lifetime=POOL_MAX_LIFETIME):
+		self.size = size
+		self.idle_timeout = idle_timeout
+		self.max_lifetime = max_lifetime
+		self.sessions = {}
+		self.lock = threading.Lock()
+
+	def get_session(self, host):
+		session = self.sessions.get(host)
+		if session is not None:
+			return session
+
+		with self.lock:
+			if host not in self.sessions:
+				self.sessions[host] = self._new_session()
+			return self.sessions[host]
+
+	def _new_session(self):
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.size, pool_block=False)
+		pool_classes = {}
+		for scheme, base in (('http', AgingHTTPConnectionPool), ('https', AgingHTTPSConnectionPool)):
+			pool_classes[scheme] = type(base.__name__, (base,), {'idle_timeout': self.idle_timeout, 'max_lifetime': self.max_lifetime})
+		adapter.poolmanager.pool_classes_by_scheme = pool_classes
+
+		session = requests.Session()
+		session.verify = False
+		# bodies are relayed undecoded, only ask for an encoding when the client did
+		session.headers['Accept-Encoding'] = 'identity'
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		return session
+
+	def close(self):
+		with self.lock:
+			for session in self.sessions.values():
+				session.close()
+			self.sessions.clear()
+
+def request_body_length(headers):
+	''' The length of a client request body, None when it is chunked. ValueError for a Content-Length that is not a length '''
+	if 'chunked' in headers.get('transfer-encoding', '').lower():
+		return None
+	length = int(headers.get('content-length', 0))
+	if length < 0:
+		raise ValueError('negative Content-Length %d' % (length,))
+	return length
+
+class RequestBodyReader(object):
+	''' File-like view of the next `length` bytes of a client request body, so requests streams the upload instead of us reading it whole '''
+
+	def __init__(self, rfile, length):
+		self.rfile = rfile
+		self.remaining = length
+
+	def __len__(self):
+		return self.remaining
+
+	def read(self, size=-1):
+		if self.remaining <= 0:
+			return b''
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.rfile.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def finished(self):
+		return self.remaining <= 0
+
+class ChunkedBodyReader(object):
+	''' The data of a chunked client request body, CHUNK_SIZE bytes at a time. requests uploads an iterable chunked again '''
+
+	def __init__(self, rfile):
+		self.rfile = rfile
+		self.done = False
+
+	def __iter__(self):
+		while True:
+			size = int(self.rfile.readline(MAX_HEADER_SIZE).split(b';')[0].strip(), 16)
+			if size == 0:
+				# skip the trailers
+				while self.rfile.readline(MAX_HEADER_SIZE) not in (b'\r\n', b'\n', b''):
+					pass
+				self.done = True
+				return
+			while size > 0:
+				data = self.rfile.read(min(size, CHUNK_SIZE))
+				if not data:
+					raise ConnectionError('client closed the connection in a chunk')
+				size -= len(data)
+				yield data
+			self.rfile.read(2)
+
+	def finished(self):
+		return self.done
+
+# shared by the handler threads, replaced in main() with the command line settings
+upstream_pool = UpstreamPool()
+
 # Proxy HTTP Request Handler Class
 class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
-	protocol_version = 'HTTP/1.0'
+	# keep client connections open between requests, bodies are framed by Content-Length or chunks
+	protocol_version = 'HTTP/1.1'
 
 	def get_connection_id(self):
 		return self.path.split('/')[-1]
@@ -36,87 +234,493 @@ class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
 
 	def do_GET(self, body=True):
 		sent = False
+		resp = None
 		try:
-			url = 'https://{}{}'.format(hostname, self.path)
+			url = '{}://{}{}'.format(upstream_scheme, hostname, self.path)
 			req_header = self.parse_headers()
 
 			print(req_header)
 			print(url)
 
-			resp = requests.get(url, headers=merget_dicts(req_header, set_header()), verify=False)
+			method = 'GET' if body else 'HEAD'
+			resp = upstream_pool.get_session(hostname).request(method, url, headers=merget_dicts(req_header, set_header()), stream=True)
 			sent = True
 
 			self.send_response(resp.status_code)
-			self.send_resp_headers(resp)
-			msg = resp.text
+			self.send_resp_headers(resp, body)
 			if body:
-				self.wfile.write(msg.encode(encoding='UTF-8', errors='strict'))
+				self.relay_body(resp)
 			return
 		finally:
+			if resp is not None:
+				resp.close()
 			if not sent:
 				self.send_error(404, 'error trying to proxy')
 
 	def do_POST(self, body=True):
+		try:
+			content_len = request_body_length(self.headers)
+		except ValueError:
+			# where the body ends is unknown, and so is where the next request starts: send_error() closes the connection
+			self.send_error(400, 'bad Content-Length')
+			return
+
 		sent = False
+		resp = None
 
 		try:
-			url = 'https://{}{}'.format(hostname, self.path)
-			content_len = int(self.headers.getheader('content-length', 0))
-			post_body = self.rfile.read(content_len)
+			url = '{}://{}{}'.format(upstream_scheme, hostname, self.path)
 			req_header = self.parse_headers()
+			# read by requests in blocks as it uploads, never held whole
+			if content_len is None:
+				post_body = ChunkedBodyReader(self.rfile)
+				req_header = dict((key, value) for key, value in req_header.items() if key.lower() != 'content-length')
+			else:
+				post_body = RequestBodyReader(self.rfile, content_len)
 
-			resp = requests.post(url, data=post_body, headers=merget_dicts(req_header, set_header()), verify=False)
+			resp = upstream_pool.get_session(hostname).post(url, data=post_body, headers=merget_dicts(req_header, set_header()), stream=True)
 			sent = True
+			if not post_body.finished():
+				# the upstream answered without the whole body, the rest of it is still in the way of the next request
+				self.close_connection = True
 
 			self.send_response(resp.status_code)
-			self.send_resp_headers(resp)
+			self.send_resp_headers(resp, body)
 			if body:
-				self.wfile.write(resp.content)
+				self.relay_body(resp)
 			return
 		finally:
+			if resp is not None:
+				resp.close()
 			if not sent:
 				self.send_error(404, 'error trying to proxy')
 
 	def parse_headers(self):
-		req_header = {}
-		for line in self.headers:
-			line_parts = [o.strip() for o in line.split(':', 1)]
-			if len(line_parts) == 2:
-				req_header[line_parts[0]] = line_parts[1]
-		return req_header
-
-	def send_resp_headers(self, resp):
-		respheaders = resp.headers
+		return filter_request_headers(self.headers)
+
+	def send_resp_headers(self, resp, body=True):
 		print('Response Header')
-		for key in respheaders:
-			if key not in ['Content-Encoding', 'Transfer-Encoding', 'content-encoding', 'transfer-encoding', 'content-length', 'Content-Length']:
-				print(key, respheaders[key])
-				self.send_header(key, respheaders[key])
-		# default headers
-		self.send_header('Content-Length', len(resp.content))
-		self.send_header('User-Agent', 'GoLive DNet Server/0.1')
+		for key, value in filter_response_headers(resp.headers):
+			print(key, value)
+			self.send_header(key, value)
+
+		framing = response_framing(resp.headers, resp.status_code, body, self.request_version)
+		self.chunked = framing == 'chunked'
+		if self.chunked:
+			self.send_header('Transfer-Encoding', 'chunked')
+		elif framing == 'close':
+			self.close_connection = True
+
+		for key, value in DEFAULT_RESPONSE_HEADERS:
+			self.send_header(key, value)
 		self.end_headers()
 
+	def relay_body(self, resp):
+		''' Copy the upstream body to the client CHUNK_SIZE bytes at a time '''
+		for chunk in resp.raw.stream(CHUNK_SIZE, decode_content=False):
+			if not chunk:
+				continue
+			if self.chunked:
+				self.wfile.write(b'%x\r\n' % len(chunk))
+				self.wfile.write(chunk)
+				self.wfile.write(b'\r\n')
+			else:
+				self.wfile.write(chunk)
+
+		if self.chunked:
+			self.wfile.write(b'0\r\n\r\n')
+
+class AsyncUpstreamConnection(object):
+	''' One keep-alive connection to the upstream, used by a single request at a time '''
+
+	def __init__(self, reader, writer):
+		self.reader = reader
+		self.writer = writer
+		self.born = time.monotonic()
+		self.last_used = self.born
+
+	def close(self):
+		self.writer.close()
+
+class AsyncUpstreamPool(object):
+	''' Idle upstream connections of the asyncio server, aged like the threaded pool
+
+	`size` caps the requests the upstream is answering at once, the exchange() slots. The connections checked out, which
+	also carry uploads and responses to slow clients, are capped apart by `max_connections`.
+	'''
+
+	def __init__(self, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, max_lifetime=POOL_MAX_LIFETIME, max_connections=ASYNC_MAX_UPSTREAM_CONNECTIONS, acquire_timeout=ASYNC_ACQUIRE_TIMEOUT):
+		self.size = size
+		self.idle_timeout = idle_timeout
+		self.max_lifetime = max_lifetime
+		self.acquire_timeout = acquire_timeout
+		self.idle = []
+		self.in_flight = asyncio.Semaphore(size)
+		self.connections = asyncio.Semaphore(max_connections)
+
+		self.ssl_context = None
+		if upstream_scheme == 'https':
+			# like session.verify = False in the threaded pool
+			self.ssl_context = ssl.create_default_context()
+			self.ssl_context.check_hostname = False
+			self.ssl_context.verify_mode = ssl.CERT_NONE
+
+	async def acquire(self):
+		''' Wait for a connection of the budget, then reuse an idle one or open a new one. asyncio.TimeoutError when none frees up '''
+		await asyncio.wait_for(self.connections.acquire(), self.acquire_timeout)
+		try:
+			now = time.monotonic()
+			while self.idle:
+				conn = self.idle.pop()
+				if conn.reader.at_eof() or now - conn.last_used > self.idle_timeout or now - conn.born > self.max_lifetime:
+					conn.close()
+					continue
+				return conn
+
+			host, _, port = hostname.partition(':')
+			if not port:
+				port = 443 if upstream_scheme == 'https' else 80
+			reader, writer = await asyncio.open_connection(host, int(port), ssl=self.ssl_context, limit=MAX_HEADER_SIZE)
+			return AsyncUpstreamConnection(reader, writer)
+		except BaseException:
+			self.connections.release()
+			raise
+
+	def release(self, conn, reusable):
+		self.connections.release()
+		if reusable and len(self.idle) < self.size:
+			conn.last_used = time.monotonic()
+			self.idle.append(conn)
+		else:
+			conn.close()
+
+	@contextlib.asynccontextmanager
+	async def exchange(self):
+		''' An in-flight slot while the upstream answers a request. asyncio.TimeoutError when none frees up '''
+		await asyncio.wait_for(self.in_flight.acquire(), self.acquire_timeout)
+		try:
+			yield
+		finally:
+			self.in_flight.release()
+
+	def close(self):
+		for conn in self.idle:
+			conn.close()
+		self.idle = []
+
+class MessageBody(object):
+	''' The body of an HTTP message on `reader`, framed as its headers say. After `chunks()` is exhausted `reusable` tells whether the connection can carry another message '''
+
+	def __init__(self, reader, headers, status=None, method=None):
+		self.reader = reader
+		self.headers = headers
+		self.status = status
+		self.method = method
+		self.reusable = False
+
+	def empty(self):
+		return self.method == 'HEAD' or self.status in (204, 304) or (self.status is not None and self.status < 200)
+
+	def is_chunked(self):
+		return 'chunked' in self.headers.get('transfer-encoding', '').lower()
+
+	async def chunks(self):
+		''' Yield the body CHUNK_SIZE bytes at a time '''
+		reader = self.reader
+		if self.empty():
+			self.reusable = True
+			return
+
+		if self.is_chunked():
+			while True:
+				size = int((await reader.readline()).split(b';')[0].strip(), 16)
+				if size == 0:
+					# skip the trailers
+					while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+						pass
+					break
+				while size > 0:
+					chunk = await reader.read(min(size, CHUNK_SIZE))
+					if not chunk:
+						raise asyncio.IncompleteReadError(b'', size)
+					size -= len(chunk)
+					yield chunk
+				await reader.readexactly(2)
+			self.reusable = True
+			return
+
+		if 'content-length' in self.headers or self.status is None:
+			# a request without a length has no body
+			remaining = int(self.headers.get('content-length', 0))
+			while remaining > 0:
+				chunk = await reader.read(min(remaining, CHUNK_SIZE))
+				if not chunk:
+					raise asyncio.IncompleteReadError(b'', remaining)
+				remaining -= len(chunk)
+				yield chunk
+			self.reusable = True
+			return
+
+		# the body ends with the connection
+		while True:
+			chunk = await reader.read(CHUNK_SIZE)
+			if not chunk:
+				return
+			yield chunk
+
+async def read_message_head(reader):
+	''' The first line and the headers of an HTTP message, None when the peer closed before starting one '''
+	try:
+		head = await reader.readuntil(b'\r\n\r\n')
+	except asyncio.IncompleteReadError as e:
+		if e.partial.strip():
+			raise
+		return None
+	first_line, _, header_block = head.partition(b'\r\n')
+	return first_line.decode('latin-1'), http.client.parse_headers(io.BytesIO(header_block))
+
+async def read_response_head(reader):
+	''' The head of the final response on `reader`, skipping interim ones (100 Continue) '''
+	resp_head = await read_message_head(reader)
+	while resp_head is not None and resp_head[0].split(' ', 2)[1].startswith('1'):
+		resp_head = await read_message_head(reader)
+	if resp_head is None:
+		raise ConnectionError('upstream closed the connection')
+	return resp_head
+
+def encode_head(first_line, headers):
+	lines = [first_line] + ['%s: %s' % (key, value) for key, value in headers]
+	return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+async def read_chunks(body):
+	''' The chunks of a MessageBody, read whole '''
+	return [chunk async for chunk in body.chunks()]
+
+async def write_body(writer, body, chunked):
+	''' Relay a MessageBody to `writer`, waiting for a slow reader before each new chunk '''
+	async for chunk in body.chunks():
+		if chunked:
+			writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+		else:
+			writer.write(chunk)
+		await writer.drain()
+
+	if chunked:
+		writer.write(b'0\r\n\r\n')
+	await writer.drain()
+
+class AsyncProxyServer(object):
+	''' The reverse proxy on one asyncio loop: a coroutine per client connection instead of a thread, and upstream I/O that never blocks
+
+	At most `max_connections` clients are served at once, the ones beyond get a 503.
+	On SIGINT/SIGTERM it stops accepting, closes idle keep-alive connections and gives requests in progress `drain_timeout` seconds to finish.
+	'''
+
+	def __init__(self, address, pool, max_connections=ASYNC_MAX_CONNECTIONS, drain_timeout=ASYNC_DRAIN_TIMEOUT):
+		self.address = address
+		self.pool = pool
+		self.max_connections = max_connections
+		self.drain_timeout = drain_timeout
+		# connection task -> True while it waits for the client's next request
+		self.connections = {}
+		self.draining = False
+		self.server = None
+
+	async def serve(self):
+		self.server = await asyncio.start_server(self.handle_client, self.address[0], self.address[1], limit=MAX_HEADER_SIZE, backlog=ASYNC_LISTEN_BACKLOG)
+
+		stop = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		for signum in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(signum, stop.set)
+
+		await stop.wait()
+		await self.drain()
+
+	async def drain(self):
+		self.draining = True
+		self.server.close()
+
+		for task, idle in list(self.connections.items()):
+			if idle:
+				task.cancel()
+
+		busy = list(self.connections)
+		if busy:
+			(_, pending) = await asyncio.wait(busy, timeout=self.drain_timeout)
+			for task in pending:
+				task.cancel()
+			await asyncio.gather(*pending, return_exceptions=True)
+
+		self.pool.close()
+
+	async def handle_client(self, reader, writer):
+		if self.draining or len(self.connections) >= self.max_connections:
+			writer.write(encode_head('HTTP/1.1 503 Service Unavailable', [('Content-Length', '0'), ('Connection', 'close')]))
+			writer.close()
+			return
+
+		task = asyncio.current_task()
+		self.connections[task] = True
+		try:
+			keep_alive = True
+			while keep_alive and not self.draining:
+				self.connections[task] = True
+				head = await asyncio.wait_for(read_message_head(reader), ASYNC_HEADER_TIMEOUT)
+				if head is None:
+					break
+				self.connections[task] = False
+				keep_alive = await self.handle_request(reader, writer, head)
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+			pass
+		finally:
+			del self.connections[task]
+			writer.close()
+
+	async def send_error(self, writer, code, message):
+		body = message.encode('utf-8')
+		writer.write(encode_head('HTTP/1.1 %d %s' % (code, message), [('Content-Length', str(len(body))), ('Connection', 'close')]) + body)
+		await writer.drain()
+
+	async def handle_request(self, reader, writer, head):
+		''' Proxy one request, True when the client connection can carry another one '''
+		request_line, headers = head
+		(method, path, version) = request_line.split(' ', 2)
+		keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+		try:
+			length = request_body_length(headers)
+		except ValueError:
+			await self.send_error(writer, 400, 'Bad Request')
+			return False
+		request_body = MessageBody(reader, headers)
+
+		buffered = None
+		if length is not None and length <= ASYNC_BUFFERED_BODY_SIZE:
+			# read while nothing upstream is taken, however slowly the client sends it
+			buffered = b''.join(await asyncio.wait_for(read_chunks(request_body), ASYNC_HEADER_TIMEOUT))
+
+		req_header = merget_dicts(filter_request_headers(headers), set_header())
+		# bodies are relayed undecoded, only ask for an encoding when the client did
+		if 'accept-encoding' not in headers:
+			req_header['Accept-Encoding'] = 'identity'
+		if request_body.is_chunked():
+			req_header['Transfer-Encoding'] = 'chunked'
+
+		started = False
+		reusable = False
+		try:
+			conn = await self.pool.acquire()
+		except asyncio.TimeoutError:
+			await self.send_error(writer, 503, 'Service Unavailable')
+			return False
+		except OSError:
+			await self.send_error(writer, 404, 'error trying to proxy')
+			return False
+
+		try:
+			request_head = encode_head('%s %s HTTP/1.1' % (method, path), req_header.items())
+			if buffered is not None:
+				async with self.pool.exchange():
+					conn.writer.write(request_head + buffered)
+					await conn.writer.drain()
+					resp_head = await read_response_head(conn.reader)
+			else:
+				# a body too large to hold is uploaded on the connection alone, the slot is taken once it is sent
+				conn.writer.write(request_head)
+				await write_body(conn.writer, request_body, request_body.is_chunked())
+				async with self.pool.exchange():
+					resp_head = await read_response_head(conn.reader)
+
+			(status_line, resp_headers) = resp_head
+			(_, status, reason) = (status_line.split(' ', 2) + [''])[:3]
+			status = int(status)
+			response_body = MessageBody(conn.reader, resp_headers, status, method)
+
+			framing = response_framing(resp_headers, status, method != 'HEAD', version)
+			resp_header = filter_response_headers(resp_headers)
+			if framing == 'chunked':
+				resp_header.append(('Transfer-Encoding', 'chunked'))
+			elif framing == 'close':
+				keep_alive = False
+			resp_header.extend(DEFAULT_RESPONSE_HEADERS)
+
+			# the response is relayed on the connection alone, a slow reader holds no in-flight slot
+			started = True
+			writer.write(encode_head('HTTP/1.1 %d %s' % (status, reason), resp_header))
+			await write_body(writer, response_body, framing == 'chunked')
+			reusable = response_body.reusable
+		except asyncio.TimeoutError:
+			if started:
+				return False
+			await self.send_error(writer, 503, 'Service Unavailable')
+			return False
+		except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+			if started:
+				# the client already has part of the response, only closing tells it something went wrong
+				return False
+			await self.send_error(writer, 404, 'error trying to proxy')
+			return False
+		finally:
+			self.pool.release(conn, reusable)
+
+		return keep_alive and request_body.reusable
+
+def raise_file_limit():
+	''' Every proxied client costs a descriptor, and one more while its request is upstream '''
+	try:
+		(soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+		if hard == resource.RLIM_INFINITY or hard > soft:
+			resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+	except (ValueError, OSError) as e:
+		print('Could not raise the open file limit: %s' % (e,))
+
 def parse_args(argv=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Proxy HTTP requests')
     parser.add_argument('--port', dest='port', type=int, default=9999,
                         help='serve HTTP requests on specified port (default: random)')
     parser.add_argument('--hostname', dest='hostname', type=str, default='en.wikipedia.org',
                         help='hostname to be processd (default: en.wikipedia.org)')
+    parser.add_argument('--pool-size', dest='pool_size', type=int, default=POOL_SIZE,
+                        help='connections kept open per upstream host (default: %d)' % POOL_SIZE)
+    parser.add_argument('--pool-idle-timeout', dest='pool_idle_timeout', type=float, default=POOL_IDLE_TIMEOUT,
+                        help='seconds an unused upstream connection is kept (default: %d)' % POOL_IDLE_TIMEOUT)
+    parser.add_argument('--pool-max-lifetime', dest='pool_max_lifetime', type=float, default=POOL_MAX_LIFETIME,
+                        help='seconds before an upstream connection is recycled (default: %d)' % POOL_MAX_LIFETIME)
+    parser.add_argument('--upstream-scheme', dest='upstream_scheme', choices=['https', 'http'], default='https',
+                        help='how the upstream is reached (default: https)')
+    parser.add_argument('--server', dest='server', choices=['threaded', 'asyncio'], default='threaded',
+                        help='a thread per client connection, or every client on one asyncio loop (default: threaded)')
+    parser.add_argument('--max-connections', dest='max_connections', type=int, default=ASYNC_MAX_CONNECTIONS,
+                        help='asyncio server: clients served at once (default: %d)' % ASYNC_MAX_CONNECTIONS)
+    parser.add_argument('--max-upstream-connections', dest='max_upstream_connections', type=int, default=ASYNC_MAX_UPSTREAM_CONNECTIONS,
+                        help='asyncio server: upstream connections open at once, slow clients included (default: %d)' % ASYNC_MAX_UPSTREAM_CONNECTIONS)
+    parser.add_argument('--drain-timeout', dest='drain_timeout', type=float, default=ASYNC_DRAIN_TIMEOUT,
+                        help='asyncio server: seconds requests in progress get to finish on shutdown (default: %d)' % ASYNC_DRAIN_TIMEOUT)
     args = parser.parse_args(argv)
     return args
 
-
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+	''' A thread per client connection, which now lives for many requests '''
+	daemon_threads = True
 
 
 def main(argv=sys.argv[1:]):
-	global hostname
+	global hostname, upstream_scheme, upstream_pool
 	args = parse_args(argv)
 	hostname = args.hostname
+	upstream_scheme = args.upstream_scheme
 	print('Reverse proxy starting on {} port {}'.format(args.hostname, args.port))
 	server_address = ('127.0.0.1', args.port)
+
+	if args.server == 'asyncio':
+		raise_file_limit()
+		pool = AsyncUpstreamPool(args.pool_size, args.pool_idle_timeout, args.pool_max_lifetime, args.max_upstream_connections)
+		asyncio.run(AsyncProxyServer(server_address, pool, args.max_connections, args.drain_timeout).serve())
+		return
+
+	upstream_pool = UpstreamPool(args.pool_size, args.pool_idle_timeout, args.pool_max_lifetime)
 	httpd = ThreadedHTTPServer(server_address, ProxyHTTPRequestHandler)
 	httpd.serve_forever()
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
\ No newline at end of file
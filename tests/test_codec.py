@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli'))
+
+try:
+	import bson
+except ImportError:
+	# the client's codecs need the bson package it depends on
+	raise unittest.SkipTest('bson is not installed')
+
+from codec import BSONCodec, BinaryCodec, CODECS, get_codec
+
+HEADERS = {'Host': 'demo.example.com', 'Accept': 'text/html', 'Cookie': 'a=1; b=2'}
+
+MESSAGES = [
+	{'id': 'r1', 'method': 'GET', 'uri': '/a?b=c', 'url': '/a?b=c', 'header': HEADERS, 'body': b''},
+	{'id': 'r2', 'method': 'POST', 'uri': '/items', 'url': '/items', 'header': HEADERS, 'body': os.urandom(2048)},
+	{'id': 'r3', 'method': 'PROPFIND', 'uri': '/dav', 'url': '/dav', 'header': HEADERS},
+	{'id': 'r4', 'method': 'PUT', 'uri': '/up', 'url': '/up', 'header': HEADERS, 'stream': True},
+	{'request_id': 'r1', 'token': 't' * 32, 'status': 200, 'header': {'Content-Type': 'text/html'}, 'body': b'<p>hi</p>'},
+	{'request_id': 'r2', 'token': 't' * 32, 'status': 500, 'header': {}, 'error': 'local server unreachable'},
+	{'type': 'start', 'request_id': 'r3', 'token': 't' * 32, 'seq': 0, 'status': 200, 'header': {'Content-Type': 'video/mp4'}},
+	{'type': 'data', 'request_id': 'r3', 'token': 't' * 32, 'seq': 7, 'body': os.urandom(256 * 1024)},
+	{'type': 'end', 'request_id': 'r3', 'token': 't' * 32, 'seq': 8},
+	{'type': 'data', 'id': 'r4', 'uri': '', 'url': '', 'seq': 1, 'body': b'chunk', 'stream': True},
+	{'request_id': 'r5', 'token': 't', 'status': 200, 'body': b'\x28\xb5\x2f\xfd', 'body_encoding': 'zstd'},
+	{'id': 'r6', 'method': 'MKCOL', 'uri': '/dav/new', 'url': '/dav/new'},
+]
+
+def plain(message):
+	''' `message` with a bytes body, as the codecs are compared '''
+	message = dict(message)
+	if message.get('body') is not None:
+		message['body'] = bytes(message['body'])
+	return message
+
+class CodecTest(unittest.TestCase):
+	def test_binary_round_trip(self):
+		for message in MESSAGES:
+			with self.subTest(message=message.get('id') or message.get('request_id'), type=message.get('type')):
+				self.assertEqual(plain(BinaryCodec.decode(BinaryCodec.encode(message))), message)
+
+	def test_bson_round_trip(self):
+		for message in MESSAGES:
+			with self.subTest(message=message.get('id') or message.get('request_id'), type=message.get('type')):
+				self.assertEqual(plain(BSONCodec.decode(BSONCodec.encode(message))), message)
+
+	def test_binary_body_is_a_view(self):
+		data = BinaryCodec.encode(MESSAGES[1])
+		body = BinaryCodec.decode(data)['body']
+		self.assertIsInstance(body, memoryview)
+		self.assertEqual(bytes(body), MESSAGES[1]['body'])
+
+	def test_unicode_strings_and_headers(self):
+		message = {'id': 'ü', 'method': 'GET', 'uri': '/café', 'url': '/café', 'header': {'X-Name': 'Zoë'}, 'body': b''}
+		self.assertEqual(plain(BinaryCodec.decode(BinaryCodec.encode(message))), message)
+
+	def test_header_only_when_sent(self):
+		for message in MESSAGES:
+			with self.subTest(message=message.get('id') or message.get('request_id'), type=message.get('type')):
+				self.assertEqual('header' in BinaryCodec.decode(BinaryCodec.encode(message)), 'header' in message)
+
+	def test_get_codec(self):
+		self.assertIs(get_codec('binary'), BinaryCodec)
+		self.assertIs(get_codec(None), BSONCodec)
+		self.assertIs(get_codec('unknown'), BSONCodec)
+		self.assertEqual(sorted(CODECS), ['binary', 'bson'])
+
+if __name__ == '__main__':
+	unittest.main()
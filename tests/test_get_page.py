@@ -0,0 +1,88 @@
+import os
+import sys
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'liveserve'))
+
+import get_page
+
+class Origin(BaseHTTPRequestHandler):
+	# path -> (status, content type or None)
+	pages = {
+		'/page': (200, 'text/html; charset=utf-8'),
+		'/logo': (200, 'image/png'),
+		'/missing': (404, 'text/html'),
+		'/broken': (500, None),
+	}
+	requests = []
+
+	def do_GET(self):
+		self.requests.append((self.path, dict(self.headers)))
+		(status, content_type) = self.pages.get(self.path, (404, None))
+		self.send_response(status)
+		if content_type:
+			self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', '2')
+		self.end_headers()
+		self.wfile.write(b'ok')
+
+	def log_message(self, *args):
+		pass
+
+class GetUrlSuffixTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.server = HTTPServer(('127.0.0.1', 0), Origin)
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+		cls.base = 'http://127.0.0.1:%d' % (cls.server.server_address[1],)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+
+	def setUp(self):
+		get_page.suffix_cache = get_page.SuffixCache()
+		del Origin.requests[:]
+
+	def classify(self, path, cached_suffix=None, headers=None):
+		(suffix, res) = get_page.get_url_suffix(self.base + path, cached_suffix, headers)
+		if res is not None:
+			res.close()
+		return suffix, res
+
+	def test_classified_by_the_get(self):
+		(suffix, res) = self.classify('/logo')
+		self.assertEqual(suffix, 'png')
+		self.assertEqual(res.status_code, 200)
+		# remembered, the next request asks nobody
+		self.assertEqual(self.classify('/logo'), ('png', None))
+		self.assertEqual(len(Origin.requests), 1)
+
+	def test_static_extension_and_cached_page_ask_nobody(self):
+		self.assertEqual(self.classify('/style.css'), ('css', None))
+		self.assertEqual(self.classify('/page', cached_suffix=lambda url: 'html'), ('html', None))
+		self.assertEqual(Origin.requests, [])
+
+	def test_error_without_extension_is_a_page(self):
+		(suffix, res) = self.classify('/missing')
+		self.assertEqual((suffix, res.status_code), ('html', 404))
+		(suffix, res) = self.classify('/broken')
+		self.assertEqual((suffix, res.status_code), (get_page.ERROR_SUFFIX, 500))
+		# an error is not what the url is, the next request asks again
+		self.assertEqual(get_page.suffix_cache.get(self.base + '/missing'), (False, None))
+
+	def test_unreachable_origin(self):
+		(suffix, res) = get_page.get_url_suffix('http://127.0.0.1:1/nothing')
+		self.assertEqual((suffix, res), (get_page.ERROR_SUFFIX, None))
+
+	def test_client_headers_sent(self):
+		self.classify('/page', headers={'Cookie': 'session=1', 'Accept-Language': 'fr', 'If-None-Match': '"a"', 'Range': 'bytes=0-1'})
+		headers = Origin.requests[0][1]
+		self.assertEqual((headers.get('Cookie'), headers.get('Accept-Language')), ('session=1', 'fr'))
+		self.assertNotIn('If-None-Match', headers)
+		self.assertNotIn('Range', headers)
+
+if __name__ == '__main__':
+	unittest.main()
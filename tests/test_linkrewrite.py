@@ -0,0 +1,44 @@
+import os
+import sys
+import glob
+import subprocess
+import unittest
+
+APP_FACTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'liveserve', 'app_factory')
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'html_corpus')
+sys.path.insert(0, APP_FACTORY)
+
+from linkrewrite import LinkRewriter
+
+# seconds a corpus page may take, a regex backtracking on one takes minutes
+TIME_LIMIT = 5
+
+REWRITE = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+from linkrewrite import LinkRewriter
+with open(sys.argv[2], encoding='utf-8') as f:
+	LinkRewriter('example.com', 'proxy.test', 8080).rewrite_html(f.read() * 20)
+'''
+
+class LinkRewriteTest(unittest.TestCase):
+	def setUp(self):
+		self.rewriter = LinkRewriter('example.com', 'proxy.test', 8080)
+
+	def test_corpus_in_time(self):
+		# in a child process: a match in progress cannot be interrupted
+		for path in sorted(glob.glob(os.path.join(CORPUS, '*.html'))):
+			with self.subTest(page=os.path.basename(path)):
+				subprocess.run([sys.executable, '-c', REWRITE, APP_FACTORY, path], check=True, timeout=TIME_LIMIT)
+
+	def test_unclosed_tags_pass_through(self):
+		for page in ['<a href=https://example.com/', '<a href=https://example.com/ ', "<p>if x<y then see https://example.com/ it's fine</p>"]:
+			with self.subTest(page=page):
+				self.assertEqual(self.rewriter.rewrite_html(page), page)
+
+	def test_links_rewritten(self):
+		page = '<a href="https://example.com/a">a</a> <img src=https://cdn.example.com/b.png>'
+		self.assertEqual(self.rewriter.rewrite_html(page), '<a href="https://proxy.test:8080/a">a</a> <img src=https://cdn.proxy.test:8080/b.png>')
+
+if __name__ == '__main__':
+	unittest.main()
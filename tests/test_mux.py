@@ -0,0 +1,129 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli'))
+
+import mux
+
+async def connection_pair():
+	''' (server, client, the queue of the streams opened to the client, their run() tasks) over a loopback connection '''
+	accepted = asyncio.Queue()
+	listener = await asyncio.start_server(lambda reader, writer: accepted.put_nowait((reader, writer)), '127.0.0.1', 0)
+	port = listener.sockets[0].getsockname()[1]
+	opened = asyncio.Queue()
+	client = await mux.connect('127.0.0.1', port, on_open=opened.put_nowait)
+	server = await mux.accept(*await accepted.get())
+	listener.close()
+	tasks = [asyncio.ensure_future(server.run()), asyncio.ensure_future(client.run())]
+	return server, client, opened, tasks
+
+async def settle():
+	for _ in range(20):
+		await asyncio.sleep(0)
+	await asyncio.sleep(.05)
+
+class MuxStreamTest(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		(self.server, self.client, self.opened, self.tasks) = await connection_pair()
+
+	async def asyncTearDown(self):
+		self.server.close()
+		self.client.close()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+
+	async def open_stream(self, port=8080):
+		stream = await self.server.open_stream(port)
+		return stream, await asyncio.wait_for(self.opened.get(), 5)
+
+	async def read_all(self, stream):
+		chunks = []
+		while True:
+			data = await stream.read()
+			if not data:
+				return b''.join(chunks)
+			chunks.append(data)
+
+	async def test_open_carries_port(self):
+		(stream, peer) = await self.open_stream(4242)
+		self.assertEqual(peer.port, 4242)
+		self.assertEqual(peer.stream_id, stream.stream_id)
+		self.assertEqual(stream.stream_id % 2, 1)
+
+	async def test_window_limits_data_in_flight(self):
+		(stream, peer) = await self.open_stream()
+		data = os.urandom(4 * mux.INITIAL_WINDOW)
+
+		writing = asyncio.ensure_future(peer.write(data))
+		await settle()
+		# nothing read on the server side: the client stops at the window it was granted
+		self.assertFalse(writing.done())
+		self.assertEqual(peer.send_window, 0)
+		self.assertEqual(sum(len(chunk) for chunk in stream.buffer), mux.INITIAL_WINDOW)
+
+		received = bytearray()
+		while len(received) < len(data):
+			received += await stream.read()
+		await asyncio.wait_for(writing, 5)
+		self.assertEqual(bytes(received), data)
+
+	async def test_data_beyond_window_resets_stream(self):
+		(stream, peer) = await self.open_stream()
+		# a peer ignoring the window it was granted
+		await self.client.send(mux.DATA, peer.stream_id, b'x' * (mux.INITIAL_WINDOW + 1))
+		await settle()
+		self.assertTrue(stream.is_reset)
+		self.assertNotIn(stream.stream_id, self.server.streams)
+
+	async def test_fin_ends_reads_after_the_data(self):
+		(stream, peer) = await self.open_stream()
+		await peer.write(b'hello')
+		await peer.close()
+
+		self.assertEqual(await asyncio.wait_for(self.read_all(stream), 5), b'hello')
+		# the server side can still send until it closes too
+		await stream.write(b'bye')
+		await stream.close()
+		self.assertEqual(await asyncio.wait_for(self.read_all(peer), 5), b'bye')
+
+		await settle()
+		self.assertNotIn(stream.stream_id, self.server.streams)
+		self.assertNotIn(peer.stream_id, self.client.streams)
+
+	async def test_write_after_fin_fails(self):
+		(_, peer) = await self.open_stream()
+		await peer.close()
+		with self.assertRaises(ConnectionResetError):
+			await peer.write(b'late')
+
+	async def test_reset_aborts_both_directions(self):
+		(stream, peer) = await self.open_stream()
+		reading = asyncio.ensure_future(peer.read())
+		await settle()
+
+		await stream.reset()
+		with self.assertRaises(ConnectionResetError):
+			await asyncio.wait_for(reading, 5)
+		with self.assertRaises(ConnectionResetError):
+			await peer.write(b'x')
+		self.assertNotIn(peer.stream_id, self.client.streams)
+
+	async def test_closed_connection_resets_streams(self):
+		(_, peer) = await self.open_stream()
+		self.server.close()
+		await settle()
+		self.assertTrue(peer.is_reset)
+		self.assertTrue(self.client.closed)
+
+	async def test_streams_are_independent(self):
+		(_, stalled) = await self.open_stream()
+		(stream, peer) = await self.open_stream()
+		# a stream with its window used up and nobody reading it does not hold up another
+		await stalled.write(b'x' * mux.INITIAL_WINDOW)
+		self.assertEqual(stalled.send_window, 0)
+		await peer.write(b'ping')
+		self.assertEqual(await asyncio.wait_for(stream.read(), 5), b'ping')
+
+if __name__ == '__main__':
+	unittest.main()